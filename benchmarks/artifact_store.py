@@ -0,0 +1,49 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.provisioners import ArtifactStore
+
+from tests.support.fake_archive import ArchiveServer, archive
+
+
+def provision(store_dir, url, sha256):
+  return ArtifactStore(store_dir).provision(url, sha256, ['docker/docker'])
+
+
+def measure(server, sha256, runs):
+  store_dir = tempfile.mkdtemp(prefix='cosh-artifacts-')
+  server.delay = 0
+  try:
+    started = time.time()
+    provision(store_dir, server.url(), sha256)
+    cold = time.time() - started
+    started = time.time()
+    for _ in range(runs):
+      provision(store_dir, server.url(), sha256)
+    warm = (time.time() - started) / runs
+  finally:
+    shutil.rmtree(store_dir)
+  print('%d byte archive: cold %.1fms, warm %.3fms' % (len(server.content), cold * 1000,
+                                                        warm * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Artifact store provisioning time')
+  parser.add_argument('--member-size', default=4 * 1024 * 1024, type=int)
+  parser.add_argument('--runs', default=1000, type=int)
+  args = parser.parse_args()
+
+  content = archive(args.member_size)
+  sha256 = hashlib.sha256(content).hexdigest()
+  server = ArchiveServer(content).start()
+  try:
+    measure(server, sha256, args.runs)
+  finally:
+    server.stop()
@@ -0,0 +1,42 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.support import ROOT, run_cosh, warm_tmpdir
+
+
+def run(jobs, concurrency, delay):
+  tmpdir = warm_tmpdir(jobs, 'cosh-batch-')
+  state = tempfile.mkdtemp(prefix='cosh-batch-docker-')
+  env = dict(os.environ, PYTHONPATH=ROOT, COSH_NO_DAEMON='1', FAKE_DOCKER_STATE=state,
+             FAKE_DOCKER_START_DELAY=str(delay))
+  lines = ''.join('image%d job%d\n' % (i, i) for i in range(jobs)).encode('utf-8')
+  try:
+    started = time.time()
+    for i in range(jobs):
+      run_cosh(env, tmpdir, 'image%d' % i, 'job%d' % i)
+    sequential = time.time() - started
+
+    started = time.time()
+    run_cosh(env, tmpdir, '--batch', '-', '-j', str(concurrency), stdin=lines)
+    batch = time.time() - started
+    print('%d jobs, %.1fs container start: one cosh per job %.2fs, --batch -j %d %.2fs'
+          % (jobs, delay, sequential, concurrency, batch))
+  finally:
+    shutil.rmtree(tmpdir)
+    shutil.rmtree(state)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Batch mode time against one cosh per job')
+  parser.add_argument('--jobs', default=16, type=int)
+  parser.add_argument('-j', '--concurrency', default=4, type=int)
+  parser.add_argument('--delay', default=0.2, type=float,
+                      help='Seconds the fake docker binary takes to start a container')
+  args = parser.parse_args()
+  run(args.jobs, args.concurrency, args.delay)
@@ -0,0 +1,59 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.cache import FileCache
+from cosh.docker.repositories import DockerStore
+
+from tests.support.fake_registry import FakeRegistry, PlainHttpSession
+
+
+def loader(host, cachedir, ttl, start, results):
+  repository = DockerStore(namespace='actions', name=host, http=PlainHttpSession())
+  start.wait()
+  records = FileCache(cachedir=cachedir, ttl=ttl, max_stale=0).load(repository.list)
+  results.put(len(records))
+
+
+def run(loaders, images, tags):
+  registry = FakeRegistry(images=images, tags=tags).start()
+  cachedir = tempfile.mkdtemp(prefix='cosh-cache-stress-')
+  start = multiprocessing.Barrier(loaders)
+  results = multiprocessing.Queue()
+  processes = [multiprocessing.Process(target=loader,
+                                       args=(registry.host(), cachedir, 60, start, results))
+               for _ in range(loaders)]
+
+  try:
+    started = time.time()
+    for process in processes:
+      process.start()
+    sizes = [results.get(timeout=120) for _ in processes]
+    for process in processes:
+      process.join()
+    elapsed = time.time() - started
+
+    listings = len([path for path in registry.requests
+                    if path.startswith('/v2/repositories/actions?') and '&page=' not in path])
+  finally:
+    registry.stop()
+    shutil.rmtree(cachedir)
+
+  print('%d loaders, %d images: %.3fs, %d catalog refreshes, record counts %s'
+        % (loaders, images, elapsed, listings, sorted(set(sizes))))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Concurrent FileCache loaders against a fake registry')
+  parser.add_argument('--loaders', default=32, type=int)
+  parser.add_argument('--images', default=50, type=int)
+  parser.add_argument('--tags', default=30, type=int)
+  args = parser.parse_args()
+  run(args.loaders, args.images, args.tags)
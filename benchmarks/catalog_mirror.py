@@ -0,0 +1,68 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.cache import FileCache
+from cosh.mirror import CatalogMirror, MirroredRepository
+
+from tests.support import repository
+from tests.support.fake_registry import FakeRegistry, PlainHttpSession, RecordingHttpSession
+
+
+def client(registry, mirror, kind='store'):
+  http = RecordingHttpSession()
+  host, port = mirror.address()
+  return MirroredRepository(repository(kind, registry.host(), PlainHttpSession()),
+                            'http://%s:%d' % (host, port), http), http
+
+
+def crawled(registry):
+  return repository('store', registry.host(), PlainHttpSession()).list()
+
+
+def fields(records):
+  return [record.fields() for record in records]
+
+
+def timed(fn):
+  started = time.time()
+  result = fn()
+  return result, time.time() - started
+
+
+def run(images, tags):
+  registry = FakeRegistry(images=images, tags=tags).start()
+  cachedir = tempfile.mkdtemp(prefix='cosh-mirror-')
+  # Every refresh of the mirror crawls the registry again
+  mirror = CatalogMirror(FileCache(cachedir=cachedir, ttl=0, max_stale=0),
+                         [repository('store', registry.host(), PlainHttpSession())],
+                         refresh_interval=3600).start(port=0)
+  try:
+    mirrored, http = client(registry, mirror)
+    records, full = timed(lambda: mirrored.list())
+    _, not_modified = timed(lambda: mirrored.list(records))
+    registry.touch('image3')
+    mirror.refresh()
+    _, delta = timed(lambda: mirrored.list(records))
+    _, crawl = timed(lambda: crawled(registry))
+    print('%d images: crawl %.1fms, mirror full %.1fms (%d bytes), delta %.1fms (%d bytes),'
+          ' not modified %.1fms'
+          % (images, crawl * 1000, full * 1000, http.responses[0][1], delta * 1000,
+             http.responses[2][1], not_modified * 1000))
+  finally:
+    mirror.stop()
+    registry.stop()
+    shutil.rmtree(cachedir)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Catalog mirror times against a fake registry')
+  parser.add_argument('--images', default=200, type=int)
+  parser.add_argument('--tags', default=30, type=int)
+  args = parser.parse_args()
+  run(args.images, args.tags)
@@ -0,0 +1,48 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.snapshot import CatalogSnapshot
+
+from tests.support import cosh_tmpdir, create_cosh
+from tests.support.fake_registry import FakeRegistry
+
+
+def export(registry, snapshot):
+  tmpdir = cosh_tmpdir('cosh-snapshot-')
+  try:
+    create_cosh(registry, tmpdir).export_catalog(snapshot)
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def measure(snapshot, runs):
+  started = time.time()
+  for _ in range(runs):
+    catalogs = CatalogSnapshot.read(snapshot).catalogs
+  elapsed = (time.time() - started) / runs
+  print('%d records, %d byte snapshot: read in %.1fms'
+        % (sum(len(catalog['records']) for catalog in catalogs), os.path.getsize(snapshot),
+           elapsed * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Catalog snapshot read time')
+  parser.add_argument('--images', default=500, type=int)
+  parser.add_argument('--tags', default=30, type=int)
+  parser.add_argument('--runs', default=10, type=int)
+  args = parser.parse_args()
+
+  registry = FakeRegistry(images=args.images, tags=args.tags).start()
+  snapshot_dir = tempfile.mkdtemp(prefix='cosh-snapshot-')
+  try:
+    export(registry, '%s/catalog.snapshot' % snapshot_dir)
+    measure('%s/catalog.snapshot' % snapshot_dir, args.runs)
+  finally:
+    shutil.rmtree(snapshot_dir)
+    registry.stop()
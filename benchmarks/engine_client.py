@@ -0,0 +1,43 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cosh.docker import DockerTerminalClient
+from cosh.docker.engine import DockerEngineClient
+
+from tests.support import Captured, KWARGS
+from tests.support.fake_engine import FakeEngine
+
+
+def measure(name, client, runs):
+  with Captured():
+    started = time.time()
+    for _ in range(runs):
+      client.run('alpine:3.8', ['hello'], **KWARGS)
+    elapsed = time.time() - started
+  print('%-8s %8.2fms per run' % (name, elapsed * 1000 / runs))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Docker engine api client per run overhead against a fake engine.'
+                  ' The cli client runs a stub docker binary, so docker cli start up itself is'
+                  ' not included')
+  parser.add_argument('--runs', default=200, type=int)
+  args = parser.parse_args()
+
+  socket_dir = tempfile.mkdtemp(prefix='cosh-engine-')
+  socket_path = '%s/engine.sock' % socket_dir
+  engine = FakeEngine(socket_path).start()
+  try:
+    measure('cli', DockerTerminalClient('true'), args.runs)
+    measure('engine', DockerEngineClient('true', socket_path=socket_path), args.runs)
+  finally:
+    engine.stop()
+    shutil.rmtree(socket_dir)
@@ -0,0 +1,63 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.docker import DockerEnvironment, DockerTerminalClient, LaunchPlan
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.provisioners import CommandsProvisioner
+
+
+def records(size):
+  return [DockerRepositoryRecord(repository=None, namespace='actions', name='image%d' % i,
+                                 tags=['1.0']) for i in range(size)]
+
+
+def provision(size, mode):
+  base_dir = tempfile.mkdtemp(prefix='cosh-launch-plan-')
+  env = DockerEnvironment(tmpdir_base=base_dir, home=os.environ.get('HOME', '/root'),
+                          extra_volumes={}, extra_envs=[])
+  try:
+    started = time.time()
+    plan = LaunchPlan.create(docker_client=DockerTerminalClient('docker'), env=env)
+    provisioner = CommandsProvisioner(plan=plan, records=records(size), base_dir=base_dir,
+                                      mode=mode)
+    provisioner.provision()
+    cold = time.time() - started
+
+    started = time.time()
+    provisioner.provision()
+    warm = time.time() - started
+
+    written = sum(os.path.getsize(os.path.join(root, name))
+                  for root, _, names in os.walk(base_dir) for name in names
+                  if not os.path.islink(os.path.join(root, name)))
+    return cold, warm, written
+  finally:
+    shutil.rmtree(base_dir)
+
+
+def run(sizes, runs):
+  results = {}
+  for mode in CommandsProvisioner.MODES:
+    print('%s mode' % mode)
+    print('%8s %12s %16s %12s %12s' % ('records', 'cold ms', 'cold us/record', 'warm ms', 'bytes'))
+    for size in sizes:
+      cold, warm, written = min((provision(size, mode) for _ in range(runs)),
+                                key=lambda sample: sample[0])
+      results[(mode, size)] = cold
+      print('%8d %12.1f %16.1f %12.1f %12d'
+            % (size, cold * 1000, cold * 1000000 / size, warm * 1000, written))
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Command shim generation time by catalog size')
+  parser.add_argument('--sizes', default=[50, 100, 200, 400, 800], type=int, nargs='+')
+  parser.add_argument('--runs', default=3, type=int)
+  args = parser.parse_args()
+  run(args.sizes, args.runs)
@@ -0,0 +1,46 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.support import ROOT, WARM_START, warm_tmpdir
+
+
+def run(images, runs, budget):
+  tmpdir = warm_tmpdir(images, 'cosh-startup-')
+  argv = ['--tmpdir', tmpdir, '--docker-binary', 'true', 'image0', '--version']
+  env = dict(os.environ, PYTHONPATH=ROOT, COSH_NO_DAEMON='1')
+
+  samples = []
+  try:
+    for _ in range(runs):
+      started = time.time()
+      output = subprocess.check_output([sys.executable, '-c', WARM_START] + argv, env=env)
+      samples += [dict(json.loads(output.decode('utf-8')), process=time.time() - started)]
+  finally:
+    shutil.rmtree(tmpdir)
+
+  best = min(samples, key=lambda sample: sample['elapsed'])
+  # tests/test_startup.py checks that the registry clients stay unimported
+  loaded = sorted(set(module for sample in samples for module in sample['modules']))
+  print('%d images, best of %d: import and plan %.1fms, whole process %.1fms, heavy modules: %s'
+        % (images, runs, best['elapsed'] * 1000, best['process'] * 1000,
+           ', '.join(loaded) if loaded else 'none'))
+  if best['elapsed'] > budget:
+    raise SystemExit('Warm start took %.1fms, over the %.1fms budget'
+                     % (best['elapsed'] * 1000, budget * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Warm cache startup time and import budget')
+  parser.add_argument('--images', default=200, type=int)
+  parser.add_argument('--runs', default=5, type=int)
+  parser.add_argument('--budget', default=0.15, type=float,
+                      help='Maximum seconds for imports and planning in the best run')
+  args = parser.parse_args()
+  run(args.images, args.runs, args.budget)
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+
+from cosh.catalog import Catalog
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.provisioners import CommandsProvisioner
+
+from launch_plan import provision
+from tests.support import FAKE_DOCKER, cosh_tmpdir, repository
+from tests.support.fake_registry import FakeRegistry, PlainHttpSession
+
+KINDS = ['store', 'v1', 'gcr']
+
+# Runs a command the way bin/cosh does without a daemon, against the fake registry
+COSH = '''
+import sys
+
+from cosh import args as cosh_args
+from tests.support import repository
+from tests.support.fake_registry import PlainHttpSession
+
+args = cosh_args.parse(sys.argv[3:])
+instance = cosh_args.create_cosh(args,
+                                 cosh_args.create_cache(args),
+                                 [repository(sys.argv[1], sys.argv[2], PlainHttpSession())])
+sys.exit(instance.run(args.command, args.arguments))
+'''
+
+
+def best(fn, runs):
+  samples = []
+  for _ in range(runs):
+    started = time.time()
+    fn()
+    samples += [time.time() - started]
+  return min(samples)
+
+
+def refresh(kind, sizes, tags, latency, runs):
+  results = {}
+  for size in sizes:
+    registry = FakeRegistry(images=size, tags=tags, latency=latency).start()
+    try:
+      instance = repository(kind, registry.host(), PlainHttpSession())
+      records = []
+
+      def cold():
+        records[:] = instance.list()
+
+      results['refresh.%s.cold.%d' % (kind, size)] = best(cold, runs)
+      # Nothing changed upstream, so every image is revalidated instead of fetched
+      results['refresh.%s.incremental.%d' % (kind, size)] = best(lambda: instance.list(records),
+                                                                  runs)
+      if len(records) != size:
+        raise SystemExit('%s registry listed %d of %d images' % (kind, len(records), size))
+    finally:
+      registry.stop()
+  return results
+
+
+def decode(sizes, tags, runs):
+  results = {}
+  cachedir = tempfile.mkdtemp(prefix='cosh-suite-decode-')
+  try:
+    for size in sizes:
+      file_name = '%s/%d.catalog' % (cachedir, size)
+      Catalog.write(file_name, 'suite', time.time(),
+                    [DockerRepositoryRecord(repository=None, namespace='actions',
+                                            name='image%d' % i,
+                                            tags=['1.%d' % tag for tag in range(tags)])
+                     for i in range(size)])
+
+      def records():
+        with Catalog.open(file_name) as catalog:
+          catalog.records()
+
+      def find():
+        with Catalog.open(file_name) as catalog:
+          catalog.find('image%d' % (size // 2))
+
+      results['decode.records.%d' % size] = best(records, runs)
+      results['decode.find.%d' % size] = best(find, runs)
+  finally:
+    shutil.rmtree(cachedir)
+  return results
+
+
+def shims(sizes, runs):
+  results = {}
+  for mode in CommandsProvisioner.MODES:
+    for size in sizes:
+      results['shims.%s.%d' % (mode, size)] = min(provision(size, mode)[0] for _ in range(runs))
+  return results
+
+
+def end_to_end(kind, size, tags, latency, runs):
+  registry = FakeRegistry(images=size, tags=tags, latency=latency).start()
+  state = tempfile.mkdtemp(prefix='cosh-suite-docker-')
+  env = dict(os.environ,
+             PYTHONPATH=ROOT,
+             FAKE_DOCKER_STATE=state,
+             FAKE_DOCKER_START_DELAY='0')
+
+  def cosh(tmpdir):
+    output = subprocess.check_output(
+        [sys.executable, '-c', COSH, kind, registry.host(), '--tmpdir', tmpdir,
+         '--docker-binary', FAKE_DOCKER, '--no-history',
+         'image0', '--version'], env=env)
+    if b'--version' not in output:
+      raise SystemExit('Unexpected cosh output: %s' % output)
+
+  tmpdirs = []
+  try:
+    def cold():
+      tmpdirs.append(cosh_tmpdir('cosh-suite-'))
+      cosh(tmpdirs[-1])
+
+    results = {'end_to_end.%s.cold.%d' % (kind, size): best(cold, runs),
+               'end_to_end.%s.warm.%d' % (kind, size): best(lambda: cosh(tmpdirs[-1]), runs)}
+  finally:
+    for tmpdir in tmpdirs:
+      shutil.rmtree(tmpdir)
+    shutil.rmtree(state)
+    registry.stop()
+  return results
+
+
+def revision():
+  def git(*arguments):
+    return subprocess.check_output(('git',) + arguments, cwd=ROOT).decode('utf-8').strip()
+  try:
+    return git('rev-parse', 'HEAD'), bool(git('status', '--porcelain', '--untracked-files=no'))
+  except (OSError, subprocess.CalledProcessError):
+    return None, False
+
+
+def previous_entry(results_file, host, commit):
+  entries = []
+  if os.path.exists(results_file):
+    with open(results_file, 'r') as f:
+      entries = [json.loads(line) for line in f if line.strip()]
+  # Timings are only comparable on the same host
+  entries = [entry for entry in entries if entry['host'] == host and entry['commit'] != commit]
+  return entries[-1] if entries else None
+
+
+def compare(previous, metrics, threshold):
+  regressions = []
+  print('%-40s %12s %12s %8s' % ('metric', 'ms', 'previous', 'change'))
+  for name, value in sorted(metrics.items()):
+    before = previous['metrics'].get(name) if previous else None
+    change = (value - before) / before if before else None
+    if change is not None and change > threshold:
+      regressions += [name]
+    print('%-40s %12.2f %12s %8s%s'
+          % (name, value * 1000,
+             '%.2f' % (before * 1000) if before is not None else '-',
+             '%+.0f%%' % (change * 100) if change is not None else '-',
+             ' REGRESSION' if name in regressions else ''))
+  return regressions
+
+
+def run(args):
+  metrics = {}
+  for kind in args.kinds:
+    metrics.update(refresh(kind, args.sizes, args.tags, args.latency, args.runs))
+    metrics.update(end_to_end(kind, args.sizes[0], args.tags, args.latency, args.runs))
+  metrics.update(decode(args.sizes, args.tags, args.runs))
+  metrics.update(shims(args.sizes, args.runs))
+
+  commit, dirty = revision()
+  entry = {
+    'commit': commit,
+    'dirty': dirty,
+    'time': time.time(),
+    'host': platform.node(),
+    'python': platform.python_version(),
+    'options': {'sizes': args.sizes, 'tags': args.tags, 'latency': args.latency},
+    'metrics': metrics
+  }
+  previous = previous_entry(args.results, entry['host'], commit)
+  if previous and previous['options'] != entry['options']:
+    print('Previous results were taken with %s, not comparing' % previous['options'])
+    previous = None
+  if previous:
+    print('Comparing with %s' % previous['commit'])
+  regressions = compare(previous, metrics, args.threshold)
+
+  if args.results != '-':
+    with open(args.results, 'a') as f:
+      f.write(json.dumps(entry, sort_keys=True) + '\n')
+  if regressions and args.fail_on_regression:
+    raise SystemExit('%d metrics regressed more than %d%%'
+                     % (len(regressions), args.threshold * 100))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='End to end, refresh, catalog decode and shim generation timings against a fake'
+                  ' registry and docker binary. Results are appended to a file and compared with'
+                  ' the last run of a different commit on the same host')
+  parser.add_argument('--kinds', default=KINDS, choices=KINDS, nargs='+',
+                      help='Registry flavours to benchmark')
+  parser.add_argument('--sizes', default=[50, 200, 800], type=int, nargs='+',
+                      help='Catalog sizes. End to end runs use the first one')
+  parser.add_argument('--tags', default=30, type=int, help='Tags per image')
+  parser.add_argument('--latency', default=0.002, type=float,
+                      help='Seconds every registry response is delayed by')
+  parser.add_argument('--runs', default=3, type=int, help='Runs per metric, the best one counts')
+  parser.add_argument('--results', default='%s/results.jsonl' % BENCHMARKS,
+                      help='File results are appended to. - keeps them out of any file')
+  parser.add_argument('--threshold', default=0.2, type=float,
+                      help='Relative slowdown reported as a regression')
+  parser.add_argument('--fail-on-regression', dest='fail_on_regression', action='store_true',
+                      help='Exit with an error when any metric regressed')
+  parser.set_defaults(fail_on_regression=False)
+  run(parser.parse_args())
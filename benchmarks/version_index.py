@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cosh.docker.repositories import DockerRepositoryRecord
+
+from tests.support import tags
+
+
+def specs(majors):
+  return ['^3.5', '~3.5', '>=10 <12', '<=2.3', '>3', '8-*', '^0.2', '^%d' % majors]
+
+
+def run(majors, lookups):
+  record = DockerRepositoryRecord(repository=None, namespace='actions', name='node',
+                                  tags=tags(majors, 10, 10))
+  started = time.time()
+  fields = record.fields()
+  built = time.time() - started
+
+  # Decoded from the cache, the way Cosh sees it
+  record = DockerRepositoryRecord.from_fields(fields)
+  lookup_specs = specs(majors)
+  started = time.time()
+  for i in range(lookups):
+    record.version_index().resolve(lookup_specs[i % len(lookup_specs)])
+  elapsed = time.time() - started
+  print('%6d tags: index built in %.1fms, %.1fus per lookup'
+        % (len(record.tags), built * 1000, elapsed * 1000000 / lookups))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Version constraint resolution time by tag count')
+  parser.add_argument('--majors', default=[20, 50, 100, 200], type=int, nargs='+')
+  parser.add_argument('--lookups', default=10000, type=int)
+  args = parser.parse_args()
+  for majors in args.majors:
+    run(majors, args.lookups)
@@ -0,0 +1,46 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cosh.docker import DockerTerminalClient
+from cosh.docker.warm import WarmContainerClient
+
+from tests.support import FAKE_DOCKER, KWARGS
+
+
+def measure(name, client, runs):
+  started = time.time()
+  for _ in range(runs):
+    subprocess.check_output(client.exec_command('alpine:3.8', ['hello'], **KWARGS)
+                            if isinstance(client, WarmContainerClient)
+                            else client.run_command('alpine:3.8', ['hello'], **KWARGS),
+                            shell=True)
+  print('%-6s %8.1fms per call' % (name, (time.time() - started) * 1000 / runs))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Warm container per call time against a stub docker binary')
+  parser.add_argument('--runs', default=10, type=int)
+  parser.add_argument('--start-delay', default=0.5, type=float,
+                      help='Simulated container start up time in seconds')
+  args = parser.parse_args()
+
+  state_dir = tempfile.mkdtemp(prefix='cosh-fake-docker-')
+  warm_dir = tempfile.mkdtemp(prefix='cosh-warm-')
+  os.environ['FAKE_DOCKER_STATE'] = state_dir
+  os.environ['FAKE_DOCKER_START_DELAY'] = str(args.start_delay)
+  try:
+    measure('run', DockerTerminalClient(FAKE_DOCKER), args.runs)
+    measure('exec', WarmContainerClient(DockerTerminalClient(FAKE_DOCKER), state_dir=warm_dir),
+            args.runs)
+  finally:
+    shutil.rmtree(warm_dir)
+    shutil.rmtree(state_dir)
@@ -1,32 +1,91 @@
 import argparse
 import logging
 import os
-from random import Random
+import sys
 
-from cosh import Cosh
-from cosh.cache import FileCache, NoCache
+from cosh.batch import BatchRunner, parse_jobs
+from cosh.cache import FileCache, NoCache, RegistryCache
+from cosh.core import Cosh
 from cosh.docker import DockerTerminalClient, DockerEnvironment
-from cosh.docker.repositories import DockerRepositoryFactory
-from cosh.tmpdir import Tmpdir, rmdir
+from cosh.docker.warm import WarmContainerClient
+from cosh.docker.repositories import DockerRepositoryFactory, TagFetcher
+from cosh.docker.tokens import TokenCache
+from cosh.history import UsageHistory
+from cosh.prefetch import Prefetcher
+from cosh.provisioners import ArtifactStore, CommandsProvisioner
+from cosh.session import HttpSession
+from cosh.snapshot import SnapshotCache
+from cosh.tmpdir import Tmpdir
+from cosh.trace import Tracer
 
 
 def normalize_path(path):
   return os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
 
 
-def get():
+def parse(argv=None):
   parser = argparse.ArgumentParser(description='Container shell', prog='cosh')
   parser.add_argument('--home', default=os.environ.get('HOME'), type=str,
                       help='Set home path to be mounted for containers')
   parser.add_argument('--tmpdir', default=Tmpdir.default_instance().base(), type=str,
                       help='Set tmp path to be mounted for containers')
   parser.add_argument('--debug', dest='debug', action='store_true', help='Turn on debug logging')
+  parser.add_argument('--timings', dest='timings', action='store_true',
+                      help='Log how long each phase took. COSH_TRACE=1 does the same')
+  parser.add_argument('--trace-file', type=str, required=False,
+                      help='Write a chrome trace (chrome://tracing) of the phases to this file.'
+                           ' A directory gets one file per invocation. Also set by COSH_TRACE')
   parser.add_argument('--docker-binary', default='docker', type=str, help='Docker binary path')
+  parser.add_argument('--docker-client', default='cli', choices=['cli', 'engine'],
+                      help='Run containers through the docker binary, or talk to the docker engine'
+                           ' api over its unix socket directly. The engine client falls back to'
+                           ' the docker binary when the socket is not available')
+  parser.add_argument('--reuse-containers', dest='reuse_containers', action='store_true',
+                      help='Keep one container running per image, mounts, environment and working'
+                           ' dir and run commands in it with docker exec')
+  parser.add_argument('--reuse-idle-timeout', default=WarmContainerClient.DEFAULT_IDLE_TIMEOUT,
+                      type=int, help='Seconds a reused container may stay unused before it'
+                                     ' exits')
+  parser.add_argument('--artifact-dir', type=str, required=False,
+                      help='Directory provisioned binaries, i.e. the static docker binary, are'
+                           ' stored in by checksum. May be shared by several tmpdirs and hosts.'
+                           ' Defaults to a directory in tmpdir')
   parser.add_argument('--cache-dir', type=str, required=False,
                       help='Repository record cache directory')
   parser.add_argument('--no-cache', dest='cache', action='store_false', help='Ignore cache')
   parser.add_argument('--cache-ttl', default=6 * 60 * 60, type=int,
                       help='Repository cache ttl in seconds')
+  parser.add_argument('--cache-max-stale', default=7 * 24 * 60 * 60, type=int,
+                      help='Maximum repository cache age in seconds that is still served'
+                           ' while it is refreshed in background. Older caches are refreshed'
+                           ' before running the command. Use 0 to always refresh in foreground')
+  parser.add_argument('--catalog-snapshot', type=str, required=False,
+                      help='Serve repository catalogs from a snapshot written by cosh catalog'
+                           ' export instead of the cache. Registries are never asked for catalogs')
+  parser.add_argument('--catalog-mirror', type=str, required=False,
+                      help='Url of a cosh serve-catalog mirror. Expired catalogs are fetched from'
+                           ' it with a single conditional request instead of crawling registries.'
+                           ' Repositories it does not mirror are crawled as usual')
+  parser.add_argument('--registry-ttl', default=RegistryCache.DEFAULT_TTL, type=int,
+                      help='Seconds the detected kind of a repository registry is cached for')
+  parser.add_argument('--lazy', dest='lazy', action='store_true',
+                      help='Resolve only the requested command instead of loading full repository'
+                           ' catalogs. Embedded commands are limited to already cached records')
+  parser.add_argument('--commands-mode', default=CommandsProvisioner.MODE_MOUNTS,
+                      choices=CommandsProvisioner.MODES,
+                      help='How embedded commands are exposed to containers: one rendered script'
+                           ' per command bind mounted to /sbin/<command>, or one directory of'
+                           ' links to a shared dispatcher script, mounted once and put first on'
+                           ' the PATH of the image')
+  parser.add_argument('--fetch-concurrency', default=TagFetcher.DEFAULT_CONCURRENCY, type=int,
+                      help='Maximum number of concurrent image tag requests per repository')
+  parser.add_argument('--http-pool-size', type=int, required=False,
+                      help='Registry http connection pool size.'
+                           ' Defaults to the tag fetch concurrency')
+  parser.add_argument('--http-timeout', default=HttpSession.DEFAULT_TIMEOUT, type=int,
+                      help='Registry http request timeout in seconds')
+  parser.add_argument('--http-retries', default=HttpSession.DEFAULT_RETRIES, type=int,
+                      help='Number of retries with exponential backoff for failed registry requests')
   parser.add_argument('-r', '--repository', dest='repositories',
                       type=str, required=False, action='append',
                       help='Docker image repository that will be used as a prefix.'
@@ -42,70 +101,252 @@ def get():
                       help='Extra docker environments to be set for containers. '
                            ' Multiple values are allowed.'
                            ' Format: KEY=VALUE. Example: -e MY_VAR=foo')
+  parser.add_argument('--no-history', dest='history', action='store_false',
+                      help='Do not record used images. cosh prefetch pulls the most used ones')
   parser.add_argument('--gcr-key-file', type=str, required=False,
                       help='GCR key file that would be used if gcr.io repository was provided')
 
-  parser.add_argument('command', type=str,
-                      help='Command to execute')
+  parser.add_argument('--batch', type=str, required=False,
+                      help='Run the commands of this file, one per line, instead of a single'
+                           ' command. - reads them from stdin. The catalog is loaded and commands'
+                           ' are provisioned once for all of them')
+  parser.add_argument('-j', '--jobs', default=BatchRunner.DEFAULT_CONCURRENCY, type=int,
+                      help='Maximum number of batch commands running at the same time')
+  parser.add_argument('-k', '--keep-going', dest='keep_going', action='store_true',
+                      help='Keep starting batch commands after one failed')
+  parser.add_argument('--batch-output', default=BatchRunner.OUTPUT_PREFIX,
+                      choices=BatchRunner.OUTPUTS,
+                      help='Prefix every output line of a batch command with its number and'
+                           ' name, or print the whole output of a command once it finished')
+  parser.add_argument('command', type=str, nargs='?',
+                      help='Command to execute. prefetch pulls images ahead of time,'
+                           ' see cosh prefetch --help. catalog exports and imports catalog'
+                           ' snapshots, see cosh catalog --help. serve-catalog runs a catalog'
+                           ' mirror, see cosh serve-catalog --help')
   parser.add_argument('arguments', type=str, nargs=argparse.REMAINDER,
                       help='Command arguments')
 
   parser.set_defaults(debug=False)
+  parser.set_defaults(timings=False)
   parser.set_defaults(cache=True)
+  parser.set_defaults(lazy=False)
+  parser.set_defaults(history=True)
+  parser.set_defaults(reuse_containers=False)
+  parser.set_defaults(keep_going=False)
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
-  if args.debug:
-    logging.basicConfig(level=logging.DEBUG)
-  else:
-    logging.basicConfig(level=logging.INFO)
+  if args.batch and args.command:
+    parser.error('--batch runs the commands of its file, no command may be given')
+  if not args.batch and not args.command:
+    parser.error('the following arguments are required: command')
+
+  if not args.repositories:
+    args.repositories = ['actions/']
+
+  return args
+
+
+def parse_prefetch(argv):
+  parser = argparse.ArgumentParser(description='Pull images ahead of time, so that the first run'
+                                               ' of a command does not wait for it',
+                                   prog='cosh prefetch')
+  parser.add_argument('--top', default=Prefetcher.DEFAULT_TOP, type=int,
+                      help='Number of most used images to pull when no commands are given')
+  parser.add_argument('-j', '--jobs', default=Prefetcher.DEFAULT_CONCURRENCY, type=int,
+                      help='Maximum number of concurrent pulls')
+  parser.add_argument('commands', type=str, nargs='*',
+                      help='Commands to pull images for, optionally versioned. Example: mvn:3.5.4')
+  return parser.parse_args(argv)
+
+
+def parse_catalog(argv):
+  parser = argparse.ArgumentParser(description='Share repository catalogs through snapshots, so'
+                                               ' that hosts without registry access can run'
+                                               ' commands',
+                                   prog='cosh catalog')
+  actions = parser.add_subparsers(dest='action')
+  actions.required = True
+  export_parser = actions.add_parser('export', help='Write a snapshot of the configured'
+                                                    ' repository catalogs, refreshing them first'
+                                                    ' when they expired')
+  export_parser.add_argument('file', type=str, nargs='?', default='-',
+                             help='Snapshot file, - for stdout')
+  import_parser = actions.add_parser('import', help='Load the configured repository catalogs from'
+                                                    ' a snapshot into the cache')
+  import_parser.add_argument('file', type=str, help='Snapshot file, - for stdin')
+  return parser.parse_args(argv)
 
+
+def parse_serve_catalog(argv):
+  parser = argparse.ArgumentParser(description='Keep the configured repository catalogs up to date'
+                                               ' and serve them to cosh --catalog-mirror clients',
+                                   prog='cosh serve-catalog')
+  parser.add_argument('--bind', default='127.0.0.1', type=str, help='Address to listen on')
+  parser.add_argument('--port', default=8787, type=int, help='Port to listen on')
+  parser.add_argument('--refresh-interval', default=60, type=int,
+                      help='Seconds between checks of the catalogs. Registries are only crawled'
+                           ' once a catalog is older than --cache-ttl')
+  return parser.parse_args(argv)
+
+
+# Subcommands parse their own arguments, before anything is set up for them. Usage errors and
+# --help exit right away
+def parse_command(args):
+  parsers = {
+    'prefetch': parse_prefetch,
+    'catalog': parse_catalog,
+    'serve-catalog': parse_serve_catalog
+  }
+  if args.batch or args.command not in parsers:
+    return None
+  return parsers[args.command](args.arguments)
+
+
+def create_tmpdir(args):
   # TODO: Redesign
-  tmpdir = Tmpdir(basedir=normalize_path(args.tmpdir),
-                  cachedir=normalize_path(args.cache_dir) if args.cache_dir else None)
+  return Tmpdir(basedir=normalize_path(args.tmpdir),
+                cachedir=normalize_path(args.cache_dir) if args.cache_dir else None)
+
+
+def create_cache(args):
+  if args.catalog_snapshot:
+    return SnapshotCache(normalize_path(args.catalog_snapshot))
+  return FileCache(cachedir=create_tmpdir(args).cache(),
+                   ttl=args.cache_ttl,
+                   max_stale=args.cache_max_stale) if args.cache else NoCache()
+
+
+def create_http(args):
+  return HttpSession(pool_size=args.http_pool_size or max(args.fetch_concurrency, 1),
+                     timeout=args.http_timeout,
+                     retries=args.http_retries)
+
+
+def create_repositories(args, http_session):
+  logging.debug('Got repositories: %s' % args.repositories)
+  fetcher = TagFetcher(concurrency=args.fetch_concurrency)
+  token_cache = TokenCache(create_tmpdir(args).tokens())
+  registry_cache = RegistryCache('%s/registries.json' % create_tmpdir(args).cache(),
+                                 ttl=args.registry_ttl) if args.cache else None
+  repositories = DockerRepositoryFactory.repositories([
+    DockerRepositoryFactory(repository.strip(),
+                            args.gcr_key_file,
+                            fetcher,
+                            http_session,
+                            token_cache,
+                            registry_cache)
+    for repository in args.repositories])
+  if args.catalog_mirror and args.command != 'serve-catalog':
+    from cosh.mirror import MirroredRepository
+    return [MirroredRepository(repository, args.catalog_mirror, http_session)
+            for repository in repositories]
+  return repositories
+
+
+def create_docker_client(args):
+  docker_binary = os.path.expanduser(os.path.expandvars(args.docker_binary))
+  if args.docker_client == 'engine':
+    from cosh.docker.engine import DockerEngineClient
+    docker_client = DockerEngineClient(docker_binary)
+  else:
+    docker_client = DockerTerminalClient(docker_binary)
+  if args.reuse_containers:
+    return WarmContainerClient(docker_client,
+                               state_dir=create_tmpdir(args).warm(),
+                               idle_timeout=args.reuse_idle_timeout)
+  return docker_client
+
+
+def create_cosh(args, repository_cache, repository_list, http_session=None):
+  cosh_tmpdir = create_tmpdir(args)
 
   volumes = {
     normalize_path(volume.split(':')[0]): normalize_path(volume.split(':')[1])
     for volume in args.volumes
   }
 
-  if not args.repositories:
-    args.repositories = ['actions/']
-
-  cache = FileCache(cachedir=tmpdir.cache(), ttl=args.cache_ttl) if args.cache else NoCache()
-
-  logging.debug('Got repositories: %s' % args.repositories)
-  repositories = [DockerRepositoryFactory(repository.strip(), args.gcr_key_file).versions().pop()
-                  for repository in args.repositories]
-
-  maybe_versioned_command = args.command.split(':')
-  command_name = maybe_versioned_command[0]
-  command_base_dir = '%s/%s.%d' \
-                     % (tmpdir.bin().rstrip('/'), command_name, Random().randint(10000, 99999))
-  logging.debug('Creating command base dir: %s' % command_base_dir)
-  if not os.path.exists(command_base_dir):
-    os.makedirs(command_base_dir)
-
-  docker_client = DockerTerminalClient(os.path.expanduser(os.path.expandvars(args.docker_binary)))
-
-  cosh = Cosh(docker_client=docker_client,
-              tmpdir=tmpdir.tmp(),
-              command_base_dir=command_base_dir,
-              env=DockerEnvironment(tmpdir_base=tmpdir.base(),
+  return Cosh(docker_client=create_docker_client(args),
+              artifact_store=ArtifactStore(normalize_path(args.artifact_dir)
+                                           if args.artifact_dir else cosh_tmpdir.artifacts(),
+                                           http=http_session if http_session
+                                           else create_http(args)),
+              command_base_dir=cosh_tmpdir.bin().rstrip('/'),
+              env=DockerEnvironment(tmpdir_base=cosh_tmpdir.base(),
                                     home=normalize_path(args.home),
                                     extra_volumes=volumes,
                                     extra_envs=args.envs),
-              cache=cache,
-              repositories=repositories)
+              cache=repository_cache,
+              repositories=repository_list,
+              lazy=args.lazy,
+              commands_mode=args.commands_mode,
+              history=UsageHistory(cosh_tmpdir.history()) if args.history else None)
+
+
+def serve_catalog(args, serve_args, repositories):
+  from cosh.mirror import CatalogMirror
+  # Expired catalogs are refreshed by the refresh loop itself, never in a forked process
+  cache = FileCache(cachedir=create_tmpdir(args).cache(),
+                    ttl=args.cache_ttl,
+                    max_stale=0) if args.cache else NoCache()
+  CatalogMirror(cache, repositories, serve_args.refresh_interval) \
+    .serve(serve_args.bind, serve_args.port)
+
 
-  logging.debug('Running cosh: %s' % cosh)
+def run_batch(args, instance):
+  if args.batch == '-':
+    jobs = parse_jobs(sys.stdin)
+  else:
+    with open(normalize_path(args.batch), 'r') as f:
+      jobs = parse_jobs(f)
+  return BatchRunner.report(instance.batch(jobs, args.jobs, args.keep_going, args.batch_output))
+
+
+def get():
+  args = parse()
+  command_args = parse_command(args)
+
+  if args.debug:
+    logging.basicConfig(level=logging.DEBUG)
+  else:
+    logging.basicConfig(level=logging.INFO)
+
+  tracer = Tracer.default_instance()
+  tracer.enable(summary=args.timings,
+                trace_file=normalize_path(args.trace_file) if args.trace_file else None)
+
+  http_session = create_http(args)
+  repositories = create_repositories(args, http_session)
+  instance = create_cosh(args, create_cache(args), repositories, http_session)
+
+  logging.debug('Running cosh: %s' % instance)
+  status = None
   try:
-    cosh.run(args.command, args.arguments)
+    if args.batch:
+      status = run_batch(args, instance)
+    elif args.command == 'prefetch':
+      instance.prefetch(command_args.commands, command_args.top, command_args.jobs)
+    elif args.command == 'serve-catalog':
+      serve_catalog(args, command_args, repositories)
+    elif args.command == 'catalog':
+      if command_args.action == 'export':
+        instance.export_catalog(command_args.file)
+      elif not args.cache or args.catalog_snapshot:
+        raise Exception('cosh catalog import needs a writable cache,'
+                        ' --no-cache and --catalog-snapshot do not have one')
+      else:
+        instance.import_catalog(command_args.file)
+    else:
+      instance.run(args.command, args.arguments)
   except BaseException as e:
     if isinstance(e, KeyboardInterrupt):
       logging.error('Interrupting...')
     else:
       logging.error(e)
+    if args.batch:
+      status = 1
 
-  logging.debug('Cleaning up: %s' % command_base_dir)
-  rmdir(command_base_dir)
+  http_session.log_stats()
+  tracer.report()
+  # Only batches report an exit status so far
+  return status
@@ -0,0 +1,111 @@
+import logging
+import shlex
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cosh.misc import Printable
+
+
+# Jobs are read one per line, blank lines and # comments are skipped
+def parse_jobs(lines):
+  jobs = []
+  for line in lines:
+    words = shlex.split(line, comments=True)
+    if words:
+      jobs += [(words[0], [shlex.quote(word) for word in words[1:]])]
+  return jobs
+
+
+class BatchJob(Printable):
+  NOT_FOUND = 127
+
+  def __init__(self, number, command_str, arguments, command=None, error=None):
+    self.number = number
+    self.command_str = command_str
+    self.arguments = arguments
+    # The shell command that runs the container
+    self.command = command
+    self.error = error
+    # None while the job did not run
+    self.status = None
+
+  def label(self):
+    return '%d %s' % (self.number, self.command_str)
+
+
+class BatchRunner(Printable):
+  DEFAULT_CONCURRENCY = 4
+  OUTPUT_PREFIX = 'prefix'
+  OUTPUT_COLLECT = 'collect'
+  OUTPUTS = [OUTPUT_PREFIX, OUTPUT_COLLECT]
+
+  def __init__(self, concurrency=DEFAULT_CONCURRENCY, keep_going=False, output=OUTPUT_PREFIX,
+               stream=None):
+    self.concurrency = concurrency
+    self.keep_going = keep_going
+    self.output = output
+    self.stream = stream if stream else sys.stdout.buffer
+    self.__failed = threading.Event()
+    self.__lock = threading.Lock()
+
+  def __write(self, content):
+    with self.__lock:
+      self.stream.write(content)
+      self.stream.flush()
+
+  def __header(self, job):
+    return ('==> %s <==\n' % job.label()).encode('utf-8')
+
+  def __run(self, job):
+    if self.__failed.is_set() and not self.keep_going:
+      return job
+    prefix = ('[%s] ' % job.label()).encode('utf-8')
+    collect = self.output == BatchRunner.OUTPUT_COLLECT
+
+    if job.error:
+      job.status = BatchJob.NOT_FOUND
+      self.__failed.set()
+      self.__write((self.__header(job) if collect else prefix) + job.error.encode('utf-8') + b'\n')
+      return job
+
+    logging.debug('Running job %s: %s' % (job.label(), job.command))
+    # Jobs share the terminal, none of them gets stdin
+    process = subprocess.Popen(job.command, shell=True, close_fds=True, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = []
+    for line in process.stdout:
+      if collect:
+        lines += [line]
+      else:
+        self.__write(prefix + line)
+    status = process.wait()
+    # Like a shell, a job killed by a signal reports 128 + the signal number
+    job.status = status if status >= 0 else 128 - status
+
+    if collect:
+      self.__write(b''.join([self.__header(job)] + lines))
+    if job.status:
+      self.__failed.set()
+    return job
+
+  def run(self, jobs):
+    if not jobs:
+      return []
+    # Without --keep-going jobs that did not start yet are skipped after the first failure
+    with ThreadPoolExecutor(max_workers=max(min(self.concurrency, len(jobs)), 1)) as executor:
+      return list(executor.map(self.__run, jobs))
+
+  # Logs a summary, returns the status of the first failed job or 0
+  @classmethod
+  def report(cls, jobs):
+    failed = [job for job in jobs if job.status]
+    for job in failed:
+      logging.error('Job %s failed with status %d' % (job.label(), job.status))
+    logging.info('Ran %d of %d jobs, %d failed, %d skipped'
+                 % (len([job for job in jobs if job.status is not None]),
+                    len(jobs),
+                    len(failed),
+                    len([job for job in jobs if job.status is None])))
+    return failed[0].status if failed else 0
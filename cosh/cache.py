@@ -1,10 +1,14 @@
+import hashlib
+import json
 import logging
 import os
+import threading
 import time
 
-import jsonpickle
-
+from cosh.catalog import Catalog
+from cosh.files import FileLock, atomic_write
 from cosh.misc import Printable
+from cosh.trace import traced
 
 
 def func_ref_name(fn_ref):
@@ -20,51 +24,381 @@ def func_call(fn_ref, *fn_args):
   return fn_ref.__call__(*fn_args) if fn_arg_size > 0 else fn_ref.__call__()
 
 
+def accepts_previous(fn_ref):
+  import inspect
+  return 'previous' in inspect.signature(fn_ref).parameters
+
+
+def instance_key(instance):
+  state = instance.__getstate__() if hasattr(instance, '__getstate__') else instance.__dict__
+  return json.dumps({
+    'class': '%s.%s' % (instance.__class__.__module__, instance.__class__.__qualname__),
+    'state': state
+  }, sort_keys=True, default=str)
+
+
+def detach(fn):
+  pid = os.fork()
+  if pid > 0:
+    # The intermediate child exits right away, so this never waits for fn
+    os.waitpid(pid, 0)
+    return
+  try:
+    os.setsid()
+    if os.fork() > 0:
+      os._exit(0)
+    with open(os.devnull, 'r+') as devnull:
+      os.dup2(devnull.fileno(), 0)
+      os.dup2(devnull.fileno(), 1)
+      if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        os.dup2(devnull.fileno(), 2)
+    fn()
+  except BaseException as e:
+    logging.debug('Background task failed: %s' % e)
+  finally:
+    os._exit(0)
+
+
 class FileCache(Printable):
+  # Catalogs missing images that failed to fetch are crawled again this soon
+  FAILED_RETRY = 5 * 60
+  # Merges of earlier generations are kept this long for processes still reading them
+  MERGED_RETENTION = 24 * 60 * 60
 
-  def __init__(self, cachedir, ttl=1 * 60 * 60):
+  def __init__(self, cachedir, ttl=1 * 60 * 60, max_stale=7 * 24 * 60 * 60):
     self.cachedir = cachedir
     self.ttl = ttl
+    self.max_stale = max_stale
 
-  def load(self, fn_ref, *fn_args):
-    logging.debug('Loading file cache for %s with %s' % (fn_ref, fn_args))
-    file_name = '%s/%s%s.json' % (
+  def __file_name(self, fn_ref, *fn_args):
+    return '%s/%s%s.%s.catalog' % (
       self.cachedir,
       func_ref_name(fn_ref),
-      ('_' + '_'.join(fn_args) if fn_args else '')
+      ('_' + '_'.join(fn_args) if fn_args else ''),
+      hashlib.sha1(instance_key(fn_ref.__self__).encode('utf-8')).hexdigest()[:12]
     )
 
-    if os.path.exists(file_name):
-      with open(file_name) as f:
-        cache = jsonpickle.decode(f.read())
-
-      if time.time() - cache['timestamp'] > self.ttl or not cache['instance'] == fn_ref.__self__:
-        logging.debug('Cache expired. Refreshing...')
-        cache = {
-          'instance': fn_ref.__self__,
-          'result': func_call(fn_ref, *fn_args),
-          'timestamp': time.time()
-        }
-        logging.debug('Writing cache: %s' % cache)
-        with open(file_name, 'wb') as f:
-          f.write(jsonpickle.encode(cache).encode('utf-8'))
-          f.flush()
-      else:
-        logging.debug('Valid cache found. Loading...')
+  def __open(self, fn_ref, *fn_args):
+    catalog = Catalog.open(self.__file_name(fn_ref, *fn_args))
+    if catalog and not catalog.key == instance_key(fn_ref.__self__):
+      catalog.close()
+      return None
+    return catalog
+
+  def __is_valid(self, catalog):
+    return catalog is not None and time.time() - catalog.timestamp <= self.ttl
+
+  def __is_servable(self, catalog):
+    return catalog is not None and time.time() - catalog.timestamp <= self.max_stale
+
+  def __lock(self, fn_ref, *fn_args):
+    return FileLock('%s.lock' % self.__file_name(fn_ref, *fn_args))
+
+  def __fresh_records(self, fn_ref, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
+      return None
+    with catalog:
+      return catalog.records() if self.__is_valid(catalog) else None
+
+  def __refresh(self, fn_ref, *fn_args):
+    # Only one process refreshes, the others wait for it and load its result
+    with self.__lock(fn_ref, *fn_args):
+      records = self.__fresh_records(fn_ref, *fn_args)
+      if records is not None:
+        logging.debug('Cache was refreshed by another process. Loading...')
+        return records
+      return self.__write(fn_ref, *fn_args)
+
+  def __refresh_in_background(self, fn_ref, *fn_args):
+    def refresh():
+      lock = self.__lock(fn_ref, *fn_args)
+      if not lock.acquire(blocking=False):
+        logging.debug('Cache is already being refreshed by another process')
+        return
+      try:
+        if self.__fresh_records(fn_ref, *fn_args) is None:
+          self.__write(fn_ref, *fn_args)
+      finally:
+        lock.release()
+
+    detach(refresh)
+
+  def __failed_file_name(self, fn_ref, *fn_args):
+    return '%s.failed' % self.__file_name(fn_ref, *fn_args)
+
+  def __write_failed(self, fn_ref, failed, *fn_args):
+    file_name = self.__failed_file_name(fn_ref, *fn_args)
+    if failed:
+      with atomic_write(file_name) as f:
+        json.dump(failed, f)
+    elif os.path.exists(file_name):
+      os.remove(file_name)
+
+  # The failures of the last refresh are reported on every load, background refreshes can not
+  def __warn_failed(self, fn_ref, *fn_args):
+    try:
+      with open(self.__failed_file_name(fn_ref, *fn_args)) as f:
+        failed = json.load(f)
+    except (OSError, ValueError):
+      return
+    logging.warning('Tags of %d images of %s/%s could not be fetched at the last refresh: %s'
+                    % (len(failed), fn_ref.__self__.name, fn_ref.__self__.namespace,
+                       ', '.join(failed)))
+
+  def __write(self, fn_ref, *fn_args):
+    if accepts_previous(fn_ref):
+      # Unchanged records are carried over from the previous catalog, expired or not
+      result = fn_ref(*fn_args, previous=self.cached(fn_ref, *fn_args))
     else:
+      result = func_call(fn_ref, *fn_args)
+    failed = getattr(result, 'failed', [])
+    timestamp = None
+    if failed:
+      # Failed images keep their previous records or none, neither is good for a whole ttl
+      timestamp = time.time() - max(self.ttl - FileCache.FAILED_RETRY, 0)
+    self.__store(fn_ref, result, *fn_args, timestamp=timestamp)
+    self.__write_failed(fn_ref, failed, *fn_args)
+    return result
+
+  def __store(self, fn_ref, records, *fn_args, timestamp=None):
+    logging.debug('Writing cache: %s' % records)
+    Catalog.write(self.__file_name(fn_ref, *fn_args),
+                  key=instance_key(fn_ref.__self__),
+                  timestamp=timestamp if timestamp else time.time(),
+                  records=records)
+
+  def store(self, fn_ref, records, *fn_args, timestamp=None):
+    with self.__lock(fn_ref, *fn_args):
+      self.__store(fn_ref, records, *fn_args, timestamp=timestamp)
+
+  # Returns an open catalog that may be served, refreshing it first when there is none
+  def __ensure(self, fn_ref, *fn_args):
+    catalog = self.__ensure_catalog(fn_ref, *fn_args)
+    self.__warn_failed(fn_ref, *fn_args)
+    return catalog
+
+  def __ensure_catalog(self, fn_ref, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
       logging.debug('No cache found. Refreshing...')
-      cache = {
-        'instance': fn_ref.__self__,
-        'result': func_call(fn_ref, *fn_args),
-        'timestamp': time.time()
+    elif self.__is_valid(catalog):
+      logging.debug('Valid cache found. Loading...')
+      return catalog
+    elif self.__is_servable(catalog):
+      logging.debug('Cache expired. Serving stale records while refreshing in background...')
+      self.__refresh_in_background(fn_ref, *fn_args)
+      return catalog
+    else:
+      logging.debug('Cache expired. Refreshing...')
+      catalog.close()
+    self.__refresh(fn_ref, *fn_args)
+    return self.__open(fn_ref, *fn_args)
+
+  @traced('cache')
+  def load(self, fn_ref, *fn_args):
+    logging.debug('Loading file cache for %s with %s' % (fn_ref, fn_args))
+    with self.__ensure(fn_ref, *fn_args) as catalog:
+      return catalog.records()
+
+  def __merged_file_name(self, generation):
+    return '%s/merged.%s.catalog' % (self.cachedir,
+                                     hashlib.sha1(generation.encode('utf-8')).hexdigest()[:12])
+
+  def __collect_merged(self, current):
+    now = time.time()
+    for entry in os.listdir(self.cachedir):
+      path = '%s/%s' % (self.cachedir, entry)
+      try:
+        if entry.startswith('merged.') and path != current and \
+            now - os.stat(path).st_mtime > FileCache.MERGED_RETENTION:
+          os.remove(path)
+      except OSError as e:
+        logging.debug('Failed to remove %s: %s' % (path, e))
+
+  # Records of all catalogs, the first catalog holding a name with tags wins. The merge is stored
+  # next to the catalogs and reused until one of them changes
+  @traced('cache')
+  def merged(self, fn_refs, refresh=True):
+    catalogs = []
+    try:
+      # Catalogs opened before a failing refresh are closed as well
+      for fn_ref in fn_refs:
+        catalogs += [self.__ensure(fn_ref) if refresh else self.__open(fn_ref)]
+      generation = json.dumps([[func_ref_name(fn_ref), instance_key(fn_ref.__self__),
+                                catalog.timestamp if catalog else None]
+                               for fn_ref, catalog in zip(fn_refs, catalogs)])
+      file_name = self.__merged_file_name(generation)
+      merged = Catalog.open(file_name)
+      if merged:
+        with merged:
+          if merged.key == generation:
+            logging.debug('Loading merged cache: %s' % file_name)
+            return merged.records()
+
+      logging.debug('Merging caches for %s' % fn_refs)
+      records = {}
+      for catalog in catalogs:
+        for record in catalog.records() if catalog else []:
+          # Images whose tags failed to load do not hide the same name in later catalogs
+          if record.tags:
+            records.setdefault(record.name, record)
+      records = list(records.values())
+      Catalog.write(file_name, key=generation, timestamp=time.time(), records=records)
+      self.__collect_merged(file_name)
+      return records
+    finally:
+      for catalog in catalogs:
+        if catalog:
+          catalog.close()
+
+  def revalidate(self, fn_ref, *fn_args):
+    if not self.is_fresh(fn_ref, *fn_args):
+      logging.debug('Refreshing cache for %s in background...' % fn_ref)
+      self.__refresh_in_background(fn_ref, *fn_args)
+
+  def is_fresh(self, fn_ref, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
+      return False
+    with catalog:
+      return self.__is_valid(catalog)
+
+  def cached(self, fn_ref, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
+      return None
+    with catalog:
+      return catalog.records()
+
+  def timestamp(self, fn_ref, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
+      return None
+    with catalog:
+      return catalog.timestamp
+
+  def find(self, fn_ref, name, *fn_args):
+    catalog = self.__open(fn_ref, *fn_args)
+    if catalog is None:
+      return None
+    with catalog:
+      return catalog.find(name)
+
+
+class MemoryCache(Printable):
+  def __init__(self, cache, ttl=60):
+    self.cache = cache
+    self.ttl = ttl
+    self.__entries = {}
+    self.__lock = threading.Lock()
+
+  @classmethod
+  def __key(cls, fn_ref, *fn_args):
+    return func_ref_name(fn_ref), fn_args, instance_key(fn_ref.__self__)
+
+  def load(self, fn_ref, *fn_args):
+    key = MemoryCache.__key(fn_ref, *fn_args)
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry and time.time() - entry['timestamp'] <= self.ttl:
+        return entry['records']
+    records = self.cache.load(fn_ref, *fn_args)
+    with self.__lock:
+      self.__entries[key] = {
+        'timestamp': time.time(),
+        'records': records,
+        'names': {record.name: record for record in reversed(records)}
       }
-      logging.debug('Writing cache: %s' % cache)
-      with open(file_name, 'wb') as f:
-        f.write(jsonpickle.encode(cache).encode('utf-8'))
-        f.flush()
-    return cache['result']
+    return records
+
+  def merged(self, fn_refs, refresh=True):
+    key = tuple(MemoryCache.__key(fn_ref) for fn_ref in fn_refs), refresh
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry and time.time() - entry['timestamp'] <= self.ttl:
+        return entry['records']
+    records = self.cache.merged(fn_refs, refresh)
+    with self.__lock:
+      self.__entries[key] = {'timestamp': time.time(), 'records': records}
+    return records
+
+  def is_fresh(self, fn_ref, *fn_args):
+    return self.cache.is_fresh(fn_ref, *fn_args)
+
+  def revalidate(self, fn_ref, *fn_args):
+    self.cache.revalidate(fn_ref, *fn_args)
+
+  def cached(self, fn_ref, *fn_args):
+    entry = self.__entries.get(MemoryCache.__key(fn_ref, *fn_args))
+    return entry['records'] if entry else self.cache.cached(fn_ref, *fn_args)
+
+  def timestamp(self, fn_ref, *fn_args):
+    return self.cache.timestamp(fn_ref, *fn_args)
+
+  def find(self, fn_ref, name, *fn_args):
+    entry = self.__entries.get(MemoryCache.__key(fn_ref, *fn_args))
+    return entry['names'].get(name) if entry else self.cache.find(fn_ref, name, *fn_args)
 
 
 class NoCache(Printable):
   def load(self, fn_ref, *fn_args):
     return func_call(fn_ref, *fn_args)
+
+  def merged(self, fn_refs, refresh=True):
+    records = {}
+    for fn_ref in fn_refs if refresh else []:
+      for record in func_call(fn_ref):
+        if record.tags:
+          records.setdefault(record.name, record)
+    return list(records.values())
+
+  def is_fresh(self, fn_ref, *fn_args):
+    return False
+
+  def revalidate(self, fn_ref, *fn_args):
+    pass
+
+  def cached(self, fn_ref, *fn_args):
+    return None
+
+  def timestamp(self, fn_ref, *fn_args):
+    return None
+
+  def find(self, fn_ref, name, *fn_args):
+    return None
+
+
+class RegistryCache(Printable):
+  DEFAULT_TTL = 7 * 24 * 60 * 60
+
+  # Registry kinds and capabilities found by probing, kept in one json file for all repositories
+  def __init__(self, file_name, ttl=DEFAULT_TTL):
+    self.file_name = file_name
+    self.ttl = ttl
+    self.__entries = None
+    self.__lock = threading.Lock()
+
+  def __read(self):
+    try:
+      with open(self.file_name, 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def get(self, repository, stale=False):
+    with self.__lock:
+      if self.__entries is None:
+        self.__entries = self.__read()
+      entry = self.__entries.get(repository)
+    if entry is None or (not stale and time.time() - entry['timestamp'] > self.ttl):
+      return None
+    return entry['capabilities']
+
+  def put(self, repository, capabilities):
+    with self.__lock, FileLock('%s.lock' % self.file_name):
+      # Other processes may have probed other repositories meanwhile
+      self.__entries = self.__read()
+      self.__entries[repository] = {'timestamp': time.time(), 'capabilities': capabilities}
+      with atomic_write(self.file_name) as f:
+        json.dump(self.__entries, f)
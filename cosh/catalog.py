@@ -0,0 +1,118 @@
+import json
+import mmap
+import os
+import struct
+
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.files import atomic_write
+
+
+# Layout, all integers little endian:
+#   header  magic, version, timestamp, key length, record count, names length
+#   key     utf-8 json identifying the repository instance the catalog was built for
+#   index   one (name offset, name length, record offset, record length) entry per record,
+#           sorted by name so a single record can be found by binary search
+#   names   utf-8 record names referenced by the index
+#   records newline separated compact json field lists in the original listing order
+class Catalog:
+  MAGIC = b'COSH'
+  VERSION = 1
+  HEADER = struct.Struct('<4sHdIII')
+  ENTRY = struct.Struct('<IHII')
+
+  def __init__(self, buffer, timestamp, key, count, index_start, names_start, data_start):
+    self.__buffer = buffer
+    self.timestamp = timestamp
+    self.key = key
+    self.count = count
+    self.__index_start = index_start
+    self.__names_start = names_start
+    self.__data_start = data_start
+
+  @classmethod
+  def write(cls, file_name, key, timestamp, records):
+    key_bytes = key.encode('utf-8')
+    encoded = [(record.name.encode('utf-8'),
+                json.dumps(record.fields(), separators=(',', ':')).encode('utf-8'))
+               for record in records]
+
+    entries = []
+    names = bytearray()
+    data = bytearray()
+    for name, fields in encoded:
+      entries += [(name, len(names), len(name), len(data), len(fields))]
+      names += name
+      data += fields + b'\n'
+    entries.sort(key=lambda entry: entry[0])
+
+    # Readers may have the previous file mapped, so it is replaced instead of rewritten
+    with atomic_write(file_name, 'wb') as f:
+      f.write(Catalog.HEADER.pack(Catalog.MAGIC, Catalog.VERSION, timestamp,
+                                  len(key_bytes), len(entries), len(names)))
+      f.write(key_bytes)
+      for entry in entries:
+        f.write(Catalog.ENTRY.pack(*entry[1:]))
+      f.write(names)
+      f.write(data)
+
+  @classmethod
+  def open(cls, file_name):
+    if not os.path.exists(file_name) or os.path.getsize(file_name) < Catalog.HEADER.size:
+      return None
+    with open(file_name, 'rb') as f:
+      buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, timestamp, key_length, count, names_length = \
+      Catalog.HEADER.unpack_from(buffer, 0)
+    if magic != Catalog.MAGIC or version != Catalog.VERSION:
+      buffer.close()
+      return None
+    key_start = Catalog.HEADER.size
+    index_start = key_start + key_length
+    names_start = index_start + count * Catalog.ENTRY.size
+    return Catalog(buffer=buffer,
+                   timestamp=timestamp,
+                   key=buffer[key_start:index_start].decode('utf-8'),
+                   count=count,
+                   index_start=index_start,
+                   names_start=names_start,
+                   data_start=names_start + names_length)
+
+  def __entry(self, position):
+    name_offset, name_length, record_offset, record_length = \
+      Catalog.ENTRY.unpack_from(self.__buffer, self.__index_start + position * Catalog.ENTRY.size)
+    name_start = self.__names_start + name_offset
+    return self.__buffer[name_start:name_start + name_length], record_offset, record_length
+
+  def __record(self, record_offset, record_length):
+    record_start = self.__data_start + record_offset
+    return DockerRepositoryRecord.from_fields(
+        json.loads(self.__buffer[record_start:record_start + record_length].decode('utf-8')))
+
+  def find(self, name):
+    name = name.encode('utf-8')
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      if self.__entry(middle)[0] < name:
+        low = middle + 1
+      else:
+        high = middle
+    if low < self.count:
+      entry_name, record_offset, record_length = self.__entry(low)
+      if entry_name == name:
+        return self.__record(record_offset, record_length)
+    return None
+
+  def records(self):
+    data = self.__buffer[self.__data_start:].decode('utf-8')
+    return [DockerRepositoryRecord.from_fields(json.loads(line))
+            for line in data.split('\n') if line]
+
+  def close(self):
+    self.__buffer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
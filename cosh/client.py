@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import platform
+import re
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+
+
+def socket_path():
+  basedir = ('/tmp' if platform.system() == 'Darwin' else tempfile.gettempdir()).rstrip('/')
+  return os.environ.get('COSH_SOCKET', '%s/cosh/coshd.sock' % basedir)
+
+
+# Variables read while planning, including the ones the docker binary needs to inspect images
+PLANNING_ENV = ['COSH_TRACE', 'DOCKER_CERT_PATH', 'DOCKER_CONFIG', 'DOCKER_CONTEXT', 'DOCKER_HOST',
+                'DOCKER_TLS_VERIFY', 'GOOGLE_APPLICATION_CREDENTIALS', 'HOME', 'PATH',
+                'SSH_AUTH_SOCK', 'TEMP', 'TMP', 'TMPDIR']
+
+
+# Requests carry parts of the environment, so the socket has to be this user's, in a directory
+# no one else can replace it in
+def is_trusted(path):
+  try:
+    socket_stat = os.lstat(path)
+    dir_stat = os.lstat(os.path.dirname(path) or '.')
+  except OSError:
+    return False
+  uid = os.getuid()
+  return stat.S_ISSOCK(socket_stat.st_mode) and socket_stat.st_uid == uid \
+    and stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == uid \
+    and not dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def planning_env(argv):
+  names = set(PLANNING_ENV)
+  # Paths in options may name variables
+  names.update(re.findall(r'\$\{?(\w+)', ' '.join(argv)))
+  # Engine containers get the value of -e NAME from the environment the plan is made in
+  names.update(value for option, value in zip(argv, argv[1:])
+               if option in ('-e', '--env') and '=' not in value)
+  names.update(arg[len('--env='):] for arg in argv
+               if arg.startswith('--env=') and '=' not in arg[len('--env='):])
+  return {name: os.environ[name] for name in names if name in os.environ}
+
+
+def request(argv, path=None):
+  path = path if path else socket_path()
+  if os.environ.get('COSH_NO_DAEMON') or not os.path.exists(path):
+    return None
+  if not is_trusted(path):
+    logging.debug('Ignoring daemon socket %s, it is not owned by this user or its directory is'
+                  ' writable by others' % path)
+    return None
+
+  message = {
+    'argv': argv,
+    'cwd': os.getcwd(),
+    'env': planning_env(argv),
+    'tty': sys.stdin.isatty()
+  }
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.connect(path)
+      s.sendall(json.dumps(message).encode('utf-8') + b'\n')
+      with s.makefile('rb') as f:
+        response = f.readline()
+  except OSError as e:
+    logging.debug('Daemon is not available at %s: %s' % (path, e))
+    return None
+
+  return json.loads(response.decode('utf-8')) if response else None
+
+
+def run_container(config):
+  from cosh.docker.engine import DockerEngineClient, EngineUnavailable
+  engine = DockerEngineClient()
+  if not engine.available():
+    return False
+  try:
+    engine.start(config)
+  except EngineUnavailable as e:
+    logging.debug(e)
+    return False
+  return True
+
+
+def run(argv):
+  response = request(argv)
+  if not response or response.get('fallback'):
+    return False
+
+  if 'error' in response:
+    logging.error(response['error'])
+    return True
+
+  try:
+    if not ('container' in response and run_container(response['container'])):
+      logging.debug('Running command:\n%s' % response['command'])
+      subprocess.call(response['command'], shell=True, close_fds=True, preexec_fn=os.setsid)
+  except KeyboardInterrupt:
+    logging.error('Interrupting...')
+  return True
@@ -0,0 +1,198 @@
+import logging
+import sys
+import time
+
+from cosh.batch import BatchJob, BatchRunner
+from cosh.docker import LaunchPlan
+from cosh.misc import Printable
+from cosh.prefetch import Prefetcher
+from cosh.provisioners import DockerProvisioner, CommandsProvisioner
+from cosh.snapshot import CatalogSnapshot, catalog_key
+from cosh.trace import traced
+from cosh.versions import is_constraint
+
+
+class Cosh(Printable):
+  def __init__(self, docker_client, artifact_store, command_base_dir, env, cache, repositories,
+               lazy=False, commands_mode=CommandsProvisioner.MODE_MOUNTS, history=None):
+    self.docker_client = docker_client
+    self.artifact_store = artifact_store
+    self.command_base_dir = command_base_dir
+    self.env = env
+    self.repositories = repositories
+    self.cache = cache
+    self.lazy = lazy
+    self.commands_mode = commands_mode
+    self.history = history
+
+  @classmethod
+  def __is_command(cls, record):
+    return record and record.tags and not record.name == 'docker'
+
+  # Records in repository precedence order, the first repository holding a name wins
+  def __load_records(self, refresh=True):
+    logging.debug('Fetching repository records for: %s' % self.repositories)
+    return [record for record in self.cache.merged([repository.list
+                                                    for repository in self.repositories],
+                                                   refresh)
+            if Cosh.__is_command(record)]
+
+  def resolve(self, command_name):
+    for repository in self.repositories:
+      if self.cache.is_fresh(repository.list):
+        record = self.cache.find(repository.list, command_name)
+      else:
+        logging.debug('Resolving %s directly from: %s' % (command_name, repository))
+        self.cache.revalidate(repository.list)
+        record = repository.record(command_name)
+      if Cosh.__is_command(record):
+        return record
+    return None
+
+  def __resolve_command(self, command_str):
+    command_name = command_str.split(':', 1)[0]
+
+    command_record = None
+    if self.lazy:
+      command_record = self.resolve(command_name)
+      # Shims are provisioned from whatever catalog is already cached,
+      # the full catalog is refreshed in background
+      records = [record for record in self.__load_records(refresh=False)
+                 if record.name != command_name]
+      if command_record:
+        records += [command_record]
+    else:
+      records = self.__load_records()
+      command_record = {record.name: record for record in records}.get(command_name)
+
+    logging.debug('Repository records: %s' % records)
+
+    return records, Cosh.__image(command_record, command_str)
+
+  @classmethod
+  def __image(cls, command_record, command_str):
+    maybe_versioned_command = command_str.split(':', 1)
+
+    version = None
+    if len(maybe_versioned_command) > 1:
+      version = maybe_versioned_command[1]
+      if command_record and is_constraint(version):
+        # Constraints like ^3.5, 8-* or >=10 <12 resolve to the best matching tag
+        version = command_record.version_index().resolve(maybe_versioned_command[1])
+        if not version:
+          raise Exception('No %s version matches %s'
+                          % (maybe_versioned_command[0], maybe_versioned_command[1]))
+        logging.debug('Resolved %s to %s' % (command_str, version))
+    elif command_record:
+      version = command_record.tags[0]
+
+    if not (command_record and version):
+      raise Exception('%s command not found' % command_str)
+
+    return '%s:%s' % (command_record.image_name, version)
+
+  def image(self, command_str):
+    return self.__resolve_command(command_str)[1]
+
+  def __launch_plan(self, records):
+    logging.debug("Provisioning...")
+    extra_mounts = DockerProvisioner(self.artifact_store).provision()
+
+    # Environment and mounts are computed once and shared by every command
+    plan = LaunchPlan.create(docker_client=self.docker_client,
+                             env=self.env,
+                             extra_mounts=extra_mounts)
+
+    commands_mounts = CommandsProvisioner(plan=plan,
+                                          records=records,
+                                          base_dir=self.command_base_dir,
+                                          mode=self.commands_mode) \
+      .provision()
+
+    return plan.with_commands(**commands_mounts)
+
+  @traced('cosh')
+  def plan(self, command_str, args):
+    records, image = self.__resolve_command(command_str)
+    logging.debug('Executing command %s with arguments %s' % (command_str, args))
+    if self.history:
+      self.history.record(image)
+
+    return self.__launch_plan(records) \
+      .with_command(image=image,
+                    arguments=args,
+                    tty=sys.stdin.isatty())
+
+  def run(self, command_str, args):
+    return self.plan(command_str, args).run()
+
+  def prefetch(self, command_strs=[], top=Prefetcher.DEFAULT_TOP,
+               concurrency=Prefetcher.DEFAULT_CONCURRENCY):
+    images = []
+    for command_str in command_strs:
+      try:
+        images += [self.image(command_str)]
+      except Exception as e:
+        logging.warning(e)
+    if not command_strs and self.history:
+      images = self.history.top(top)
+      logging.debug('Most used images: %s' % images)
+
+    results = Prefetcher(self.docker_client, concurrency).prefetch(images)
+    Prefetcher.report(results)
+    return results
+
+  # Jobs are (command, arguments) pairs. The catalog is loaded and commands are provisioned
+  # once for all of them
+  @traced('cosh')
+  def batch(self, jobs, concurrency=BatchRunner.DEFAULT_CONCURRENCY, keep_going=False,
+            output=BatchRunner.OUTPUT_PREFIX):
+    records = self.__load_records()
+    command_records = {record.name: record for record in records}
+    plan = self.__launch_plan(records)
+    # Warm containers are entered with docker exec
+    fn_command = getattr(self.docker_client, 'exec_command', None)
+
+    batch_jobs = []
+    for number, (command_str, args) in enumerate(jobs, 1):
+      job = BatchJob(number, command_str, args)
+      try:
+        image = Cosh.__image(command_records.get(command_str.split(':', 1)[0]), command_str)
+        job_plan = plan.with_command(image=image, arguments=args)
+        job.command = fn_command(image, args, **job_plan.kwargs()) if fn_command \
+          else job_plan.command()
+        if self.history:
+          self.history.record(image)
+      except Exception as e:
+        job.error = str(e)
+      batch_jobs += [job]
+
+    try:
+      return BatchRunner(concurrency, keep_going, output).run(batch_jobs)
+    finally:
+      if fn_command:
+        self.docker_client.reap()
+
+  def export_catalog(self, file_name):
+    catalogs = []
+    for repository in self.repositories:
+      records = self.cache.load(repository.list)
+      catalogs += [{'key': catalog_key(repository.list),
+                    'timestamp': self.cache.timestamp(repository.list) or time.time(),
+                    'records': records}]
+    CatalogSnapshot(catalogs).write(file_name)
+    logging.info('Exported %d records of %d repositories to %s'
+                 % (sum(len(catalog['records']) for catalog in catalogs), len(catalogs), file_name))
+
+  # Imported catalogs keep their age, so they expire like the catalogs they were exported from
+  def import_catalog(self, file_name):
+    snapshot = CatalogSnapshot.read(file_name)
+    for repository in self.repositories:
+      catalog = snapshot.find(repository.list)
+      if catalog is None:
+        logging.warning('%s/%s is not in catalog snapshot %s'
+                        % (repository.name, repository.namespace, file_name))
+        continue
+      self.cache.store(repository.list, catalog['records'], timestamp=catalog['timestamp'])
+      logging.info('Imported %d records of %s/%s'
+                   % (len(catalog['records']), repository.name, repository.namespace))
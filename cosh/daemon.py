@@ -0,0 +1,122 @@
+import argparse
+import json
+import logging
+import os
+import socketserver
+
+from cosh import args as cosh_args
+from cosh.cache import MemoryCache
+from cosh.client import is_trusted, socket_path
+from cosh.misc import Printable
+
+
+class CoshDaemon(Printable):
+  def __init__(self, socket_path, memory_ttl=60):
+    self.socket_path = socket_path
+    self.memory_ttl = memory_ttl
+    self.__caches = {}
+    self.__http_sessions = {}
+    self.__repositories = {}
+
+  def __cache(self, args):
+    key = (args.cache, args.tmpdir, args.cache_dir, args.cache_ttl, args.cache_max_stale,
+           args.catalog_snapshot)
+    if key not in self.__caches:
+      self.__caches[key] = MemoryCache(cosh_args.create_cache(args), ttl=self.memory_ttl)
+    return self.__caches[key]
+
+  def __http_session(self, args):
+    key = (args.fetch_concurrency, args.http_pool_size, args.http_timeout, args.http_retries)
+    if key not in self.__http_sessions:
+      self.__http_sessions[key] = cosh_args.create_http(args)
+    return self.__http_sessions[key]
+
+  # Repository clients hold the pooled http session and the GCR credentials
+  def __repository_list(self, args):
+    key = (tuple(args.repositories), args.gcr_key_file, args.tmpdir, args.cache, args.cache_dir,
+           args.registry_ttl, args.catalog_mirror, args.fetch_concurrency, args.http_pool_size,
+           args.http_timeout, args.http_retries)
+    if key not in self.__repositories:
+      self.__repositories[key] = cosh_args.create_repositories(args, self.__http_session(args))
+    return self.__repositories[key]
+
+  def plan(self, request):
+    args = cosh_args.parse(request['argv'])
+    if args.batch or args.command in ('prefetch', 'catalog', 'serve-catalog'):
+      # Batches, pulls, snapshots and mirrors run in the client, there is nothing to plan
+      return {'fallback': True}
+    instance = cosh_args.create_cosh(args, self.__cache(args), self.__repository_list(args),
+                                     self.__http_session(args))
+    plan = instance.plan(args.command, args.arguments)
+    plan.tty = request['tty']
+    if args.reuse_containers:
+      return {'command': plan.docker_client.exec_command(plan.image, plan.arguments,
+                                                         **plan.kwargs())}
+    response = {'command': plan.command()}
+    if args.docker_client == 'engine':
+      # The client creates the container itself, the command is its fallback
+      response['container'] = plan.docker_client.config(plan.image, plan.arguments, **plan.kwargs())
+    return response
+
+  def handle(self, request):
+    # Requests are served one at a time, so the client's cwd and environment can be borrowed
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+      os.chdir(request['cwd'])
+      os.environ.clear()
+      os.environ.update(request['env'])
+      return self.plan(request)
+    except SystemExit:
+      # Usage errors and --help are left to the in-process path
+      return {'fallback': True}
+    except Exception as e:
+      logging.debug('Failed to plan %s: %s' % (request['argv'], e))
+      return {'error': str(e)}
+    finally:
+      os.chdir(cwd)
+      os.environ.clear()
+      os.environ.update(environ)
+
+  def serve(self):
+    daemon = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        self.wfile.write(json.dumps(daemon.handle(request)).encode('utf-8') + b'\n')
+
+    socket_dir = os.path.dirname(self.socket_path)
+    if not os.path.exists(socket_dir):
+      os.makedirs(socket_dir, 0o755)
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+    server = socketserver.UnixStreamServer(self.socket_path, Handler)
+    # Requests carry the client environment
+    os.chmod(self.socket_path, 0o600)
+    if not is_trusted(self.socket_path):
+      logging.warning('%s is writable by other users, clients will not use this daemon' % socket_dir)
+    logging.info('Listening on %s' % self.socket_path)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      logging.info('Shutting down...')
+    finally:
+      server.server_close()
+      os.remove(self.socket_path)
+
+
+def get():
+  parser = argparse.ArgumentParser(description='Container shell daemon', prog='coshd')
+  parser.add_argument('--socket', default=socket_path(), type=str,
+                      help='Unix socket path to listen on. Clients use COSH_SOCKET to find it')
+  parser.add_argument('--memory-ttl', default=60, type=int,
+                      help='Seconds repository records are kept in memory before the file cache'
+                           ' is consulted again')
+  parser.add_argument('--debug', dest='debug', action='store_true', help='Turn on debug logging')
+  parser.set_defaults(debug=False)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+  CoshDaemon(socket_path=args.socket, memory_ttl=args.memory_ttl).serve()
@@ -4,6 +4,7 @@ import stat
 import subprocess
 
 from cosh.misc import Printable
+from cosh.trace import traced
 
 
 class DockerMount(Printable):
@@ -14,30 +15,67 @@ class DockerMount(Printable):
 
 
 class DockerTerminalClient(Printable):
+  DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+  ENV_FORMAT = '{{range .Config.Env}}{{println .}}{{end}}'
 
   def __init__(self, docker_binary='docker'):
     self.docker_binary = docker_binary
 
-  def run_command(self, image, arguments, **kwargs):
+  def run_options(self, **kwargs):
     volume_mounts = ' '.join('%s-v %s:%s'
                              % ('--read-only '
                                 if mount.readonly else '', mount.source, mount.target)
                              for mount in kwargs['mounts']) if 'mounts' in kwargs else ''
     envs = ' '.join('-e %s' % env for env in kwargs['environment']) \
       if 'environment' in kwargs else ''
+    return '%s%s%s' % (
+      ' %s' % envs if envs else '',
+      ' %s' % volume_mounts if volume_mounts else '',
+      (' -w %s' % kwargs['working_dir']) if 'working_dir' in kwargs else '')
+
+  # Pre-rendered environment, mounts and working dir can be passed as options
+  def run_command(self, image, arguments, **kwargs):
     attachments = ' '.join('-a %s' % a for a in kwargs['attach']) if 'attach' in kwargs else ''
-    return '%s run --net=host -i%s%s%s%s%s%s%s %s %s' % (
+    return '%s run --net=host -i%s%s%s%s%s %s %s' % (
       self.docker_binary,
       ' %s' % attachments if attachments else '',
       ' -t' if 'tty' in kwargs and kwargs['tty'] else '',
       ' --rm' if 'auto_remove' in kwargs and kwargs['auto_remove'] else '',
-      ' %s' % envs if envs else '',
-      ' %s' % volume_mounts if volume_mounts else '',
-      (' -w %s' % kwargs['working_dir']) if 'working_dir' in kwargs else '',
+      kwargs['options'] if 'options' in kwargs else self.run_options(**kwargs),
       ' %s' % kwargs['custom'] if 'custom' in kwargs else '',
       image,
       ' '.join(arguments))
 
+  def image_exists(self, image):
+    return subprocess.call('%s image inspect %s' % (self.docker_binary, image), shell=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+  def pull(self, image):
+    subprocess.check_call('%s pull %s' % (self.docker_binary, image), shell=True,
+                          stdout=subprocess.DEVNULL)
+    # The cli does not report transferred bytes, the pulled image size is the closest estimate
+    size = subprocess.check_output('%s image inspect --format "{{.Size}}" %s'
+                                   % (self.docker_binary, image), shell=True)
+    return int(size.strip() or 0)
+
+  @classmethod
+  def path(cls, environment):
+    # Images without a PATH get the one docker sets
+    return next((env[len('PATH='):] for env in environment if env.startswith('PATH=')),
+                DockerTerminalClient.DEFAULT_PATH)
+
+  # The PATH containers of the image start with, the image is pulled when it is missing
+  def image_path(self, image):
+    inspect = '%s image inspect -f "%s" %s' % (self.docker_binary, DockerTerminalClient.ENV_FORMAT,
+                                               image)
+    try:
+      output = subprocess.check_output(inspect, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+      self.pull(image)
+      output = subprocess.check_output(inspect, shell=True)
+    return DockerTerminalClient.path(output.decode('utf-8').splitlines())
+
+  @traced('docker')
   def run(self, image, arguments, **kwargs):
     cmd = self.run_command(image, arguments, **kwargs)
     logging.debug('Running command:\n%s' % cmd)
@@ -48,6 +86,7 @@ class DockerEnvironment(Printable):
   FS_ROOT = '/'
   CONTAINER_HOME = '/container_user_home'
   DOCKER_SOCK = '/var/run/docker.sock'
+  COMMANDS_DIR = '/cosh/bin'
 
   def __init__(self, tmpdir_base, home, extra_volumes, extra_envs):
     self.extra_envs = extra_envs
@@ -69,18 +108,17 @@ class DockerEnvironment(Printable):
       target = destination if destination else ('/mount/%s' % name)
     return [DockerMount(source=source, target=target)]
 
-  def mounts(self, placed_records, extra_mounts={}):
-    __extra_mounts = {}
-    __extra_mounts.update(extra_mounts)
-    __extra_mounts.update(self.extra_volumes)
-
-    logging.debug('Extra mounts: %s' % __extra_mounts)
+  def mounts(self, placed_records=[], extra_mounts={}):
+    return [self.workdir_mount()] \
+           + self.system_mounts() \
+           + DockerEnvironment.commands_mounts(placed_records) \
+           + self.user_mounts(extra_mounts)
 
+  def system_mounts(self):
     pwd = os.getcwd()
     dev = '/dev'
-    ssh_auth_sock = os.environ.get('SSH_AUTH_SOCK')
 
-    mounts = [DockerMount(source=pwd, target=self.workdir())]
+    mounts = []
     if not (pwd == self.tmpdir_base or '$(pwd)' == self.tmpdir_base):
       mounts += DockerEnvironment.__root_mount(self.tmpdir_base, 'tmp')
     if not (pwd == self.home or '$(pwd)' == self.home):
@@ -93,18 +131,38 @@ class DockerEnvironment(Printable):
       mounts += DockerEnvironment.__root_mount(DockerEnvironment.DOCKER_SOCK, 'docker.sock')
 
     mounts += DockerEnvironment.__root_mount(dev, 'dev')
+    return mounts
+
+  @classmethod
+  def commands_mounts(cls, placed_records=[], commands_dir=None):
+    mounts = [DockerMount(source=commands_dir, target=DockerEnvironment.COMMANDS_DIR,
+                          readonly=True)] if commands_dir else []
     mounts += [
       DockerMount(source=placed_record['path'],
                   target=('/sbin/%s' % placed_record['record'].name),
                   readonly=True)
       for placed_record in placed_records
     ]
-    mounts += [DockerMount(source=source, target=target)
-               for source, target in __extra_mounts.items()]
+    return mounts
+
+  def user_mounts(self, extra_mounts={}):
+    __extra_mounts = {}
+    __extra_mounts.update(extra_mounts)
+    __extra_mounts.update(self.extra_volumes)
+
+    logging.debug('Extra mounts: %s' % __extra_mounts)
+
+    ssh_auth_sock = os.environ.get('SSH_AUTH_SOCK')
+
+    mounts = [DockerMount(source=source, target=target)
+              for source, target in __extra_mounts.items()]
     if ssh_auth_sock:
       mounts += [DockerMount(source=ssh_auth_sock, target=ssh_auth_sock)]
     return mounts
 
+  def workdir_mount(self):
+    return DockerMount(source=os.getcwd(), target=self.workdir())
+
   def workdir(self):
     pwd = os.getcwd()
     return '/mount/root' if pwd == DockerEnvironment.FS_ROOT else pwd
@@ -141,10 +199,122 @@ class DockerEnvironment(Printable):
         merged_envs += [os.path.expandvars(env)]
 
     logging.debug('Merged envs: %s' % merged_envs)
-    distinct_envs = list(set(merged_envs))
+    # Order preserving, so that rendered commands are stable across invocations
+    distinct_envs = list(dict.fromkeys(merged_envs))
     logging.debug('Distinct envs: %s' % distinct_envs)
     return distinct_envs
 
   @classmethod
   def create(cls):
     return DockerEnvironment()
+
+
+class LaunchPlan(Printable):
+  # The working dir is handed down to the containers started by commands, see relocatable
+  PWD_ENV = 'COSH_PWD'
+  WORKDIR_ENV = 'COSH_WORKDIR'
+
+  def __init__(self, docker_client, environment, working_dir, workdir_mount, system_mounts,
+               user_mounts,
+               commands_mounts=[], commands_dir=None, commands_on_path=False, image=None,
+               arguments=[], tty=False):
+    self.docker_client = docker_client
+    self.environment = environment
+    self.working_dir = working_dir
+    self.workdir_mount = workdir_mount
+    self.system_mounts = system_mounts
+    self.user_mounts = user_mounts
+    self.commands_mounts = commands_mounts
+    self.commands_dir = commands_dir
+    self.commands_on_path = commands_on_path
+    self.mounts = [workdir_mount] + system_mounts + commands_mounts + user_mounts
+    self.image = image
+    self.arguments = arguments
+    self.tty = tty
+    self.__options = None
+    self.__path = None
+
+  @classmethod
+  def create(cls, docker_client, env, extra_mounts={}):
+    return LaunchPlan(docker_client=docker_client,
+                      environment=env.environment(),
+                      working_dir=env.workdir(),
+                      workdir_mount=env.workdir_mount(),
+                      system_mounts=env.system_mounts(),
+                      user_mounts=env.user_mounts(extra_mounts))
+
+  def __copy(self, **changes):
+    fields = {
+      'docker_client': self.docker_client,
+      'environment': self.environment,
+      'working_dir': self.working_dir,
+      'workdir_mount': self.workdir_mount,
+      'system_mounts': self.system_mounts,
+      'user_mounts': self.user_mounts,
+      'commands_mounts': self.commands_mounts,
+      'commands_dir': self.commands_dir,
+      'commands_on_path': self.commands_on_path,
+      'image': self.image,
+      'arguments': self.arguments,
+      'tty': self.tty
+    }
+    fields.update(changes)
+    return LaunchPlan(**fields)
+
+  # Takes the working dir from the environment at run time, so that commands rendered from it
+  # do not depend on the directory they were rendered in
+  def relocatable(self):
+    working_dir = '"${%s}"' % LaunchPlan.WORKDIR_ENV
+    return self.__copy(working_dir=working_dir,
+                       workdir_mount=DockerMount(source='"${%s}"' % LaunchPlan.PWD_ENV,
+                                                 target=working_dir))
+
+  def with_commands(self, placed_records=[], commands_dir=None, commands_on_path=False):
+    return self.__copy(commands_mounts=DockerEnvironment.commands_mounts(placed_records,
+                                                                         commands_dir),
+                       commands_dir=commands_dir,
+                       commands_on_path=commands_on_path)
+
+  def with_command(self, image, arguments, tty=False):
+    plan = self.__copy(image=image, arguments=arguments, tty=tty)
+    plan.__options = self.__options
+    return plan
+
+  def __environment(self):
+    return self.environment + ['%s=%s' % (LaunchPlan.PWD_ENV, self.workdir_mount.source),
+                               '%s=%s' % (LaunchPlan.WORKDIR_ENV, self.working_dir)]
+
+  def options(self):
+    if self.__options is None:
+      self.__options = self.docker_client.run_options(environment=self.__environment(),
+                                                      mounts=self.mounts,
+                                                      working_dir=self.working_dir)
+    return self.__options
+
+  # A mounted commands dir goes first on the PATH of the image
+  def __path_environment(self):
+    if not (self.commands_on_path and self.image):
+      return []
+    if self.__path is None:
+      self.__path = self.docker_client.image_path(self.image)
+    return ['PATH=%s:%s' % (DockerEnvironment.COMMANDS_DIR, self.__path)]
+
+  def kwargs(self, **kwargs):
+    path_environment = self.__path_environment()
+    kwargs.setdefault('tty', self.tty)
+    kwargs.update({
+      'auto_remove': True,
+      'environment': self.__environment() + path_environment,
+      'mounts': self.mounts,
+      'working_dir': self.working_dir,
+      'options': self.options() + self.docker_client.run_options(environment=path_environment)
+    })
+    return kwargs
+
+  def command(self, image=None, arguments=None, **kwargs):
+    return self.docker_client.run_command(image if image else self.image,
+                                          arguments if arguments is not None else self.arguments,
+                                          **self.kwargs(**kwargs))
+
+  def run(self):
+    return self.docker_client.run(self.image, self.arguments, **self.kwargs())
@@ -0,0 +1,305 @@
+import http.client
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+from urllib.parse import urlencode
+
+from cosh.docker import DockerEnvironment, DockerTerminalClient
+from cosh.misc import Printable
+from cosh.trace import traced
+
+
+class EngineError(Exception):
+  def __init__(self, message, status=None):
+    super().__init__(message)
+    self.status = status
+
+
+class EngineUnavailable(EngineError):
+  pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, socket_path, timeout=None):
+    super().__init__('localhost', timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
+
+
+def write_all(fd, data):
+  while data:
+    data = data[os.write(fd, data):]
+
+
+class DockerEngineClient(Printable):
+  API_VERSION = 'v1.25'
+  FRAME_HEADER = '>BxxxI'
+  STREAMS = {0: 1, 1: 1, 2: 2}
+  BUFFER_SIZE = 65536
+
+  def __init__(self, docker_binary='docker', socket_path=None):
+    self.docker_binary = docker_binary
+    self.socket_path = socket_path if socket_path else DockerEngineClient.default_socket()
+    # Rendered commands, i.e. the shims, are still executed by the docker binary
+    self.fallback = DockerTerminalClient(docker_binary)
+
+  @classmethod
+  def default_socket(cls):
+    docker_host = os.getenv('DOCKER_HOST')
+    if not docker_host:
+      return DockerEnvironment.DOCKER_SOCK
+    return docker_host[len('unix://'):] if docker_host.startswith('unix://') else None
+
+  def available(self):
+    return bool(self.socket_path) and os.path.exists(self.socket_path)
+
+  def run_options(self, **kwargs):
+    return self.fallback.run_options(**kwargs)
+
+  def run_command(self, image, arguments, **kwargs):
+    return self.fallback.run_command(image, arguments, **kwargs)
+
+  def __url(self, path, query=None):
+    return '/%s%s%s' % (DockerEngineClient.API_VERSION, path,
+                        ('?%s' % urlencode(query)) if query else '')
+
+  def __request(self, method, path, query=None, body=None):
+    connection = UnixHTTPConnection(self.socket_path)
+    try:
+      connection.request(method, self.__url(path, query),
+                         body=json.dumps(body) if body is not None else None,
+                         headers={'Content-Type': 'application/json'} if body is not None else {})
+      response = connection.getresponse()
+      content = response.read()
+    finally:
+      connection.close()
+
+    if response.status >= 400:
+      message = content.decode('utf-8', 'replace')
+      try:
+        message = json.loads(message).get('message', message)
+      except ValueError:
+        pass
+      raise EngineError('%s %s failed: %s' % (method, path, message), response.status)
+    return content
+
+  def __json(self, method, path, query=None, body=None):
+    content = self.__request(method, path, query, body)
+    return json.loads(content.decode('utf-8')) if content else None
+
+  def image_exists(self, image):
+    if not self.available():
+      return self.fallback.image_exists(image)
+    try:
+      self.__request('GET', '/images/%s/json' % image)
+      return True
+    except EngineError as e:
+      if e.status == 404:
+        return False
+      raise
+
+  def image_path(self, image):
+    if not self.available():
+      return self.fallback.image_path(image)
+    if not self.image_exists(image):
+      self.pull(image)
+    config = self.__json('GET', '/images/%s/json' % image)['Config']
+    return DockerTerminalClient.path(config.get('Env') or [])
+
+  # Returns the number of downloaded bytes
+  def pull(self, image):
+    if not self.available():
+      return self.fallback.pull(image)
+    name, tag = image.rsplit(':', 1) if ':' in image.split('/')[-1] else (image, 'latest')
+    logging.debug('Pulling %s...' % image)
+    layers = {}
+    # Progress is streamed as json lines, failures included
+    for line in self.__request('POST', '/images/create',
+                               query={'fromImage': name, 'tag': tag}).splitlines():
+      progress = json.loads(line.decode('utf-8')) if line.strip() else {}
+      if 'error' in progress:
+        raise EngineError('Failed to pull %s: %s' % (image, progress['error']))
+      if progress.get('status') == 'Downloading':
+        layers[progress.get('id')] = progress.get('progressDetail', {}).get('total', 0)
+    return sum(layers.values())
+
+  @classmethod
+  def __environment(cls, environment):
+    envs = []
+    for env in environment:
+      if '=' in env:
+        envs += [env]
+      elif env in os.environ:
+        # Just like docker run -e NAME, the host value is passed through
+        envs += ['%s=%s' % (env, os.environ[env])]
+    return envs
+
+  def config(self, image, arguments, **kwargs):
+    return {
+      'Image': image,
+      'Cmd': list(arguments) if arguments else None,
+      'Env': DockerEngineClient.__environment(kwargs.get('environment', [])),
+      'WorkingDir': kwargs.get('working_dir', ''),
+      'Tty': bool(kwargs.get('tty')),
+      'OpenStdin': True,
+      'StdinOnce': True,
+      'AttachStdin': True,
+      'AttachStdout': True,
+      'AttachStderr': True,
+      'HostConfig': {
+        'NetworkMode': 'host',
+        'Binds': ['%s:%s%s' % (mount.source, mount.target, ':ro' if mount.readonly else '')
+                  for mount in kwargs.get('mounts', [])]
+      }
+    }
+
+  def __create(self, config):
+    try:
+      try:
+        return self.__json('POST', '/containers/create', body=config)['Id']
+      except EngineError as e:
+        if not e.status == 404:
+          raise
+      logging.info('Pulling %s...' % config['Image'])
+      self.pull(config['Image'])
+      return self.__json('POST', '/containers/create', body=config)['Id']
+    except (OSError, http.client.HTTPException) as e:
+      raise EngineUnavailable('Docker engine is not reachable at %s: %s' % (self.socket_path, e))
+
+  def __attach(self, container_id):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(self.socket_path)
+    sock.sendall(('POST %s HTTP/1.1\r\n'
+                  'Host: localhost\r\n'
+                  'Connection: Upgrade\r\n'
+                  'Upgrade: tcp\r\n'
+                  '\r\n' % self.__url('/containers/%s/attach' % container_id,
+                                      {'stream': 1, 'stdin': 1, 'stdout': 1, 'stderr': 1}))
+                 .encode('utf-8'))
+
+    response = b''
+    while b'\r\n\r\n' not in response:
+      chunk = sock.recv(DockerEngineClient.BUFFER_SIZE)
+      if not chunk:
+        sock.close()
+        raise EngineError('Attaching to %s was interrupted' % container_id)
+      response += chunk
+    head, rest = response.split(b'\r\n\r\n', 1)
+    status = int(head.split(b' ', 2)[1])
+    if status not in (101, 200):
+      sock.close()
+      raise EngineError('Attaching to %s failed with %d' % (container_id, status), status)
+    # The connection is hijacked, whatever follows the headers is container output
+    return sock, rest
+
+  @classmethod
+  def __pump_stdin(cls, sock, done):
+    try:
+      while not done.is_set():
+        if not select.select([0], [], [], 0.1)[0]:
+          continue
+        data = os.read(0, DockerEngineClient.BUFFER_SIZE)
+        if not data:
+          break
+        sock.sendall(data)
+    except OSError as e:
+      logging.debug('Stopped forwarding stdin: %s' % e)
+    try:
+      # Lets the container see the end of its input
+      sock.shutdown(socket.SHUT_WR)
+    except OSError:
+      pass
+
+  @classmethod
+  def __pump_output(cls, sock, buffered, tty):
+    if tty:
+      write_all(1, buffered)
+      for data in iter(lambda: sock.recv(DockerEngineClient.BUFFER_SIZE), b''):
+        write_all(1, data)
+      return
+
+    # Without a tty stdout and stderr are multiplexed into frames
+    header_size = struct.calcsize(DockerEngineClient.FRAME_HEADER)
+    data = buffered
+    while True:
+      while len(data) >= header_size:
+        stream, size = struct.unpack(DockerEngineClient.FRAME_HEADER, data[:header_size])
+        if len(data) < header_size + size:
+          break
+        write_all(DockerEngineClient.STREAMS.get(stream, 1), data[header_size:header_size + size])
+        data = data[header_size + size:]
+      chunk = sock.recv(DockerEngineClient.BUFFER_SIZE)
+      if not chunk:
+        return
+      data += chunk
+
+  def __resize(self, container_id):
+    try:
+      size = os.get_terminal_size(1)
+      self.__request('POST', '/containers/%s/resize' % container_id,
+                     query={'h': size.lines, 'w': size.columns})
+    except (OSError, EngineError) as e:
+      logging.debug('Failed to resize %s: %s' % (container_id, e))
+
+  def __stream(self, container_id, tty):
+    sock, buffered = self.__attach(container_id)
+    done = threading.Event()
+    terminal = None
+    try:
+      self.__request('POST', '/containers/%s/start' % container_id)
+      if tty and sys.stdin.isatty():
+        import termios
+        import tty as tty_mode
+        terminal = termios.tcgetattr(0)
+        tty_mode.setraw(0)
+        self.__resize(container_id)
+      threading.Thread(target=DockerEngineClient.__pump_stdin, args=(sock, done),
+                       daemon=True).start()
+      DockerEngineClient.__pump_output(sock, buffered, tty)
+    finally:
+      done.set()
+      if terminal:
+        import termios
+        termios.tcsetattr(0, termios.TCSADRAIN, terminal)
+      sock.close()
+
+  # Runs a container from a create config, returns its exit status
+  def start(self, config, auto_remove=True):
+    container_id = self.__create(config)
+    logging.debug('Created container %s for %s' % (container_id, config['Image']))
+    try:
+      self.__stream(container_id, config['Tty'])
+      return self.__json('POST', '/containers/%s/wait' % container_id)['StatusCode']
+    except KeyboardInterrupt:
+      try:
+        self.__request('POST', '/containers/%s/kill' % container_id)
+      except EngineError as e:
+        logging.debug('Failed to kill container %s: %s' % (container_id, e))
+      raise
+    finally:
+      if auto_remove:
+        try:
+          self.__request('DELETE', '/containers/%s' % container_id, query={'force': 1})
+        except EngineError as e:
+          logging.debug('Failed to remove container %s: %s' % (container_id, e))
+
+  @traced('docker')
+  def run(self, image, arguments, **kwargs):
+    # Raw cli options can not be translated into an api call
+    if self.available() and 'custom' not in kwargs and 'attach' not in kwargs:
+      try:
+        return self.start(self.config(image, arguments, **kwargs),
+                          auto_remove=bool(kwargs.get('auto_remove')))
+      except EngineUnavailable as e:
+        logging.debug(e)
+    logging.debug('Falling back to %s' % self.docker_binary)
+    return self.fallback.run(image, arguments, **kwargs)
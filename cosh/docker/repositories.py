@@ -1,24 +1,96 @@
+import calendar
 import logging
 import re
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-import google.auth
-import google.auth.transport.requests
-import requests
-from google.oauth2 import service_account
-from natsort import natsorted
-
+from cosh.docker.tokens import TokenCache, credentials_identity
 from cosh.misc import Printable
+from cosh.session import HttpSession
+from cosh.trace import traced
+from cosh.versions import VersionIndex
+
+
+# natsort, requests and google.auth are imported on first use only, so that resolving a command
+# from a warm cache does not pay for them
+
+
+def natsorted(tags, reverse=False):
+  from natsort import natsorted as _natsorted
+  return _natsorted(tags, reverse=reverse)
+
+
+class NotFound(Exception):
+  pass
+
+
+class NotModified(Exception):
+  pass
+
 
+def get_validated_json(http, url, validators=None, **kwargs):
+  headers = dict(kwargs.pop('headers', {}))
+  if validators and validators.get('ETag'):
+    headers['If-None-Match'] = validators['ETag']
+  if validators and validators.get('Last-Modified'):
+    headers['If-Modified-Since'] = validators['Last-Modified']
+  response = http.get(url, headers=headers, **kwargs)
+  if response.status_code == 304:
+    raise NotModified('%s not modified' % url)
+  if response.status_code == 404:
+    raise NotFound('%s not found' % url)
+  response.raise_for_status()
+  return response.json(), {key: response.headers[key] for key in ('ETag', 'Last-Modified')
+                           if key in response.headers}
 
-class DockerRepositoryRecord(Printable):
 
-  def __init__(self, repository, namespace, name, tags=['latest']):
+def get_json(http, url, **kwargs):
+  return get_validated_json(http, url, **kwargs)[0]
+
+
+def refresh_record(previous, last_updated, fn_fetch):
+  if previous and last_updated and previous.last_updated == last_updated:
+    return previous
+  try:
+    return fn_fetch(previous.validators if previous else None)
+  except NotModified:
+    if last_updated:
+      previous.last_updated = last_updated
+    return previous
+
+
+class DockerRepositoryRecord:
+  __slots__ = ('repository', 'namespace', 'name', 'tags', 'last_updated', 'validators',
+               'image_name', 'versions')
+
+  def __init__(self, repository, namespace, name, tags=['latest'], last_updated=None,
+               validators=None, versions=None):
     self.tags = tags
     self.name = name
     self.repository = repository
     self.namespace = namespace
+    self.last_updated = last_updated
+    self.validators = validators
     self.image_name = ('%s/%s/%s' % (repository if repository else '', namespace, name)).lstrip('/')
+    self.versions = VersionIndex.from_fields(tags, versions) if versions else None
+
+  @classmethod
+  def from_fields(cls, fields):
+    return DockerRepositoryRecord(*fields)
+
+  # Built once when the record is cached, lookups never sort
+  def version_index(self):
+    if not self.versions or self.versions.tags is not self.tags:
+      self.versions = VersionIndex.build(self.tags)
+    return self.versions
+
+  def fields(self):
+    return [self.repository, self.namespace, self.name, self.tags, self.last_updated,
+            self.validators, self.version_index().fields()]
+
+  def __repr__(self):
+    return str(self.__class__) + ": " + str({slot: getattr(self, slot) for slot in self.__slots__})
 
   def __eq__(self, other):
     return isinstance(other, self.__class__) and ((self.name) == (other.name))
@@ -42,10 +114,51 @@ class DockerRepositoryRecord(Printable):
     return hash(self.name)
 
 
+# Records of a crawl, with the names of the images whose tags could not be fetched
+class FetchedRecords(list):
+  def __init__(self, records, failed=None):
+    super().__init__(records)
+    self.failed = failed if failed else []
+
+
+class TagFetcher(Printable):
+  DEFAULT_CONCURRENCY = 8
+
+  def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+    self.concurrency = concurrency
+
+  @classmethod
+  def __safe_call(cls, fn, image_name):
+    try:
+      return fn(image_name)
+    except Exception as e:
+      # A single broken image must not take the whole catalog down
+      logging.warning('Failed to fetch tags for %s: %s' % (image_name, e))
+      return None
+
+  def map(self, fn, image_names):
+    if self.concurrency <= 1 or len(image_names) <= 1:
+      return [TagFetcher.__safe_call(fn, image_name) for image_name in image_names]
+    with ThreadPoolExecutor(max_workers=min(self.concurrency, len(image_names))) as executor:
+      return list(executor.map(lambda image_name: TagFetcher.__safe_call(fn, image_name),
+                               image_names))
+
+  def records(self, fn_record, image_names, fallback):
+    fetched = list(zip(image_names, self.map(fn_record, image_names)))
+    return FetchedRecords([record if record else fallback(image_name)
+                           for image_name, record in fetched],
+                          failed=[image_name for image_name, record in fetched if not record])
+
+
 class ComperableRepository:
-  def __init__(self, namespace, name):
+  def __init__(self, namespace, name, fetcher=None, http=None):
     self.name = name
     self.namespace = namespace
+    self.fetcher = fetcher if fetcher else TagFetcher()
+    self.http = http if http else HttpSession.default_instance()
+
+  def __getstate__(self):
+    return {key: value for key, value in self.__dict__.items() if key not in ('fetcher', 'http')}
 
   def __eq__(self, other):
     return isinstance(other, self.__class__) \
@@ -70,16 +183,39 @@ class ComperableRepository:
     return hash((self.name, self.namespace))
 
 
-class DockerRepositoryV1(Printable, ComperableRepository):
+class DockerRepositoryV1(ComperableRepository, Printable):
   DEFAULT_VALUE = 'registry.hub.docker.com'
 
-  def __init__(self, namespace, name=DEFAULT_VALUE):
-    super().__init__(name=name, namespace=namespace)
+  def __init__(self, namespace, name=DEFAULT_VALUE, fetcher=None, http=None):
+    super().__init__(name=name, namespace=namespace, fetcher=fetcher, http=http)
+
+  def __record(self, image_name, tags, validators=None):
+    return DockerRepositoryRecord(
+        repository=None if self.name == DockerRepositoryV1.DEFAULT_VALUE else self.name,
+        namespace=self.namespace,
+        name=image_name,
+        tags=tags,
+        validators=validators)
+
+  @traced('registry')
+  def __tags(self, image_name, validators=None):
+    r, validators = get_validated_json(self.http,
+                                       'https://%s/v1/repositories/%s/%s/tags'
+                                       % (self.name, self.namespace.rstrip('/'), image_name),
+                                       validators)
+    return natsorted([tag['name'] for tag in r], reverse=True), validators
+
+  def __fetch(self, image_name, validators):
+    return self.__record(image_name, *self.__tags(image_name, validators))
 
   def tags(self, image_name):
-    r = requests.get('https://%s/v1/repositories/%s/%s/tags'
-                     % (self.name, self.namespace.rstrip('/'), image_name)).json()
-    return natsorted([tag['name'] for tag in r], reverse=True)
+    return self.__tags(image_name)[0]
+
+  def record(self, image_name):
+    try:
+      return self.__record(image_name, self.tags(image_name))
+    except NotFound:
+      return None
 
   # {
   #   "name": "actionspec/php70-fpm",
@@ -89,46 +225,70 @@ class DockerRepositoryV1(Printable, ComperableRepository):
   #   "is_automated": true,
   #   "is_official": false
   # }
-  def list(self):
-    r = requests.get('https://%s/v1/search?q=%s' % (self.name, self.namespace))
-    search = r.json()
+  @traced('registry')
+  def list(self, previous=None):
+    search = get_json(self.http, 'https://%s/v1/search?q=%s' % (self.name, self.namespace))
     search_results = search['results']
     while search['num_pages'] != search['page']:
-      search = requests.get('https://%s/v1/search?q=%s&page=%d'
-                            % (self.name, self.namespace, search['page'] + 1)).json()
+      search = get_json(self.http,
+                        'https://%s/v1/search?q=%s&page=%d'
+                        % (self.name, self.namespace, search['page'] + 1))
       search_results += search['results']
 
-    return [
-      DockerRepositoryRecord(
-          repository=None if self.name == DockerRepositoryV1.DEFAULT_VALUE else self.name,
-          namespace=self.namespace,
-          name=search_hit['name'].split('/')[1],
-          tags=self.tags(search_hit['name'].split('/')[1]))
-      for search_hit in search_results
-      if search_hit['name'].startswith('%s/' % self.name.rstrip('/'))
-    ]
+    names = [search_hit['name'].split('/')[1] for search_hit in search_results
+             if search_hit['name'].startswith('%s/' % self.name.rstrip('/'))]
+    previous_records = {record.name: record for record in previous or []}
+    return self.fetcher.records(
+        lambda name: refresh_record(previous_records.get(name), None,
+                                    lambda validators: self.__fetch(name, validators)),
+        names,
+        lambda name: previous_records.get(name, self.__record(name, [])))
 
 
-class DockerStore(Printable, ComperableRepository):
+class DockerStore(ComperableRepository, Printable):
   DEFAULT_NAME = 'store.docker.com'
 
-  def __init__(self, namespace, name=DEFAULT_NAME):
-    super().__init__(name=name, namespace=namespace)
+  def __init__(self, namespace, name=DEFAULT_NAME, fetcher=None, http=None):
+    super().__init__(name=name, namespace=namespace, fetcher=fetcher, http=http)
 
-  def __paged_results(self, url):
-    r = requests.get(url)
-    repos = r.json()
+  # Validators only cover the first page, which is where new tags show up
+  def __paged_results(self, url, validators=None):
+    repos, validators = get_validated_json(self.http, url, validators)
     results = repos['results']
     while repos['next']:
-      r = requests.get(repos['next'])
-      repos = r.json()
+      repos = get_json(self.http, repos['next'])
       results += repos['results']
-    return results
+    return results, validators
+
+  def __record(self, image_name, tags, last_updated=None, validators=None):
+    return DockerRepositoryRecord(
+        repository=None if self.name == DockerStore.DEFAULT_NAME else self.name,
+        namespace=self.namespace,
+        name=image_name,
+        tags=tags,
+        last_updated=last_updated,
+        validators=validators)
+
+  @traced('registry')
+  def __tags(self, image_name, validators=None):
+    results, validators = self.__paged_results(
+        'https://%s/v2/repositories/%s/%s/tags/?page_size=100'
+        % (self.name, self.namespace.rstrip('/'), image_name),
+        validators)
+    return natsorted([result['name'] for result in results], reverse=True), validators
+
+  def __fetch(self, image_name, last_updated, validators):
+    tags, validators = self.__tags(image_name, validators)
+    return self.__record(image_name, tags, last_updated, validators)
 
   def tags(self, image_name):
-    results = self.__paged_results('https://%s/v2/repositories/%s/%s/tags/?page_size=100'
-                                   % (self.name, self.namespace.rstrip('/'), image_name))
-    return natsorted([result['name'] for result in results], reverse=True)
+    return self.__tags(image_name)[0]
+
+  def record(self, image_name):
+    try:
+      return self.__record(image_name, self.tags(image_name))
+    except NotFound:
+      return None
 
   # {
   #   "user": "actions",
@@ -144,65 +304,112 @@ class DockerStore(Printable, ComperableRepository):
   #   "pull_count": 2,
   #   "last_updated": "2018-08-15T00:40:22.330354Z"
   # }
-  def list(self):
+  @traced('registry')
+  def list(self, previous=None):
     results = self.__paged_results('https://%s/v2/repositories/%s?page_size=100'
-                                   % (self.name, self.namespace))
-    return [
-      DockerRepositoryRecord(
-          repository=None if self.name == DockerStore.DEFAULT_NAME else self.name,
-          namespace=self.namespace,
-          name=result['name'],
-          tags=self.tags(result['name']))
-      for result in results
-    ]
+                                   % (self.name, self.namespace))[0]
+    last_updated = {result['name']: result.get('last_updated') for result in results}
+    previous_records = {record.name: record for record in previous or []}
+    return self.fetcher.records(
+        lambda name: refresh_record(previous_records.get(name), last_updated[name],
+                                    lambda validators: self.__fetch(name, last_updated[name],
+                                                                    validators)),
+        [result['name'] for result in results],
+        lambda name: previous_records.get(name, self.__record(name, [])))
 
 
 class DockerRepositoryGcr:
+  SCOPES = ['https://www.googleapis.com/auth/devstorage.read_write']
 
-  def __init__(self, namespace, name='registry.hub.docker.com', gcr_key_file=None):
+  def __init__(self, namespace, name='registry.hub.docker.com', gcr_key_file=None, fetcher=None,
+               http=None, token_cache=None):
     self.gcr_key_file = gcr_key_file
     self.name = name
     self.namespace = namespace
+    self.fetcher = fetcher if fetcher else TagFetcher()
+    self.http = http if http else HttpSession.default_instance()
+    self.token_cache = token_cache
     self.__credentials = None
+    self.__token = None
+    self.__expiry = 0
 
   def credentials(self):
     if not self.__credentials:
+      import google.auth
+      from google.oauth2 import service_account
       warnings.filterwarnings("ignore",
                               "Your application has authenticated using end user credentials")
       if self.gcr_key_file:
         logging.debug('Using key file: %s' % self.gcr_key_file)
         self.__credentials = service_account.Credentials.from_service_account_file(
-            self.gcr_key_file,
-            scopes=['https://www.googleapis.com/auth/devstorage.read_write'])
+            self.gcr_key_file, scopes=DockerRepositoryGcr.SCOPES)
       else:
         logging.debug('Using default credentials')
-        self.__credentials, project = google.auth.default(
-            scopes=['https://www.googleapis.com/auth/devstorage.read_write'])
+        self.__credentials, project = google.auth.default(scopes=DockerRepositoryGcr.SCOPES)
     return self.__credentials
 
+  def __refresh(self):
+    import google.auth.transport.requests
+    self.credentials().refresh(
+        google.auth.transport.requests.Request(session=self.http.session()))
+    expiry = self.credentials().expiry
+    return self.credentials().token, calendar.timegm(expiry.utctimetuple()) if expiry else None
+
+  @traced('registry')
   def token(self):
-    self.credentials().refresh(google.auth.transport.requests.Request())
-    return self.credentials().token
+    if not self.__token or self.__expiry - time.time() <= TokenCache.REFRESH_MARGIN:
+      if self.token_cache:
+        self.__token, expiry = self.token_cache.get(credentials_identity(self.gcr_key_file),
+                                                    DockerRepositoryGcr.SCOPES, self.__refresh)
+      else:
+        self.__token, expiry = self.__refresh()
+      # Tokens without a known expiry are refreshed on every use
+      self.__expiry = expiry or 0
+    return self.__token
+
+  def __record(self, image_name, tags, validators=None):
+    return DockerRepositoryRecord(repository=self.name,
+                                  namespace=self.namespace,
+                                  name=image_name,
+                                  tags=tags,
+                                  validators=validators)
+
+  @traced('registry')
+  def __tags(self, image_name, token, validators=None):
+    result, validators = get_validated_json(
+        self.http,
+        'https://%s/v2/%s/%s/tags/list' % (self.name, self.namespace, image_name),
+        validators,
+        headers={'Authorization': 'Bearer %s' % token})
+    return natsorted(result['tags'], reverse=True), validators
+
+  def __fetch(self, image_name, token, validators):
+    return self.__record(image_name, *self.__tags(image_name, token, validators))
 
   def tags(self, image_name, token=None):
-    if not token:
-      token = self.token()
-    result = requests.get(
-        'https://%s/v2/%s/%s/tags/list' % (self.name, self.namespace, image_name),
-        headers={'Authorization': 'Bearer %s' % token}).json()
-    return natsorted(result['tags'], reverse=True)
+    return self.__tags(image_name, token if token else self.token())[0]
+
+  def record(self, image_name):
+    try:
+      return self.__record(image_name, self.tags(image_name))
+    except NotFound:
+      return None
 
-  def list(self):
+  @traced('registry')
+  def list(self, previous=None):
     token = self.token()
-    response = requests.get('https://%s/v2/%s/tags/list' % (self.name, self.namespace),
-                            headers={'Authorization': 'Bearer %s' % token})
-    return [
-      DockerRepositoryRecord(repository=self.name,
-                             namespace=self.namespace,
-                             name=child,
-                             tags=self.tags(child, token))
-      for child in response.json()['child']
-    ]
+    children = get_json(self.http,
+                        'https://%s/v2/%s/tags/list' % (self.name, self.namespace),
+                        headers={'Authorization': 'Bearer %s' % token})['child']
+    previous_records = {record.name: record for record in previous or []}
+    return self.fetcher.records(
+        lambda child: refresh_record(previous_records.get(child), None,
+                                     lambda validators: self.__fetch(child, token, validators)),
+        children,
+        lambda child: previous_records.get(child, self.__record(child, [])))
+
+  def __getstate__(self):
+    return {'name': self.name, 'namespace': self.namespace, 'gcr_key_file': self.gcr_key_file}
 
   def __repr__(self):
     return str(self.__class__) + ": " + str({'name': self.name, 'namespace': self.namespace})
@@ -237,11 +444,46 @@ class DockerRepositoryGcr:
 
 
 class DockerRepositoryFactory(Printable):
-  def __init__(self, repository, gcr_key_file=None):
+  def __init__(self, repository, gcr_key_file=None, fetcher=None, http=None, token_cache=None,
+               registry_cache=None):
     self.gcr_key_file = gcr_key_file
     self.repository = repository
+    self.fetcher = fetcher if fetcher else TagFetcher()
+    self.http = http if http else HttpSession.default_instance()
+    self.token_cache = token_cache
+    self.registry_cache = registry_cache
     self.__versions = []
 
+  # Returns one repository client per factory. Registries that are not cached yet are probed
+  # concurrently
+  @classmethod
+  def repositories(cls, factories):
+    if len(factories) <= 1:
+      return [factory.versions()[-1] for factory in factories]
+    with ThreadPoolExecutor(max_workers=len(factories)) as executor:
+      return [versions[-1] for versions in executor.map(lambda factory: factory.versions(),
+                                                        factories)]
+
+  def __probe(self):
+    capabilities = self.registry_cache.get(self.repository) if self.registry_cache else None
+    if capabilities is not None:
+      return capabilities
+    try:
+      capabilities = {'kind': 'v1', 'v1': self.http.get('https://%s/v1' % self.repository).ok}
+    except Exception as e:
+      # Offline, the last known capabilities are better than none
+      logging.debug('Failed to probe %s: %s' % (self.repository, e))
+      capabilities = self.registry_cache.get(self.repository, stale=True) \
+        if self.registry_cache else None
+      return capabilities or {'kind': 'v1', 'v1': False}
+    if self.registry_cache:
+      try:
+        self.registry_cache.put(self.repository, capabilities)
+      except OSError as e:
+        logging.debug('Failed to cache %s capabilities: %s' % (self.repository, e))
+    return capabilities
+
+  @traced('registry')
   def versions(self):
     if not self.__versions:
       repo_split = self.repository.split('/')
@@ -254,19 +496,26 @@ class DockerRepositoryFactory(Printable):
           self.__versions += [
             DockerRepositoryGcr(name=repo_split[0],
                                 namespace=repo_split[1],
-                                gcr_key_file=self.gcr_key_file)]
+                                gcr_key_file=self.gcr_key_file,
+                                fetcher=self.fetcher,
+                                http=self.http,
+                                token_cache=self.token_cache)]
         else:
-          v1_response = requests.get('https://%s/v1' % self.repository)
-          if v1_response.ok:
+          if self.__probe()['v1']:
             logging.debug('Adding v1 docker repository...')
-          self.__versions += [DockerRepositoryV1(name=repo_split[0], namespace=repo_split[1])]
+          self.__versions += [DockerRepositoryV1(name=repo_split[0],
+                                                 namespace=repo_split[1],
+                                                 fetcher=self.fetcher,
+                                                 http=self.http)]
         # v2_response = requests.get('https://%s/v2' % self.repository)
         # if v2_response.ok:
         # if v2_response.status_code == 401:
 
       else:
         logging.debug('Adding docker store repository...')
-        self.__versions += [DockerStore(namespace=repo_split[0])]
+        self.__versions += [DockerStore(namespace=repo_split[0],
+                                        fetcher=self.fetcher,
+                                        http=self.http)]
 
     logging.debug('Docker factory returns: %s' % self.__versions)
     return self.__versions
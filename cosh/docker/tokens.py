@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from cosh.files import FileLock, atomic_write
+from cosh.misc import Printable
+
+
+def credentials_identity(key_file=None):
+  # Tokens belong to the account, so a key file is identified by the key it holds rather than
+  # by its path. Default credentials are identified by the file google.auth would read
+  if not key_file:
+    key_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS') or os.path.expanduser(
+        '~/.config/gcloud/application_default_credentials.json')
+    if not os.path.exists(key_file):
+      return ['default']
+  try:
+    with open(key_file, 'r') as f:
+      key = json.load(f)
+    return [key.get('type'), key.get('client_email') or key.get('client_id'),
+            key.get('private_key_id') or key.get('refresh_token')]
+  except (OSError, ValueError) as e:
+    logging.debug('Failed to read credentials %s: %s' % (key_file, e))
+    return ['file', os.path.abspath(key_file)]
+
+
+class TokenCache(Printable):
+  # Tokens closer to their expiry than this are refreshed
+  REFRESH_MARGIN = 5 * 60
+
+  def __init__(self, tokendir, refresh_margin=REFRESH_MARGIN):
+    self.tokendir = tokendir
+    self.refresh_margin = refresh_margin
+
+  def __file_name(self, identity, scopes):
+    key = hashlib.sha256(json.dumps([identity, sorted(scopes)]).encode('utf-8')).hexdigest()
+    return '%s/%s.json' % (self.tokendir, key[:32])
+
+  def __read(self, file_name):
+    try:
+      with open(file_name, 'r') as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if entry.get('expiry', 0) - time.time() <= self.refresh_margin:
+      return None
+    return entry
+
+  def __create_dir(self):
+    if not os.path.exists(self.tokendir):
+      os.makedirs(self.tokendir, exist_ok=True)
+      # Access tokens are credentials, tmpdir is usually shared with other users
+      os.chmod(self.tokendir, 0o700)
+
+  def __write(self, file_name, entry):
+    # Created without group and other access, regardless of the umask
+    with atomic_write(file_name, permissions=0o600) as f:
+      json.dump(entry, f)
+
+  # Returns a cached (token, expiry) for the identity, refreshing it through fn_refresh, which
+  # returns a token and its expiry in seconds since the epoch, when it is missing or about to
+  # expire. Concurrent processes wait for a single refresh
+  def get(self, identity, scopes, fn_refresh):
+    file_name = self.__file_name(identity, scopes)
+    entry = self.__read(file_name)
+    if entry:
+      return entry['token'], entry['expiry']
+
+    lock = FileLock('%s.lock' % file_name)
+    try:
+      # Only created once a token is needed, most repositories are not gcr
+      self.__create_dir()
+      lock.acquire()
+    except OSError as e:
+      # i.e. a token dir of another user, every process then refreshes on its own
+      logging.debug('Failed to lock access token cache: %s' % e)
+      return fn_refresh()
+    try:
+      entry = self.__read(file_name)
+      if entry:
+        return entry['token'], entry['expiry']
+
+      logging.debug('Refreshing access token for %s' % identity[:2])
+      token, expiry = fn_refresh()
+      if expiry:
+        try:
+          self.__write(file_name, {'token': token, 'expiry': expiry})
+        except OSError as e:
+          logging.debug('Failed to cache access token: %s' % e)
+      return token, expiry
+    finally:
+      lock.release()
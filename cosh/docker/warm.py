@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import shlex
+import subprocess
+import time
+
+from cosh.files import FileLock, atomic_write
+from cosh.misc import Printable
+from cosh.trace import traced
+
+
+class WarmContainerClient(Printable):
+  DEFAULT_IDLE_TIMEOUT = 10 * 60
+  LABEL = 'cosh.warm'
+  KEEPER_INTERVAL = 5
+  # Runs as pid 1 and exits, removing the container, once no other process ran in it for the
+  # idle timeout. Commands signal it when they start, so that short ones are not missed between
+  # two checks. Orphans adopted by pid 1 stay zombies and are not counted
+  KEEPER = 'trap "exit 0" TERM; trap "idle=0" USR1; idle=0; ' \
+           'while [ "$idle" -lt %(timeout)d ]; do ' \
+           'sleep %(interval)d & sleeper=$!; wait $sleeper && idle=$((idle + %(interval)d)); ' \
+           'kill $sleeper 2>/dev/null; wait $sleeper 2>/dev/null; ' \
+           'for p in /proc/[0-9]*; do ' \
+           'test "${p#/proc/}" = $$ && continue; ' \
+           'read -r stat < $p/stat 2>/dev/null || continue; ' \
+           'case "$stat" in *") Z "*) ;; *) idle=0 ;; esac; ' \
+           'done; ' \
+           'done'
+  # Prepended to every docker exec, see KEEPER
+  EXEC = 'kill -USR1 1 2>/dev/null; exec "$@"'
+
+  def __init__(self, docker_client, state_dir, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    self.docker_client = docker_client
+    self.docker_binary = docker_client.docker_binary
+    self.state_dir = state_dir
+    self.idle_timeout = idle_timeout
+
+  def run_options(self, **kwargs):
+    return self.docker_client.run_options(**kwargs)
+
+  # Embedded commands keep starting their own containers
+  def run_command(self, image, arguments, **kwargs):
+    return self.docker_client.run_command(image, arguments, **kwargs)
+
+  def image_exists(self, image):
+    return self.docker_client.image_exists(image)
+
+  def pull(self, image):
+    return self.docker_client.pull(image)
+
+  def image_path(self, image):
+    return self.docker_client.image_path(image)
+
+  def __options(self, **kwargs):
+    return kwargs['options'] if 'options' in kwargs else self.run_options(**kwargs)
+
+  def __name(self, image, **kwargs):
+    # Environment, mounts and working dir are fixed once the container is created
+    return 'cosh-warm-%s' % hashlib.sha256(
+        json.dumps([image, self.__options(**kwargs)]).encode('utf-8')).hexdigest()[:16]
+
+  def __state_file(self, name):
+    return '%s/%s.json' % (self.state_dir, name)
+
+  def __state(self, name):
+    try:
+      with open(self.__state_file(name), 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def __write_state(self, name, state):
+    with atomic_write(self.__state_file(name)) as f:
+      json.dump(state, f)
+
+  def __is_running(self, name):
+    try:
+      return subprocess.check_output(
+          '%s inspect -f "{{.State.Running}}" %s' % (self.docker_binary, name), shell=True,
+          stderr=subprocess.DEVNULL).strip() == b'true'
+    except subprocess.CalledProcessError:
+      return False
+
+  def __create(self, name, image, **kwargs):
+    logging.debug('Starting warm container %s for %s' % (name, image))
+    subprocess.call('%s rm -f %s' % (self.docker_binary, name), shell=True,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    keeper = WarmContainerClient.KEEPER % {
+      'timeout': self.idle_timeout,
+      'interval': max(min(WarmContainerClient.KEEPER_INTERVAL, self.idle_timeout), 1)
+    }
+    subprocess.call('%s run -d --rm --net=host -i --name %s --label %s=%d%s --entrypoint /bin/sh'
+                    ' %s -c %s' % (self.docker_binary, name, WarmContainerClient.LABEL,
+                                   self.idle_timeout, self.__options(**kwargs), image,
+                                   shlex.quote(keeper)),
+                    shell=True, stdout=subprocess.DEVNULL)
+    if not self.__is_running(name):
+      # Images without a shell can not be kept running
+      return {'image': image, 'supported': False}
+
+    config = json.loads(subprocess.check_output(
+        '%s image inspect -f "{{json .Config}}" %s' % (self.docker_binary, image), shell=True))
+    return {
+      'image': image,
+      'supported': True,
+      'entrypoint': config.get('Entrypoint') or [],
+      'cmd': config.get('Cmd') or []
+    }
+
+  def __container(self, image, **kwargs):
+    name = self.__name(image, **kwargs)
+    if not os.path.exists(self.state_dir):
+      os.makedirs(self.state_dir)
+
+    with FileLock('%s.lock' % self.__state_file(name)):
+      state = self.__state(name)
+      if state is None or (state['supported'] and not self.__is_running(name)):
+        state = self.__create(name, image, **kwargs)
+      self.__write_state(name, state)
+    return name, state
+
+  # Prepares a warm container, returns the command that runs the arguments in it
+  def exec_command(self, image, arguments, **kwargs):
+    name, state = self.__container(image, **kwargs)
+    if not state['supported']:
+      logging.debug('%s can not be kept warm' % image)
+      return self.docker_client.run_command(image, arguments, **kwargs)
+
+    # docker exec does not apply the image entrypoint, so it is prepended like docker run does
+    command = ' '.join(shlex.quote(part) for part in
+                       ['/bin/sh', '-c', WarmContainerClient.EXEC, 'sh'] + state['entrypoint'] +
+                       ([] if arguments else state['cmd']))
+    exec_command = '%s exec -i%s %s %s %s' % (
+      self.docker_binary,
+      ' -t' if 'tty' in kwargs and kwargs['tty'] else '',
+      name,
+      command,
+      ' '.join(arguments))
+    # The container may have exited since it was checked. A failed exec into a container that is
+    # not running falls back to a cold run, commands failing in a running one keep their status
+    return '%s || { status=$?; %s inspect -f "{{.State.Running}}" %s 2>/dev/null | grep -qx true' \
+           ' && exit $status; %s; }' \
+           % (exec_command, self.docker_binary, name,
+              self.docker_client.run_command(image, arguments, **kwargs))
+
+  # Containers exit by themselves, only the state of the ones that did is removed
+  def reap(self):
+    if not os.path.exists(self.state_dir):
+      return
+    now = time.time()
+    for entry in os.listdir(self.state_dir):
+      if not entry.endswith('.json'):
+        continue
+      state_file = '%s/%s' % (self.state_dir, entry)
+      try:
+        if now - os.stat(state_file).st_mtime <= self.idle_timeout:
+          continue
+        name = entry[:-len('.json')]
+        with FileLock('%s.lock' % state_file):
+          if now - os.stat(state_file).st_mtime <= self.idle_timeout or self.__is_running(name):
+            continue
+          logging.debug('Removing state of exited warm container %s' % name)
+          os.remove(state_file)
+      except OSError as e:
+        logging.debug('Failed to reap %s: %s' % (state_file, e))
+
+  @traced('docker')
+  def run(self, image, arguments, **kwargs):
+    cmd = self.exec_command(image, arguments, **kwargs)
+    logging.debug('Running command:\n%s' % cmd)
+    try:
+      return subprocess.call(cmd, shell=True, close_fds=True, preexec_fn=os.setsid)
+    finally:
+      self.reap()
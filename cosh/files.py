@@ -0,0 +1,51 @@
+import contextlib
+import fcntl
+import os
+import threading
+
+from cosh.misc import Printable
+
+
+class FileLock(Printable):
+  def __init__(self, file_name):
+    self.file_name = file_name
+    self.__fd = None
+
+  def acquire(self, blocking=True):
+    fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      return False
+    self.__fd = fd
+    return True
+
+  def release(self):
+    if self.__fd is not None:
+      fcntl.flock(self.__fd, fcntl.LOCK_UN)
+      os.close(self.__fd)
+      self.__fd = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.release()
+
+
+# Yields a temporary file that replaces file_name once it is written, so readers see either the
+# previous or the new content, never a partial one
+@contextlib.contextmanager
+def atomic_write(file_name, mode='w', permissions=0o666):
+  tmp_file_name = '%s.%d.%d.tmp' % (file_name, os.getpid(), threading.get_ident())
+  fd = os.open(tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+  try:
+    with os.fdopen(fd, mode) as f:
+      yield f
+    os.replace(tmp_file_name, file_name)
+  except BaseException:
+    if os.path.exists(tmp_file_name):
+      os.remove(tmp_file_name)
+    raise
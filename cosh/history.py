@@ -0,0 +1,47 @@
+import logging
+import os
+import time
+from collections import Counter
+
+from cosh.files import FileLock, atomic_write
+from cosh.misc import Printable
+
+
+class UsageHistory(Printable):
+  MAX_ENTRIES = 10000
+
+  def __init__(self, file_name, max_entries=MAX_ENTRIES):
+    self.file_name = file_name
+    self.max_entries = max_entries
+
+  def __entries(self):
+    if not os.path.exists(self.file_name):
+      return []
+    with open(self.file_name, 'r') as f:
+      return [line.rstrip('\n').split('\t', 1) for line in f if '\t' in line]
+
+  def __compact(self):
+    with FileLock('%s.lock' % self.file_name):
+      entries = self.__entries()
+      if len(entries) <= self.max_entries:
+        return
+      with atomic_write(self.file_name) as f:
+        f.writelines('%s\t%s\n' % (timestamp, image)
+                     for timestamp, image in entries[-(self.max_entries // 2):])
+
+  def record(self, image):
+    try:
+      # A single short append is atomic, concurrent invocations do not need a lock
+      fd = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        os.write(fd, ('%d\t%s\n' % (time.time(), image)).encode('utf-8'))
+      finally:
+        os.close(fd)
+      if os.path.getsize(self.file_name) > self.max_entries * 64:
+        self.__compact()
+    except OSError as e:
+      logging.debug('Failed to record usage of %s: %s' % (image, e))
+
+  def top(self, count):
+    return [image for image, _ in Counter(image for _, image in self.__entries())
+            .most_common(count)]
@@ -0,0 +1,236 @@
+import collections
+import hashlib
+import json
+import logging
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from cosh.cache import instance_key
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.misc import Printable
+from cosh.trace import traced
+
+
+def encode_fields(record):
+  return json.dumps(record.fields(), separators=(',', ':'))
+
+
+# Both ends hash the records they hold, so a client can name the generation it already has
+# without keeping any state besides its cached catalog
+def generation(records):
+  digest = hashlib.sha1()
+  for record in records:
+    digest.update(encode_fields(record).encode('utf-8'))
+    digest.update(b'\n')
+  return digest.hexdigest()
+
+
+def repository_id(repository):
+  return hashlib.sha1(instance_key(repository).encode('utf-8')).hexdigest()[:16]
+
+
+# http.server only has it from python 3.7 on
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class MirroredCatalog(Printable):
+  # Number of earlier generations deltas can be computed from
+  HISTORY = 16
+
+  def __init__(self, repository):
+    self.repository = repository
+    self.generation = None
+    self.timestamp = None
+    self.names = []
+    self.__fields = {}
+    self.__history = collections.OrderedDict()
+    self.__lock = threading.Lock()
+
+  def update(self, records):
+    current = generation(records)
+    with self.__lock:
+      if current == self.generation:
+        return False
+      if self.generation:
+        self.__history[self.generation] = self.__fields
+        while len(self.__history) > MirroredCatalog.HISTORY:
+          self.__history.popitem(last=False)
+      self.generation = current
+      self.timestamp = time.time()
+      self.names = [record.name for record in records]
+      self.__fields = collections.OrderedDict((record.name, encode_fields(record))
+                                              for record in records)
+      return True
+
+  def __full(self):
+    return {'generation': self.generation,
+            'names': self.names,
+            'records': [json.loads(fields) for fields in self.__fields.values()]}
+
+  # Returns None when the client is up to date, the changes when its generation is still known
+  # and the whole catalog otherwise
+  def response(self, since=None):
+    with self.__lock:
+      if since == self.generation:
+        return None
+      base = self.__history.get(since)
+      if base is None:
+        return self.__full()
+      return {'generation': self.generation,
+              'base': since,
+              'names': self.names,
+              'records': [json.loads(fields) for name, fields in self.__fields.items()
+                          if base.get(name) != fields]}
+
+  def summary(self):
+    with self.__lock:
+      return {'repository': '%s/%s' % (self.repository.name, self.repository.namespace),
+              'generation': self.generation,
+              'timestamp': self.timestamp,
+              'count': len(self.names)}
+
+
+class CatalogMirror(Printable):
+  DEFAULT_PORT = 8787
+  DEFAULT_REFRESH_INTERVAL = 60
+
+  def __init__(self, cache, repositories, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+    self.cache = cache
+    self.refresh_interval = refresh_interval
+    self.catalogs = collections.OrderedDict((repository_id(repository),
+                                             MirroredCatalog(repository))
+                                            for repository in repositories)
+    self.__stopped = threading.Event()
+    self.__server = None
+
+  def refresh(self):
+    for catalog in self.catalogs.values():
+      try:
+        # The cache decides whether the registry is crawled again
+        if catalog.update(self.cache.load(catalog.repository.list)):
+          logging.info('Mirrored %s' % catalog.summary())
+      except Exception as e:
+        logging.warning('Failed to refresh %s/%s: %s'
+                        % (catalog.repository.name, catalog.repository.namespace, e))
+
+  def __refresh_loop(self):
+    while not self.__stopped.wait(self.refresh_interval):
+      self.refresh()
+
+  def handle(self, path, headers={}):
+    url = urlparse(path)
+    parts = url.path.strip('/').split('/')
+    if parts == ['catalogs']:
+      return 200, {catalog_id: catalog.summary()
+                   for catalog_id, catalog in self.catalogs.items()}, {}
+    if len(parts) == 2 and parts[0] == 'catalogs' and parts[1] in self.catalogs:
+      catalog = self.catalogs[parts[1]]
+      since = parse_qs(url.query).get('since', [None])[0] or \
+              headers.get('If-None-Match', '').strip('"') or None
+      body = catalog.response(since)
+      etag = {'ETag': '"%s"' % catalog.generation}
+      return (304, None, etag) if body is None else (200, body, etag)
+    return 404, {'detail': 'Not found'}, {}
+
+  def address(self):
+    return self.__server.server_address
+
+  def start(self, bind='127.0.0.1', port=DEFAULT_PORT):
+    mirror = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+
+      def log_message(self, format, *args):
+        logging.debug(format % args)
+
+      def do_GET(self):
+        status, body, headers = mirror.handle(self.path, self.headers)
+        content = json.dumps(body, separators=(',', ':')).encode('utf-8') \
+          if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+          self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    self.refresh()
+    self.__server = ThreadingHTTPServer((bind, port), Handler)
+    threading.Thread(target=self.__refresh_loop, daemon=True).start()
+    threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+    logging.info('Serving %d catalogs on http://%s:%d' % ((len(self.catalogs),) + self.address()))
+    return self
+
+  def stop(self):
+    self.__stopped.set()
+    self.__server.shutdown()
+    self.__server.server_close()
+
+  def serve(self, bind='127.0.0.1', port=DEFAULT_PORT):
+    self.start(bind, port)
+    try:
+      self.__stopped.wait()
+    finally:
+      self.stop()
+
+
+# Lists a repository through a catalog mirror, falling back to the repository itself when the
+# mirror does not know it or can not be reached
+class MirroredRepository(Printable):
+  def __init__(self, repository, mirror_url, http):
+    self.repository = repository
+    self.mirror_url = mirror_url.rstrip('/')
+    self.http = http
+    self.name = repository.name
+    self.namespace = repository.namespace
+
+  def __getstate__(self):
+    # Shared with every mirror, so switching mirrors keeps the cached catalog
+    return {'repository': instance_key(self.repository)}
+
+  def __fetch(self, since):
+    response = self.http.get('%s/catalogs/%s' % (self.mirror_url, repository_id(self.repository)),
+                             params={'since': since} if since else None)
+    if response.status_code in (304, 404):
+      return response.status_code, None
+    response.raise_for_status()
+    return response.status_code, response.json()
+
+  @classmethod
+  def __records(cls, body, previous):
+    # A delta only holds the records that changed since its base
+    records = {record.name: record for record in previous or []} if body.get('base') else {}
+    records.update((record.name, record)
+                   for record in map(DockerRepositoryRecord.from_fields, body['records']))
+    return [records[name] for name in body['names']]
+
+  @traced('registry')
+  def list(self, previous=None):
+    since = generation(previous) if previous else None
+    try:
+      status, body = self.__fetch(since)
+      if status == 304:
+        logging.debug('Mirrored catalog of %s/%s not modified' % (self.name, self.namespace))
+        return previous
+      if status == 200:
+        records = MirroredRepository.__records(body, previous)
+        if generation(records) == body['generation']:
+          return records
+        logging.debug('Catalog delta did not apply, fetching the whole catalog')
+        status, body = self.__fetch(None)
+        if status == 200:
+          return MirroredRepository.__records(body, None)
+      logging.warning('%s/%s is not mirrored by %s' % (self.name, self.namespace, self.mirror_url))
+    except Exception as e:
+      logging.warning('Catalog mirror %s failed: %s' % (self.mirror_url, e))
+    return self.repository.list(previous)
+
+  def record(self, image_name):
+    return self.repository.record(image_name)
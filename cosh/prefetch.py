@@ -0,0 +1,43 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cosh.misc import Printable
+
+
+class Prefetcher(Printable):
+  DEFAULT_CONCURRENCY = 4
+  DEFAULT_TOP = 10
+
+  def __init__(self, docker_client, concurrency=DEFAULT_CONCURRENCY):
+    self.docker_client = docker_client
+    self.concurrency = concurrency
+
+  def __fetch(self, image):
+    try:
+      if self.docker_client.image_exists(image):
+        logging.debug('%s is already present' % image)
+        return {'image': image, 'status': 'present', 'bytes': 0}
+      logging.info('Pulling %s...' % image)
+      return {'image': image, 'status': 'pulled', 'bytes': self.docker_client.pull(image) or 0}
+    except Exception as e:
+      logging.warning('Failed to pull %s: %s' % (image, e))
+      return {'image': image, 'status': 'failed', 'bytes': 0, 'error': str(e)}
+
+  def prefetch(self, images):
+    images = list(dict.fromkeys(images))
+    if not images:
+      return []
+    with ThreadPoolExecutor(max_workers=max(min(self.concurrency, len(images)), 1)) as executor:
+      return list(executor.map(self.__fetch, images))
+
+  @classmethod
+  def report(cls, results):
+    for result in results:
+      logging.info('%s: %s%s' % (result['image'], result['status'],
+                                 (' (%d bytes)' % result['bytes']) if result['bytes'] else ''))
+    logging.info('Prefetched %d of %d images, %d already present, %d failed, %d bytes transferred'
+                 % (len([result for result in results if result['status'] == 'pulled']),
+                    len(results),
+                    len([result for result in results if result['status'] == 'present']),
+                    len([result for result in results if result['status'] == 'failed']),
+                    sum(result['bytes'] for result in results)))
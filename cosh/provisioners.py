@@ -1,89 +1,286 @@
 import hashlib
+import json
 import logging
 import os
 import stat
-import tarfile
-
-import requests
+import time
 
+from cosh.docker import DockerEnvironment, DockerTerminalClient
+from cosh.files import FileLock
 from cosh.misc import Printable
+from cosh.session import HttpSession
+from cosh.tmpdir import rmdir
+from cosh.trace import traced
+
+
+class ArtifactStore(Printable):
+  BLOCK_SIZE = 65536
+
+  def __init__(self, store_dir, http=None):
+    self.store_dir = store_dir
+    self.http = http if http else HttpSession.default_instance()
+
+  def __paths(self, sha256, members):
+    return {member: '%s/%s/%s' % (self.store_dir, sha256, member) for member in members}
+
+  def __download(self, url, sha256):
+    partial = '%s/%s.partial' % (self.store_dir, sha256)
+    digest = hashlib.sha256()
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
 
+    response = self.http.get(url, stream=True,
+                             headers={'Range': 'bytes=%d-' % offset} if offset else {})
+    if response.status_code == 206:
+      logging.debug('Resuming download of %s at %d bytes' % (url, offset))
+      with open(partial, 'rb') as f:
+        for block in iter(lambda: f.read(ArtifactStore.BLOCK_SIZE), b''):
+          digest.update(block)
+      mode = 'ab'
+    elif response.status_code == 416:
+      # The previous download was complete, it only has to be verified
+      response.close()
+      with open(partial, 'rb') as f:
+        for block in iter(lambda: f.read(ArtifactStore.BLOCK_SIZE), b''):
+          digest.update(block)
+      response = None
+    else:
+      response.raise_for_status()
+      mode = 'wb'
 
-def download_file(url, filename):
-  r = requests.get(url, stream=True)
-  with open(filename, 'wb') as f:
-    for chunk in r.iter_content(chunk_size=65536):
-      if chunk:  # filter out keep-alive new chunks
-        f.write(chunk)
-  return filename
+    if response is not None:
+      received = 0
+      # Hashed while streaming, the archive is never read a second time
+      with open(partial, mode) as f:
+        for chunk in response.iter_content(chunk_size=ArtifactStore.BLOCK_SIZE):
+          if chunk:  # filter out keep-alive new chunks
+            digest.update(chunk)
+            f.write(chunk)
+            received += len(chunk)
+      expected = response.headers.get('Content-Length')
+      if expected and received < int(expected):
+        # Kept, so that the next attempt resumes from here
+        raise Exception('Download of %s was interrupted after %d of %s bytes'
+                        % (url, offset + received, offset + int(expected)))
 
+    if not digest.hexdigest() == sha256:
+      os.remove(partial)
+      raise Exception('sha256 mismatch for %s' % url)
+    return partial
 
-def sha256_checksum(filename, block_size=65536):
-  sha256 = hashlib.sha256()
-  with open(filename, 'rb') as f:
-    for block in iter(lambda: f.read(block_size), b''):
-      sha256.update(block)
-  return sha256.hexdigest()
+  def __extract(self, archive, sha256, members):
+    import tarfile
+    tmp_dir = '%s/.%s.%d' % (self.store_dir, sha256, os.getpid())
+    with tarfile.open(archive, 'r') as tgz:
+      for member in members:
+        source = tgz.extractfile(tgz.getmember(member))
+        target = '%s/%s' % (tmp_dir, member)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+          for block in iter(lambda: source.read(ArtifactStore.BLOCK_SIZE), b''):
+            f.write(block)
+        os.chmod(target, tgz.getmember(member).mode | stat.S_IRUSR | stat.S_IXUSR)
+    os.rename(tmp_dir, '%s/%s' % (self.store_dir, sha256))
+
+  # Returns the local paths of the requested archive members
+  def provision(self, url, sha256, members):
+    paths = self.__paths(sha256, members)
+    if all(os.path.exists(path) for path in paths.values()):
+      return paths
+
+    if not os.path.exists(self.store_dir):
+      os.makedirs(self.store_dir, exist_ok=True)
+    with FileLock('%s/%s.lock' % (self.store_dir, sha256)):
+      if all(os.path.exists(path) for path in paths.values()):
+        logging.debug('%s was provisioned by another process' % url)
+        return paths
+      logging.info('Downloading %s...' % url)
+      archive = self.__download(url, sha256)
+      if os.path.exists('%s/%s' % (self.store_dir, sha256)):
+        # Members missing from an earlier extraction
+        rmdir('%s/%s' % (self.store_dir, sha256))
+      self.__extract(archive, sha256, members)
+      os.remove(archive)
+    return paths
 
 
 class DockerProvisioner(Printable):
-  __docker_static_url = 'https://download.docker.com/linux/static/stable/x86_64/' \
-                        'docker-18.06.0-ce.tgz'
-  __docker_static_sha256 = '1c2fa625496465c68b856db0ba850eaad7a16221ca153661ca718de4a2217705'
+  DOCKER_STATIC_URL = 'https://download.docker.com/linux/static/stable/x86_64/' \
+                      'docker-18.06.0-ce.tgz'
+  DOCKER_STATIC_SHA256 = '1c2fa625496465c68b856db0ba850eaad7a16221ca153661ca718de4a2217705'
+  DOCKER_MEMBER = 'docker/docker'
 
-  def __init__(self, tmpdir):
-    self.tmpdir = tmpdir
+  def __init__(self, store):
+    self.store = store
 
+  @traced('provision')
   def provision(self):
-    target = '%s/docker/docker' % self.tmpdir
-
-    logging.debug('Provisioning docker %s...' % target)
-    if not os.path.exists(target):
-      local_docker_tgz = '%s/docker.tgz' % self.tmpdir
-      download_file(DockerProvisioner.__docker_static_url, local_docker_tgz)
-      if sha256_checksum(local_docker_tgz) == DockerProvisioner.__docker_static_sha256:
-        docker_tgz = tarfile.open(local_docker_tgz, 'r')
-        docker_tgz.extractall(self.tmpdir, members=[member for member in docker_tgz.getmembers()])
-        os.remove(local_docker_tgz)
-      else:
-        raise Exception('sha256 mismatch for %s' % local_docker_tgz)
-    return {target: '/sbin/docker'}
+    logging.debug('Provisioning docker from %s...' % self.store.store_dir)
+    paths = self.store.provision(DockerProvisioner.DOCKER_STATIC_URL,
+                                 DockerProvisioner.DOCKER_STATIC_SHA256,
+                                 [DockerProvisioner.DOCKER_MEMBER])
+    return {paths[DockerProvisioner.DOCKER_MEMBER]: '/sbin/docker'}
 
 
 class CommandsProvisioner(Printable):
+  MODE_MOUNTS = 'mounts'
+  MODE_DIRECTORY = 'directory'
+  MODES = [MODE_MOUNTS, MODE_DIRECTORY]
+  DISPATCHER = '.cosh-dispatch'
+  RUNNER = '.cosh-run'
+  COMMANDS_DIR_PLACEHOLDER = '@COSH_COMMANDS_DIR@'
+  MAX_IDLE = 7 * 24 * 60 * 60
+  MAX_TMP_AGE = 60 * 60
+  # Part of the commands dir key, to be bumped whenever the scripts change for the same inputs
+  TEMPLATE_VERSION = 4
 
-  def __init__(self, extra_mounts, docker_client, env, placed_records):
-    self.extra_mounts = extra_mounts
-    self.docker_client = docker_client
-    self.env = env
-    self.placed_records = placed_records
+  def __init__(self, plan, records, base_dir, mode=MODE_MOUNTS):
+    self.plan = plan
+    # Sorted, so that the same records always render the same commands
+    self.records = sorted(records, key=lambda record: record.name)
+    self.base_dir = base_dir
+    self.mode = mode
 
-  def provision(self):
-    logging.debug('Provisioning commands: %s' % self.placed_records)
+  def __mounts(self, commands_dir):
+    # The dir is mounted once for the shared runner. The directory mode puts it on PATH, the
+    # mounts mode mounts every command on its own
+    if self.mode == CommandsProvisioner.MODE_DIRECTORY:
+      return {'commands_dir': commands_dir, 'commands_on_path': True}
+    return {'commands_dir': commands_dir,
+            'placed_records': [{'record': record, 'path': '%s/%s' % (commands_dir, record.name)}
+                               for record in self.records]}
+
+  def __runner(self, plan):
+    # The only script holding the docker options, every command execs it with its image.
+    # why test -t 0 instead test -t 1:
+    # Specifying -t is forbidden when the client is receiving its standard input from a pipe
+    custom = '${USE_TTY}'
+    path = ''
+    if self.mode == CommandsProvisioner.MODE_DIRECTORY:
+      # Nested containers get the commands dir first on the PATH of their image, like the outer one
+      docker = plan.docker_client.docker_binary
+      custom += ' -e "PATH=%s:${path}"' % DockerEnvironment.COMMANDS_DIR
+      path = '%s image inspect "$image" >/dev/null 2>&1 || %s pull "$image" >/dev/null\n' \
+             'path=%s\n' \
+             'while IFS= read -r env; do\n' \
+             '  case "$env" in PATH=*) path=${env#PATH=} ;; esac\n' \
+             "done < <(%s image inspect -f '%s' \"$image\")\n" \
+             % (docker, docker, DockerTerminalClient.DEFAULT_PATH, docker,
+                DockerTerminalClient.ENV_FORMAT)
+    return '#!/bin/bash -e\n' \
+           'image=$1\n' \
+           'shift\n' \
+           '%s' \
+           'test -t 0 && USE_TTY="-t"\n' \
+           'exec %s' \
+           % (path, plan.command(image='"${image}"', arguments=['"$@"'], tty=False, custom=custom))
+
+  @classmethod
+  def __script(cls, record):
     # login_flag = ' -l' if self.interactive else ''
+    return '#!/bin/bash -e\n' \
+           'cmd=$(basename ${BASH_SOURCE[0]})\n' \
+           'test -x /sbin.orig/$cmd && exec /sbin.orig/$cmd "$@"\n' \
+           'test -x /bin/$cmd && exec /bin/$cmd "$@"\n' \
+           'exec %s/%s %s:%s "$@"\n' \
+           % (DockerEnvironment.COMMANDS_DIR, CommandsProvisioner.RUNNER, record.image_name,
+              record.tags[0])
+
+  def __dispatcher(self):
+    # Every command is a link to this script. Binaries shipped with the image win, the commands
+    # dir itself is skipped by -ef
+    return '#!/bin/bash -e\n' \
+           'cmd=$(basename "$0")\n' \
+           'IFS=: read -ra dirs <<< "$PATH"\n' \
+           'for dir in "${dirs[@]}"; do\n' \
+           '  test -x "$dir/$cmd" && ! test "$dir/$cmd" -ef "$0" && exec "$dir/$cmd" "$@"\n' \
+           'done\n' \
+           'case "$cmd" in\n' \
+           '%s' \
+           '  *) echo "$cmd: command not found" >&2; exit 127 ;;\n' \
+           'esac\n' \
+           'exec "$(dirname "$0")/%s" "$image" "$@"\n' \
+           % (''.join("  %s) image='%s:%s' ;;\n" % (record.name, record.image_name, record.tags[0])
+                      for record in self.records),
+              CommandsProvisioner.RUNNER)
+
+  def __collect_garbage(self):
+    now = time.time()
+    for entry in os.listdir(self.base_dir):
+      path = '%s/%s' % (self.base_dir, entry)
+      max_age = CommandsProvisioner.MAX_TMP_AGE if entry.startswith('.') \
+        else CommandsProvisioner.MAX_IDLE
+      try:
+        if os.path.isdir(path) and now - os.stat(path).st_mtime > max_age:
+          logging.debug('Removing unused commands dir: %s' % path)
+          rmdir(path)
+      except OSError as e:
+        logging.debug('Failed to remove %s: %s' % (path, e))
+
+  # Everything the scripts are rendered from, so that they are only rendered for a new dir. The
+  # working dir is not, it is passed at run time
+  def __digest(self):
+    return hashlib.sha256(json.dumps([
+      CommandsProvisioner.TEMPLATE_VERSION,
+      self.mode,
+      self.plan.docker_client.docker_binary,
+      self.plan.environment,
+      [[mount.source, mount.target, mount.readonly]
+       for mount in self.plan.system_mounts + self.plan.user_mounts],
+      [[record.name, record.image_name, record.tags[:1]] for record in self.records]
+    ]).encode('utf-8')).hexdigest()[:32]
+
+  def __links(self):
+    if self.mode == CommandsProvisioner.MODE_DIRECTORY:
+      return {record.name: CommandsProvisioner.DISPATCHER for record in self.records}
+    return {}
+
+  def __publish(self, fn_scripts):
+    digest = self.__digest()
+    commands_dir = '%s/%s' % (self.base_dir, digest)
+
+    if os.path.isdir(commands_dir):
+      logging.debug('Reusing commands dir: %s' % commands_dir)
+      os.utime(commands_dir)
+      return commands_dir
+
+    tmp_dir = '%s/.%s.%d' % (self.base_dir, digest, os.getpid())
+    os.makedirs(tmp_dir)
+    for name, script in fn_scripts().items():
+      path = '%s/%s' % (tmp_dir, name)
+      logging.debug('Provisioning command: %s' % path)
+      with open(path, 'w') as f:
+        f.write(script.replace(CommandsProvisioner.COMMANDS_DIR_PLACEHOLDER, commands_dir))
+      st = os.stat(path)
+      os.chmod(path, st.st_mode | stat.S_IEXEC)
+    for name, target in self.__links().items():
+      # Relative, so that they resolve wherever the dir is mounted
+      os.symlink(target, '%s/%s' % (tmp_dir, name))
+
+    try:
+      os.rename(tmp_dir, commands_dir)
+      logging.debug('Created commands dir: %s' % commands_dir)
+    except OSError:
+      # Another process has published the same commands first
+      rmdir(tmp_dir)
+    self.__collect_garbage()
+    return commands_dir
+
+  # Returns the keyword arguments for LaunchPlan.with_commands that expose the commands
+  @traced('provision')
+  def provision(self):
+    logging.debug('Provisioning commands: %s' % self.records)
+
+    def scripts():
+      # The runner is rendered against a placeholder directory, which is replaced by the directory
+      # it is placed in, and runs in the working dir of the container that starts it
+      plan = self.plan.relocatable() \
+        .with_commands(**self.__mounts(CommandsProvisioner.COMMANDS_DIR_PLACEHOLDER))
+      scripts = {CommandsProvisioner.RUNNER: self.__runner(plan)}
+      if self.mode == CommandsProvisioner.MODE_DIRECTORY:
+        scripts[CommandsProvisioner.DISPATCHER] = self.__dispatcher()
+      else:
+        scripts.update({record.name: CommandsProvisioner.__script(record)
+                        for record in self.records})
+      return scripts
 
-    for placed_record in self.placed_records:
-      logging.debug('Provisioning command: %s:%s' % (
-        placed_record['record'].name, placed_record['record'].tags[0]))
-      file = open(placed_record['path'], 'w')
-      # why test -t 0 instead test -t 1:
-      # Specifying -t is forbidden when the client is receiving its standard input from a pipe
-      file.write(
-          '#!/bin/bash -e\n'
-          'cmd=$(basename ${BASH_SOURCE[0]})\n'
-          'test -x /sbin.orig/$cmd && exec /sbin.orig/$cmd "$@"\n'
-          'test -x /bin/$cmd && exec /bin/$cmd "$@"\n'
-          'test -t 0 && export USE_TTY="-t"\n'
-          'exec %s'
-          % (self.docker_client.run_command(image='%s:%s' % (
-            placed_record['record'].image_name, placed_record['record'].tags[0]),
-                                            arguments=["$@"],
-                                            auto_remove=True,
-                                            environment=self.env.environment(),
-                                            mounts=self.env.mounts(extra_mounts=self.extra_mounts,
-                                                                   placed_records=self.placed_records),
-                                            working_dir=self.env.workdir(),
-                                            custom='${USE_TTY}')))
-      file.close()
-      st = os.stat(placed_record['path'])
-      os.chmod(placed_record['path'], st.st_mode | stat.S_IEXEC)
+    return self.__mounts(self.__publish(scripts))
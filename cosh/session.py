@@ -0,0 +1,72 @@
+import logging
+import os
+
+from cosh.misc import Printable
+
+
+class HttpSession(Printable):
+  DEFAULT_POOL_SIZE = 8
+  DEFAULT_TIMEOUT = 30
+  DEFAULT_RETRIES = 3
+  DEFAULT_BACKOFF = 0.5
+  RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+  __default_instance = None
+
+  @classmethod
+  def default_instance(cls):
+    if not HttpSession.__default_instance:
+      HttpSession.__default_instance = HttpSession()
+    return HttpSession.__default_instance
+
+  def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+               retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.__session = None
+    self.__adapter = None
+    self.__pid = None
+
+  def session(self):
+    # Pooled connections must not be shared with a forked background refresh
+    if not self.__session or self.__pid != os.getpid():
+      # requests is only imported once a registry actually has to be contacted
+      import requests
+      from requests.adapters import HTTPAdapter
+      from urllib3.util.retry import Retry
+
+      self.__pid = os.getpid()
+      self.__adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                   pool_maxsize=self.pool_size,
+                                   max_retries=Retry(total=self.retries,
+                                                     backoff_factor=self.backoff,
+                                                     status_forcelist=HttpSession.RETRY_STATUSES))
+      self.__session = requests.Session()
+      self.__session.mount('https://', self.__adapter)
+      self.__session.mount('http://', self.__adapter)
+    return self.__session
+
+  def get(self, url, **kwargs):
+    kwargs.setdefault('timeout', self.timeout)
+    return self.session().get(url, **kwargs)
+
+  def stats(self):
+    connections = 0
+    requests_sent = 0
+    if self.__adapter:
+      pools = self.__adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools.get(key)
+        if pool:
+          connections += pool.num_connections
+          requests_sent += pool.num_requests
+    return {
+      'connections': connections,
+      'requests': requests_sent,
+      'reused': max(requests_sent - connections, 0)
+    }
+
+  def log_stats(self):
+    logging.debug('HTTP session stats: %s' % self.stats())
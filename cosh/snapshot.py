@@ -0,0 +1,127 @@
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from cosh.cache import func_ref_name, instance_key
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.files import atomic_write
+from cosh.misc import Printable
+
+
+def catalog_key(fn_ref):
+  return [func_ref_name(fn_ref), instance_key(fn_ref.__self__)]
+
+
+class CatalogSnapshot(Printable):
+  FORMAT = 'cosh-catalog-snapshot'
+  VERSION = 1
+
+  def __init__(self, catalogs, created=None):
+    # [{'key': catalog_key, 'timestamp': seconds, 'records': [DockerRepositoryRecord]}]
+    self.catalogs = catalogs
+    self.created = created if created else time.time()
+
+  def find(self, fn_ref):
+    key = catalog_key(fn_ref)
+    return next((catalog for catalog in self.catalogs if catalog['key'] == key), None)
+
+  def encode(self):
+    return gzip.compress(json.dumps({
+      'format': CatalogSnapshot.FORMAT,
+      'version': CatalogSnapshot.VERSION,
+      'created': self.created,
+      'catalogs': [{'key': catalog['key'],
+                    'timestamp': catalog['timestamp'],
+                    'records': [record.fields() for record in catalog['records']]}
+                   for catalog in self.catalogs]
+    }, separators=(',', ':')).encode('utf-8'))
+
+  @classmethod
+  def decode(cls, content):
+    try:
+      snapshot = json.loads(gzip.decompress(content).decode('utf-8'))
+    except (OSError, ValueError) as e:
+      raise Exception('Not a catalog snapshot: %s' % e)
+    if snapshot.get('format') != CatalogSnapshot.FORMAT:
+      raise Exception('Not a catalog snapshot')
+    if snapshot.get('version') != CatalogSnapshot.VERSION:
+      raise Exception('Unsupported catalog snapshot version %s, expected %d'
+                      % (snapshot.get('version'), CatalogSnapshot.VERSION))
+    return CatalogSnapshot(
+        catalogs=[{'key': catalog['key'],
+                   'timestamp': catalog['timestamp'],
+                   'records': [DockerRepositoryRecord.from_fields(fields)
+                               for fields in catalog['records']]}
+                  for catalog in snapshot['catalogs']],
+        created=snapshot['created'])
+
+  def write(self, file_name):
+    if file_name == '-':
+      sys.stdout.buffer.write(self.encode())
+      sys.stdout.buffer.flush()
+      return
+    with atomic_write(file_name, 'wb') as f:
+      f.write(self.encode())
+
+  @classmethod
+  def read(cls, file_name):
+    if file_name == '-':
+      return CatalogSnapshot.decode(sys.stdin.buffer.read())
+    with open(file_name, 'rb') as f:
+      return CatalogSnapshot.decode(f.read())
+
+
+# Serves catalogs from a snapshot file only, registries are never asked
+class SnapshotCache(Printable):
+  def __init__(self, file_name):
+    self.file_name = file_name
+    self.__snapshot = None
+    self.__mtime = None
+    self.__lock = threading.Lock()
+
+  def __catalog(self, fn_ref):
+    with self.__lock:
+      # A shared snapshot may be replaced while a daemon holds it
+      mtime = os.stat(self.file_name).st_mtime
+      if self.__snapshot is None or mtime != self.__mtime:
+        logging.debug('Loading catalog snapshot: %s' % self.file_name)
+        self.__snapshot = CatalogSnapshot.read(self.file_name)
+        self.__mtime = mtime
+      catalog = self.__snapshot.find(fn_ref)
+    if catalog is None:
+      logging.warning('%s/%s is not in catalog snapshot %s'
+                      % (fn_ref.__self__.name, fn_ref.__self__.namespace, self.file_name))
+    return catalog
+
+  def load(self, fn_ref, *fn_args):
+    catalog = self.__catalog(fn_ref)
+    return catalog['records'] if catalog else []
+
+  def merged(self, fn_refs, refresh=True):
+    records = {}
+    for fn_ref in fn_refs:
+      for record in self.load(fn_ref):
+        if record.tags:
+          records.setdefault(record.name, record)
+    return list(records.values())
+
+  def is_fresh(self, fn_ref, *fn_args):
+    return True
+
+  def revalidate(self, fn_ref, *fn_args):
+    pass
+
+  def cached(self, fn_ref, *fn_args):
+    catalog = self.__catalog(fn_ref)
+    return catalog['records'] if catalog else None
+
+  def timestamp(self, fn_ref, *fn_args):
+    catalog = self.__catalog(fn_ref)
+    return catalog['timestamp'] if catalog else None
+
+  def find(self, fn_ref, name, *fn_args):
+    return next((record for record in self.load(fn_ref) if record.name == name), None)
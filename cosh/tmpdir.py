@@ -31,6 +31,9 @@ class Tmpdir(Printable):
     self.__basedir = basedir
     self.__tmpdir = '%s/cosh' % self.__basedir
     self.__bindir = '%s/bin' % self.__tmpdir
+    self.__warmdir = '%s/warm' % self.__tmpdir
+    self.__artifactdir = '%s/artifacts' % self.__tmpdir
+    self.__tokendir = '%s/tokens' % self.__tmpdir
     self.__cachedir = cachedir if cachedir else '%s/cache' % self.__tmpdir
 
   def base(self):
@@ -44,6 +47,21 @@ class Tmpdir(Printable):
     Tmpdir.__create(self.__bindir)
     return self.__bindir
 
+  def warm(self):
+    Tmpdir.__create(self.__warmdir)
+    return self.__warmdir
+
+  def artifacts(self):
+    Tmpdir.__create(self.__artifactdir)
+    return self.__artifactdir
+
+  # Created by TokenCache when the first token is stored
+  def tokens(self):
+    return self.__tokendir
+
   def cache(self):
     Tmpdir.__create(self.__cachedir)
     return self.__cachedir
+
+  def history(self):
+    return '%s/history' % self.tmp()
@@ -0,0 +1,146 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from cosh.files import atomic_write
+from cosh.misc import Printable
+
+# Close enough to the process start, cosh imports this module first thing
+STARTED = time.time()
+
+
+class Span:
+  def __init__(self, tracer, name, category, args):
+    self.tracer = tracer
+    self.name = name
+    self.category = category
+    self.args = args
+    self.start = None
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.tracer.record(self.name, self.category, self.start, time.time() - self.start, self.args)
+
+
+class NoSpan:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    pass
+
+
+class Tracer(Printable):
+  __default_instance = None
+
+  @classmethod
+  def default_instance(cls):
+    if not Tracer.__default_instance:
+      Tracer.__default_instance = Tracer.from_environment()
+    return Tracer.__default_instance
+
+  # COSH_TRACE=1 prints a summary, any other value is the trace file or directory to write
+  @classmethod
+  def from_environment(cls):
+    trace = os.environ.get('COSH_TRACE')
+    if not trace or trace in ('0', 'false'):
+      return Tracer()
+    if trace in ('1', 'true'):
+      return Tracer(summary=True)
+    return Tracer(trace_file=trace)
+
+  def __init__(self, summary=False, trace_file=None):
+    self.summary = summary
+    self.trace_file = trace_file
+    self.enabled = summary or bool(trace_file)
+    self.started = STARTED
+    self.__events = []
+    self.__lock = threading.Lock()
+
+  def enable(self, summary=False, trace_file=None):
+    self.summary = self.summary or summary
+    self.trace_file = self.trace_file or trace_file
+    self.enabled = self.summary or bool(self.trace_file)
+
+  def span(self, name, category='cosh', **args):
+    return Span(self, name, category, args) if self.enabled else NoSpan()
+
+  def record(self, name, category, start, duration, args):
+    event = {
+      'name': name,
+      'cat': category,
+      'ph': 'X',
+      'ts': int((start - self.started) * 1000000),
+      'dur': int(duration * 1000000),
+      'pid': os.getpid(),
+      'tid': threading.get_ident(),
+      'args': args
+    }
+    with self.__lock:
+      self.__events += [event]
+
+  def events(self):
+    with self.__lock:
+      return list(self.__events)
+
+  def totals(self):
+    totals = {}
+    for event in self.events():
+      count, duration = totals.get(event['name'], (0, 0))
+      totals[event['name']] = (count + 1, duration + event['dur'])
+    return totals
+
+  def __trace_file_name(self):
+    if os.path.isdir(self.trace_file):
+      # One file per invocation, so that traces of a whole fleet can be collected in one place
+      return '%s/cosh-%d-%d.json' % (self.trace_file.rstrip('/'), self.started * 1000, os.getpid())
+    return self.trace_file
+
+  def write(self):
+    file_name = self.__trace_file_name()
+    with atomic_write(file_name) as f:
+      json.dump({
+        'traceEvents': self.events(),
+        'displayTimeUnit': 'ms',
+        'otherData': {'started': self.started}
+      }, f)
+    return file_name
+
+  def report(self):
+    if not self.enabled:
+      return
+    if self.summary:
+      # Spans nest, so totals of different phases overlap
+      for name, (count, duration) in sorted(self.totals().items(),
+                                            key=lambda item: item[1][1], reverse=True):
+        logging.info('%-40s %5d calls %10.1fms' % (name, count, duration / 1000.0))
+      logging.info('%-40s %22.1fms' % ('total', (time.time() - self.started) * 1000))
+    if self.trace_file:
+      try:
+        logging.debug('Wrote trace: %s' % self.write())
+      except OSError as e:
+        logging.warning('Failed to write trace to %s: %s' % (self.trace_file, e))
+
+
+def traced(category):
+  def decorator(fn):
+    # Private methods are reported by their plain name
+    name = fn.__qualname__.replace('.__', '.')
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      tracer = Tracer.default_instance()
+      if not tracer.enabled:
+        return fn(*args, **kwargs)
+      # The first string argument, i.e. an image name, tells calls of the same function apart
+      argument = next((arg for arg in args[1:2] if isinstance(arg, str)), None)
+      with tracer.span(name, category, **({'argument': argument} if argument else {})):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
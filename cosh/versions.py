@@ -0,0 +1,151 @@
+import re
+from fnmatch import fnmatchcase
+
+from cosh.misc import Printable
+
+RELEASE = re.compile(r'^v?(\d+(?:\.\d+)*)(.*)$')
+CONSTRAINT = re.compile(r'^(\^|~|>=|<=|>|<|=)?v?(\d+(?:\.\d+)*)(?:\.[xX*])?$')
+RELEASE_PARTS = 4
+# Suffixes of pre-releases, which version constraints never resolve to. Globs still match them
+PRERELEASE = re.compile(r'(?:^|[-._])(?:alpha|beta|rc|pre|preview|dev|snapshot|a|b)(?:\d|[-._]|$)',
+                        re.IGNORECASE)
+
+
+def parse_release(tag):
+  match = RELEASE.match(tag)
+  if not match:
+    return None, None
+  return tuple(int(part) for part in match.group(1).split('.')), match.group(2)
+
+
+def is_prerelease(suffix):
+  return PRERELEASE.search(suffix) is not None
+
+
+def pad(release):
+  return tuple(release[:RELEASE_PARTS]) + (0,) * (RELEASE_PARTS - len(release))
+
+
+def bump(release):
+  return release[:-1] + (release[-1] + 1,)
+
+
+def is_constraint(spec):
+  return any(character in spec for character in '^~<>=*? ,')
+
+
+# Turns a constraint into a [lower, upper) release interval. Partial versions are ranges,
+# i.e. <=1.2 is <1.3 and ^0.2 is >=0.2 <0.3
+def bounds(spec):
+  lower = None
+  upper = None
+  for token in spec.replace(',', ' ').split():
+    match = CONSTRAINT.match(token)
+    if not match:
+      raise Exception('Invalid version constraint: %s' % spec)
+    operator, release = match.group(1), tuple(int(part) for part in match.group(2).split('.'))
+
+    if operator == '^':
+      nonzero = [i for i, part in enumerate(release) if part]
+      token_lower, token_upper = release, bump(release[:nonzero[0] + 1] if nonzero else release)
+    elif operator == '~':
+      token_lower, token_upper = release, bump(release[:2] if len(release) > 1 else release)
+    elif operator == '>=':
+      token_lower, token_upper = release, None
+    elif operator == '>':
+      token_lower, token_upper = bump(release), None
+    elif operator == '<':
+      token_lower, token_upper = None, release
+    elif operator == '<=':
+      token_lower, token_upper = None, bump(release)
+    else:
+      token_lower, token_upper = release, bump(release)
+
+    if token_lower is not None:
+      lower = max(lower, pad(token_lower)) if lower else pad(token_lower)
+    if token_upper is not None:
+      upper = min(upper, pad(token_upper)) if upper else pad(token_upper)
+  return lower, upper
+
+
+class VersionIndex(Printable):
+  FIELDS = 3
+
+  def __init__(self, tags, release_order, variant_order, name_order):
+    self.tags = tags
+    # Positions of plain release tags, i.e. 3.6.1, sorted by release
+    self.release_order = release_order
+    # Positions of suffixed tags that are not pre-releases, i.e. 3.6.1-alpine, sorted by release
+    self.variant_order = variant_order
+    # Tag positions sorted by name
+    self.name_order = name_order
+
+  @classmethod
+  def build(cls, tags):
+    releases = []
+    variants = []
+    for position, (release, suffix) in enumerate(parse_release(tag) for tag in tags):
+      if release is None or is_prerelease(suffix):
+        continue
+      # Tags are naturally sorted, highest first, so a lower position wins a tie
+      (variants if suffix else releases).append((pad(release), -position))
+    return VersionIndex(tags=tags,
+                        release_order=[-position for _, position in sorted(releases)],
+                        variant_order=[-position for _, position in sorted(variants)],
+                        name_order=sorted(range(len(tags)), key=lambda position: tags[position]))
+
+  # None for fields of an older layout, the index is then built again
+  @classmethod
+  def from_fields(cls, tags, fields):
+    return VersionIndex(tags, *fields) if len(fields) == VersionIndex.FIELDS else None
+
+  def fields(self):
+    return [self.release_order, self.variant_order, self.name_order]
+
+  def __release(self, order, order_position):
+    return pad(parse_release(self.tags[order[order_position]])[0])
+
+  def __count_below(self, order, upper):
+    low, high = 0, len(order)
+    while low < high:
+      middle = (low + high) // 2
+      if self.__release(order, middle) < upper:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def __match(self, pattern):
+    prefix = re.split(r'[*?\[]', pattern, 1)[0]
+    low, high = 0, len(self.name_order)
+    while low < high:
+      middle = (low + high) // 2
+      if self.tags[self.name_order[middle]] < prefix:
+        low = middle + 1
+      else:
+        high = middle
+
+    best = None
+    for position in self.name_order[low:]:
+      tag = self.tags[position]
+      if not tag.startswith(prefix):
+        break
+      if fnmatchcase(tag, pattern) and (best is None or position < best):
+        best = position
+    return self.tags[best] if best is not None else None
+
+  def __highest(self, order, lower, upper):
+    count = self.__count_below(order, upper) if upper else len(order)
+    if not count or (lower and self.__release(order, count - 1) < lower):
+      return None
+    return self.tags[order[count - 1]]
+
+  # Returns the best tag matching a glob or a version constraint, None if there is none.
+  # Constraints resolve to the highest plain release, suffixed tags are only used without one
+  def resolve(self, spec):
+    if any(character in spec for character in '*?['):
+      return self.__match(spec)
+
+    lower, upper = bounds(spec)
+    return self.__highest(self.release_order, lower, upper) or \
+      self.__highest(self.variant_order, lower, upper)
@@ -44,14 +44,14 @@ setup(
   license=license,
   packages=find_packages(exclude=('tests', 'docs')),
   scripts=[
-    'bin/cosh'
+    'bin/cosh',
+    'bin/coshd'
   ],
   install_requires=[
     'argparse==1.4.0',
     'requests==2.21.0',
     'google-auth==1.5.1',
-    'natsort==5.3.3',
-    'jsonpickle==0.9.6'
+    'natsort==5.3.3'
   ],
   classifiers=[
     'Development Status :: 3 - Alpha',
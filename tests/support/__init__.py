@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+from cosh import args as cosh_args
+from cosh.cache import FileCache
+from cosh.docker import DockerMount
+from cosh.docker.repositories import DockerRepositoryRecord, DockerRepositoryV1, DockerStore, \
+  natsorted
+from cosh.provisioners import DockerProvisioner
+
+from tests.support.fake_registry import FakeGcrRepository, PlainHttpSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FAKE_DOCKER = '%s/fake_docker' % os.path.dirname(os.path.abspath(__file__))
+
+KWARGS = {
+  'auto_remove': True,
+  'environment': ['HOME=/root', 'PATH'],
+  'mounts': [DockerMount(source='/tmp', target='/tmp'),
+             DockerMount(source='/tmp', target='/opt/tmp', readonly=True)],
+  'working_dir': '/tmp'
+}
+
+HEAVY_MODULES = ['requests', 'urllib3', 'google.auth', 'natsort', 'jsonpickle', 'tarfile']
+
+# Resolves and plans a command from a warm cache, the way bin/cosh does without a daemon
+WARM_START = '''
+import json
+import sys
+import time
+
+started = time.time()
+from cosh import args as cosh_args
+
+args = cosh_args.parse(sys.argv[1:])
+instance = cosh_args.create_cosh(args,
+                                 cosh_args.create_cache(args),
+                                 cosh_args.create_repositories(args, cosh_args.create_http(args)))
+instance.plan(args.command, args.arguments)
+elapsed = time.time() - started
+print(json.dumps({'elapsed': elapsed,
+                  'modules': [module for module in %r if module in sys.modules]}))
+''' % HEAVY_MODULES
+
+
+def repository(kind, host, http):
+  if kind == 'v1':
+    return DockerRepositoryV1(namespace='actions', name=host, http=http)
+  if kind == 'gcr':
+    return FakeGcrRepository(namespace='actions', name=host, http=http)
+  return DockerStore(namespace='actions', name=host, http=http)
+
+
+def records(size, tags=['1.0']):
+  return [DockerRepositoryRecord(repository=None, namespace='actions', name='image%d' % i,
+                                 tags=tags) for i in range(size)]
+
+
+def tags(majors, minors, patches):
+  return natsorted(['%d.%d.%d%s' % (major, minor, patch, suffix)
+                    for major in range(majors)
+                    for minor in range(minors)
+                    for patch in range(patches)
+                    for suffix in ('', '-alpine', '-slim')] +
+                   ['8-jre', '8-jdk', 'latest'], reverse=True)
+
+
+# A tmpdir holding the static docker binary, so that nothing is downloaded
+def cosh_tmpdir(prefix='cosh-test-'):
+  tmpdir = tempfile.mkdtemp(prefix=prefix)
+  docker = '%s/cosh/artifacts/%s/%s' % (tmpdir, DockerProvisioner.DOCKER_STATIC_SHA256,
+                                        DockerProvisioner.DOCKER_MEMBER)
+  os.makedirs(os.path.dirname(docker))
+  open(docker, 'w').close()
+  return tmpdir
+
+
+# Same, with a fresh catalog of the images image0 to image<images - 1> cached
+def warm_tmpdir(images, prefix='cosh-test-'):
+  tmpdir = cosh_tmpdir(prefix)
+  os.makedirs('%s/cosh/cache' % tmpdir)
+  FileCache(cachedir='%s/cosh/cache' % tmpdir).store(
+      DockerStore(namespace='actions').list, records(images, ['1.%d' % tag for tag in range(30)]))
+  return tmpdir
+
+
+# A Cosh instance that lists the store repository of the fake registry
+def create_cosh(registry, tmpdir, *argv):
+  args = cosh_args.parse(['--tmpdir', tmpdir, '--docker-binary', 'true', '--no-history'] +
+                         list(argv) + ['image0'])
+  return cosh_args.create_cosh(args,
+                               cosh_args.create_cache(args),
+                               [repository('store', registry.host(), PlainHttpSession())])
+
+
+# Runs bin/cosh against the fake docker binary, returns its status and output
+def run_cosh(env, tmpdir, *argv, stdin=None):
+  process = subprocess.run([sys.executable, '%s/bin/cosh' % ROOT, '--tmpdir', tmpdir,
+                            '--docker-binary', FAKE_DOCKER] + list(argv),
+                           env=env, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  return process.returncode, process.stdout.decode('utf-8')
+
+
+class Captured:
+  # Container output is written straight to the process file descriptors
+  def __init__(self, stdin=b''):
+    self.stdin = stdin
+    self.stdout = None
+    self.stderr = None
+
+  def __enter__(self):
+    self.__saved = [os.dup(fd) for fd in (0, 1, 2)]
+    self.__files = [tempfile.TemporaryFile() for _ in range(3)]
+    self.__files[0].write(self.stdin)
+    self.__files[0].seek(0)
+    for fd, f in enumerate(self.__files):
+      os.dup2(f.fileno(), fd)
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    for fd, saved in enumerate(self.__saved):
+      os.dup2(saved, fd)
+      os.close(saved)
+    self.__files[1].seek(0)
+    self.__files[2].seek(0)
+    self.stdout = self.__files[1].read()
+    self.stderr = self.__files[2].read()
+    for f in self.__files:
+      f.close()
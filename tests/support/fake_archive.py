@@ -0,0 +1,63 @@
+import io
+import os
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from cosh.mirror import ThreadingHTTPServer
+
+
+def archive(size):
+  content = io.BytesIO()
+  with tarfile.open(fileobj=content, mode='w:gz') as tgz:
+    for name in ('docker/containerd', 'docker/docker', 'docker/runc'):
+      data = os.urandom(size)
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mode = 0o755
+      tgz.addfile(info, io.BytesIO(data))
+  return content.getvalue()
+
+
+class ArchiveServer:
+  def __init__(self, content, delay=0.2):
+    self.content = content
+    self.delay = delay
+    self.requests = []
+    # Connections are cut after this many bytes, to simulate an interrupted download
+    self.cut_after = None
+    self.__server = None
+
+  def url(self):
+    return 'http://%s:%d/docker.tgz' % self.__server.server_address
+
+  def start(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, format, *args):
+        pass
+
+      def do_GET(self):
+        server.requests += [self.headers.get('Range')]
+        time.sleep(server.delay)
+        offset = int(self.headers['Range'][len('bytes='):-1]) if self.headers.get('Range') else 0
+        if offset >= len(server.content):
+          self.send_response(416)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        body = server.content[offset:]
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:server.cut_after] if server.cut_after else body)
+
+    self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
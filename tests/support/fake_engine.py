@@ -0,0 +1,146 @@
+import json
+import os
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeContainer:
+  def __init__(self, config):
+    self.config = config
+    self.started = threading.Event()
+    self.done = threading.Event()
+    self.status = None
+
+
+# Speaks just enough of the docker engine api for DockerEngineClient. Containers run the
+# first argument as a builtin: cat copies stdin, exit <n> fails, anything else echoes
+class FakeEngine:
+  def __init__(self, socket_path, images=[], layer_size=1024):
+    self.socket_path = socket_path
+    self.images = set(images)
+    self.layer_size = layer_size
+    self.containers = {}
+    self.requests = []
+    self.__server = None
+
+  def __run(self, container, read, write):
+    arguments = container.config.get('Cmd') or []
+    tty = container.config.get('Tty')
+
+    def output(stream, data):
+      write(data if tty else struct.pack('>BxxxI', stream, len(data)) + data)
+
+    if arguments[:1] == ['cat']:
+      for data in iter(lambda: read(4096), b''):
+        output(1, data)
+      return 0
+    if arguments[:1] == ['exit']:
+      output(2, b'exiting\n')
+      return int(arguments[1])
+    output(1, (' '.join(arguments) + '\n').encode('utf-8'))
+    return 0
+
+  def handle(self, method, path, body, handler):
+    self.requests += ['%s %s' % (method, path)]
+    url = urlparse(path)
+    query = parse_qs(url.query)
+    parts = url.path.strip('/').split('/')[1:]
+
+    if parts == ['images', 'create']:
+      self.images.add('%s:%s' % (query['fromImage'][0], query.get('tag', ['latest'])[0]))
+      return 200, ''.join(json.dumps({'status': 'Downloading', 'id': layer,
+                                      'progressDetail': {'current': current,
+                                                         'total': self.layer_size}}) + '\n'
+                          for layer in ('layer0', 'layer1')
+                          for current in (self.layer_size // 2, self.layer_size)).encode('utf-8')
+    if method == 'GET' and parts[:1] == ['images'] and parts[-1:] == ['json']:
+      if '/'.join(parts[1:-1]) not in self.images:
+        return 404, b'{"message":"No such image"}'
+      return 200, b'{}'
+    if parts == ['containers', 'create']:
+      config = json.loads(body.decode('utf-8'))
+      if config['Image'] not in self.images:
+        return 404, json.dumps({'message': 'No such image: %s' % config['Image']}).encode('utf-8')
+      container_id = 'container%d' % len(self.containers)
+      self.containers[container_id] = FakeContainer(config)
+      return 201, json.dumps({'Id': container_id}).encode('utf-8')
+
+    container = self.containers.get(parts[1]) if len(parts) > 1 else None
+    if not container:
+      return 404, b'{"message":"No such container"}'
+    action = parts[2] if len(parts) > 2 else None
+
+    if action == 'attach':
+      handler.send_response(101)
+      handler.send_header('Connection', 'Upgrade')
+      handler.send_header('Upgrade', 'tcp')
+      handler.end_headers()
+      handler.wfile.flush()
+      container.started.wait()
+      status = self.__run(container, handler.rfile.read1, handler.wfile.write)
+      if not container.done.is_set():
+        container.status = status
+        container.done.set()
+      handler.close_connection = True
+      return None, None
+    if action == 'start':
+      container.started.set()
+      return 204, b''
+    if action == 'wait':
+      container.done.wait()
+      return 200, json.dumps({'StatusCode': container.status}).encode('utf-8')
+    if action == 'kill':
+      container.status = 137
+      container.done.set()
+      return 204, b''
+    if action == 'resize':
+      return 200, b''
+    if method == 'DELETE' and action is None:
+      del self.containers[parts[1]]
+      return 204, b''
+    return 404, b'{"message":"Not implemented"}'
+
+  def start(self):
+    engine = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, format, *args):
+        pass
+
+      def __handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        status, content = engine.handle(method, self.path, self.rfile.read(length), self)
+        if status is None:
+          return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if content:
+          self.wfile.write(content)
+
+      def do_GET(self):
+        self.__handle('GET')
+
+      def do_POST(self):
+        self.__handle('POST')
+
+      def do_DELETE(self):
+        self.__handle('DELETE')
+
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+    self.__server = ThreadingUnixStreamServer(self.socket_path, Handler)
+    self.__server.daemon_threads = True
+    threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
+    os.remove(self.socket_path)
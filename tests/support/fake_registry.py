@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+from cosh.docker.repositories import DockerRepositoryGcr
+from cosh.mirror import ThreadingHTTPServer
+from cosh.session import HttpSession
+
+
+class PlainHttpSession(HttpSession):
+  # Repository clients always speak https, the fake registry only plain http
+  def get(self, url, **kwargs):
+    return super().get(url.replace('https://', 'http://', 1), **kwargs)
+
+
+class RecordingHttpSession(PlainHttpSession):
+  def __init__(self):
+    super().__init__()
+    # (status code, body size) of every response
+    self.responses = []
+
+  def get(self, url, **kwargs):
+    response = super().get(url, **kwargs)
+    self.responses += [(response.status_code, len(response.content))]
+    return response
+
+
+class FakeGcrRepository(DockerRepositoryGcr):
+  # The fake registry accepts any bearer token, so no google credentials are needed
+  def token(self):
+    return 'fake'
+
+
+class FakeRegistry:
+  def __init__(self, images=20, tags=30, page_size=10, latency=0):
+    self.images = images
+    self.tags = tags
+    self.page_size = page_size
+    # Seconds every response is delayed by, to simulate a remote registry
+    self.latency = latency
+    self.requests = []
+    self.revisions = {}
+    # Names of the images whose tags requests fail
+    self.failing = set()
+    self.__server = None
+
+  def touch(self, image_name):
+    self.revisions[image_name] = self.revisions.get(image_name, 0) + 1
+
+  def __revision(self, image_name):
+    return self.revisions.get(image_name, 0)
+
+  def host(self):
+    return '%s:%d' % self.__server.server_address
+
+  def image_names(self):
+    return ['image%d' % i for i in range(self.images)]
+
+  def __page(self, base_url, items, page):
+    start = (page - 1) * self.page_size
+    return {
+      'count': len(items),
+      'next': ('%s&page=%d' % (base_url, page + 1)) if start + self.page_size < len(items) else None,
+      'results': items[start:start + self.page_size]
+    }
+
+  def handle(self, path, headers={}):
+    self.requests += [path]
+    url = urlparse(path)
+    page = int(parse_qs(url.query).get('page', ['1'])[0])
+    parts = url.path.strip('/').split('/')
+    base_url = 'http://%s%s?page_size=%d' % (self.host(), url.path, self.page_size)
+
+    # /v2/repositories/<namespace>
+    if parts[:2] == ['v2', 'repositories'] and len(parts) == 3:
+      return 200, self.__page(base_url,
+                              [{'name': name,
+                                'namespace': parts[2],
+                                'last_updated': '2018-08-15T00:00:%02dZ' % self.__revision(name)}
+                               for name in self.image_names()],
+                              page), {}
+    # /v2/repositories/<namespace>/<image>/tags
+    if parts[:2] == ['v2', 'repositories'] and len(parts) == 5 and parts[4] == 'tags':
+      if parts[3] not in self.image_names():
+        return 404, {'detail': 'Not found'}, {}
+      if parts[3] in self.failing:
+        return 403, {'detail': 'Forbidden'}, {}
+      etag = '"%s-%d"' % (parts[3], self.__revision(parts[3]))
+      if page == 1 and headers.get('If-None-Match') == etag:
+        return 304, None, {'ETag': etag}
+      return 200, self.__page(base_url,
+                              [{'name': '1.%d' % i} for i in range(self.tags)],
+                              page), {'ETag': etag}
+
+    # /v1, probed by the repository factory
+    if parts == ['v1']:
+      return 200, {}, {}
+    # /v1/search?q=<namespace>&page=<page>
+    if parts == ['v1', 'search']:
+      names = self.image_names()
+      pages = max((len(names) + self.page_size - 1) // self.page_size, 1)
+      start = (page - 1) * self.page_size
+      return 200, {'num_pages': pages,
+                   'page': page,
+                   'results': [{'name': '%s/%s' % (self.host(), name)}
+                               for name in names[start:start + self.page_size]]}, {}
+    # /v1/repositories/<namespace>/<image>/tags
+    if parts[:2] == ['v1', 'repositories'] and len(parts) == 5 and parts[4] == 'tags':
+      return self.__tags(parts[3], headers, lambda tags: [{'name': tag} for tag in tags])
+
+    # gcr: /v2/<namespace>/tags/list and /v2/<namespace>/<image>/tags/list
+    if parts[0] == 'v2' and parts[-2:] == ['tags', 'list'] and len(parts) == 4:
+      return 200, {'child': self.image_names(), 'tags': []}, {}
+    if parts[0] == 'v2' and parts[-2:] == ['tags', 'list'] and len(parts) == 5:
+      return self.__tags(parts[2], headers, lambda tags: {'tags': tags})
+    return 404, {'detail': 'Not found'}, {}
+
+  def __tags(self, image_name, headers, fn_body):
+    if image_name not in self.image_names():
+      return 404, {'detail': 'Not found'}, {}
+    if image_name in self.failing:
+      return 403, {'detail': 'Forbidden'}, {}
+    etag = '"%s-%d"' % (image_name, self.__revision(image_name))
+    if headers.get('If-None-Match') == etag:
+      return 304, None, {'ETag': etag}
+    return 200, fn_body(['1.%d' % i for i in range(self.tags)]), {'ETag': etag}
+
+  def start(self):
+    registry = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      # Headers and body are separate writes, delayed acks would stall every response
+      disable_nagle_algorithm = True
+
+      def log_message(self, format, *args):
+        pass
+
+      def do_GET(self):
+        if registry.latency:
+          time.sleep(registry.latency)
+        status, body, headers = registry.handle(self.path, self.headers)
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+          self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
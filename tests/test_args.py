@@ -0,0 +1,30 @@
+import unittest
+
+from cosh import args as cosh_args
+
+
+class ParseCommandTest(unittest.TestCase):
+  def parse_command(self, argv):
+    return cosh_args.parse_command(cosh_args.parse(argv))
+
+  def test_commands_have_no_arguments_to_parse(self):
+    self.assertIsNone(self.parse_command(['git', 'status', '--help']))
+
+  def test_prefetch(self):
+    prefetch_args = self.parse_command(['prefetch', '--top', '5', 'git'])
+    self.assertEqual((prefetch_args.top, prefetch_args.commands), (5, ['git']))
+
+  def test_catalog_needs_an_action(self):
+    with self.assertRaises(SystemExit) as context:
+      self.parse_command(['catalog'])
+    self.assertEqual(context.exception.code, 2)
+    self.assertEqual(self.parse_command(['catalog', 'import', 'file']).action, 'import')
+
+  def test_usage_errors_exit_before_anything_is_set_up(self):
+    with self.assertRaises(SystemExit) as context:
+      self.parse_command(['prefetch', '--top', 'many'])
+    self.assertEqual(context.exception.code, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from cosh.provisioners import ArtifactStore
+
+from tests.support.fake_archive import ArchiveServer, archive
+
+
+def provision(store_dir, url, sha256):
+  return ArtifactStore(store_dir).provision(url, sha256, ['docker/docker'])
+
+
+class ArtifactStoreTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.content = archive(64 * 1024)
+    cls.sha256 = hashlib.sha256(cls.content).hexdigest()
+
+  def setUp(self):
+    self.server = ArchiveServer(ArtifactStoreTest.content, delay=0.2).start()
+    self.store_dir = tempfile.mkdtemp(prefix='cosh-test-')
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.store_dir)
+
+  def provision(self, sha256=None):
+    return provision(self.store_dir, self.server.url(), sha256 or ArtifactStoreTest.sha256)
+
+  def test_concurrent_processes_share_a_download(self):
+    sha256 = ArtifactStoreTest.sha256
+    with multiprocessing.Pool(8) as pool:
+      paths = pool.starmap(provision, [(self.store_dir, self.server.url(), sha256)] * 8)
+    self.assertEqual(len(self.server.requests), 1)
+    self.assertTrue(all(path == paths[0] for path in paths), paths)
+    self.assertEqual(set(os.listdir(self.store_dir)), {sha256, '%s.lock' % sha256})
+    self.assertEqual(os.listdir('%s/%s/docker' % (self.store_dir, sha256)), ['docker'])
+    self.assertTrue(os.access(paths[0]['docker/docker'], os.X_OK))
+
+  def test_interrupted_download_resumes(self):
+    half = len(ArtifactStoreTest.content) // 2
+    self.server.delay = 0
+    self.server.cut_after = half
+    with self.assertRaises(Exception):
+      self.provision()
+    self.server.cut_after = None
+    self.provision()
+    self.assertEqual(self.server.requests[-1], 'bytes=%d-' % half)
+
+  def test_checksum_mismatch_is_not_published(self):
+    self.server.delay = 0
+    with self.assertRaisesRegex(Exception, 'sha256 mismatch'):
+      self.provision('0' * 64)
+    self.assertFalse(os.path.exists('%s/%s' % (self.store_dir, '0' * 64)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cosh.batch import parse_jobs
+
+from tests.support import ROOT, run_cosh, warm_tmpdir
+
+JOBS = 4
+
+
+class BatchTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = warm_tmpdir(JOBS)
+    self.docker_state = tempfile.mkdtemp(prefix='cosh-test-docker-')
+    self.env = dict(os.environ, PYTHONPATH=ROOT, COSH_NO_DAEMON='1',
+                    FAKE_DOCKER_STATE=self.docker_state, FAKE_DOCKER_START_DELAY='0')
+    self.lines = ''.join('image%d job%d\n' % (i, i) for i in range(JOBS)).encode('utf-8')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    shutil.rmtree(self.docker_state)
+
+  def test_jobs_are_parsed_one_per_line(self):
+    self.assertEqual(parse_jobs(['git status', '', '# comment', "echo 'a b' # c"]),
+                     [('git', ['status']), ('echo', ["'a b'"])])
+
+  def test_output_lines_are_prefixed_with_the_job(self):
+    status, output = run_cosh(self.env, self.tmpdir, '--batch', '-', '-j', '2', stdin=self.lines)
+    self.assertEqual(status, 0)
+    self.assertEqual(sorted(output.splitlines()),
+                     sorted('[%d image%d] job%d' % (i + 1, i, i) for i in range(JOBS)))
+
+  def test_first_failure_skips_the_jobs_that_did_not_start(self):
+    status, output = run_cosh(self.env, self.tmpdir, '--batch', '-', '-j', '1',
+                          stdin=b'missing\n' + self.lines)
+    self.assertEqual((status, len(output.splitlines())), (127, 1), output)
+
+  def test_keep_going_runs_all_jobs(self):
+    status, output = run_cosh(self.env, self.tmpdir, '--batch', '-', '-j', '1', '-k',
+                          stdin=b'missing\n' + self.lines)
+    self.assertEqual((status, len(output.splitlines())), (127, JOBS + 1), output)
+
+
+if __name__ == '__main__':
+  unittest.main()
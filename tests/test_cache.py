@@ -0,0 +1,147 @@
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cosh.cache import FileCache
+from cosh.catalog import Catalog
+from cosh.docker.repositories import DockerRepositoryRecord
+from cosh.files import FileLock
+
+from tests.support import repository
+from tests.support.fake_registry import FakeRegistry, PlainHttpSession
+
+
+def load(host, cachedir, start, results):
+  start.wait()
+  records = FileCache(cachedir=cachedir, ttl=60, max_stale=0).load(
+      repository('store', host, PlainHttpSession()).list)
+  results.put(len(records))
+
+
+class BrokenRepository:
+  def __init__(self):
+    self.name = 'broken'
+    self.namespace = 'actions'
+
+  def list(self):
+    raise Exception('Registry is down')
+
+
+class FileCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.registry = FakeRegistry(images=4, tags=3).start()
+    self.cachedir = tempfile.mkdtemp(prefix='cosh-test-')
+    self.repository = repository('store', self.registry.host(), PlainHttpSession())
+
+  def tearDown(self):
+    self.registry.stop()
+    shutil.rmtree(self.cachedir)
+
+  def listings(self):
+    return len([path for path in self.registry.requests
+                if path.startswith('/v2/repositories/actions?') and '&page=' not in path])
+
+  def test_concurrent_loads_refresh_once(self):
+    start = multiprocessing.Barrier(8)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=load,
+                                         args=(self.registry.host(), self.cachedir, start, results))
+                 for _ in range(8)]
+    for process in processes:
+      process.start()
+    sizes = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+      process.join()
+    self.assertEqual(sizes, [4] * 8)
+    self.assertEqual(self.listings(), 1)
+
+  def test_stale_catalog_is_served_while_one_refresh_runs(self):
+    cache = FileCache(cachedir=self.cachedir, ttl=0, max_stale=3600)
+    records = cache.load(self.repository.list)
+    timestamp = cache.timestamp(self.repository.list)
+    self.registry.latency = 0.5
+    started = time.time()
+    for _ in range(3):
+      self.assertEqual(len(cache.load(self.repository.list)), len(records))
+    self.assertLess(time.time() - started, self.registry.latency)
+
+    # The detached refresh replaces the catalog once the registry answered
+    deadline = time.time() + 30
+    while cache.timestamp(self.repository.list) == timestamp and time.time() < deadline:
+      time.sleep(0.05)
+    for lock in glob.glob('%s/*.lock' % self.cachedir):
+      with FileLock(lock):
+        pass
+    self.assertGreater(cache.timestamp(self.repository.list), timestamp)
+    self.assertEqual(self.listings(), 2)
+
+  def test_merge_closes_catalogs_when_a_refresh_fails(self):
+    cache = FileCache(cachedir=self.cachedir)
+    cache.load(self.repository.list)
+    close = Catalog.close
+    with mock.patch.object(Catalog, 'close', autospec=True, side_effect=close) as closed:
+      with self.assertRaisesRegex(Exception, 'Registry is down'):
+        cache.merged([self.repository.list, BrokenRepository().list])
+    self.assertEqual(closed.call_count, 1)
+
+  def test_mapped_catalog_survives_a_rewrite(self):
+    file_name = '%s/test.catalog' % self.cachedir
+    record = DockerRepositoryRecord(repository='r', namespace='n', name='image0', tags=['1.0'])
+    Catalog.write(file_name, key='key', timestamp=1, records=[record])
+    with Catalog.open(file_name) as catalog:
+      Catalog.write(file_name, key='key', timestamp=2, records=[])
+      self.assertEqual([record.name for record in catalog.records()], ['image0'])
+    with Catalog.open(file_name) as catalog:
+      self.assertEqual((catalog.timestamp, catalog.records()), (2, []))
+
+  def test_failed_images_are_not_cached_for_the_whole_ttl(self):
+    cache = FileCache(cachedir=self.cachedir, ttl=3600)
+    self.registry.failing.add('image1')
+    with self.assertLogs(level='WARNING') as logs:
+      records = cache.load(self.repository.list)
+    self.assertEqual([record.tags for record in records if record.name == 'image1'], [[]])
+    self.assertTrue(any('Tags of 1 images' in line for line in logs.output), logs.output)
+    self.assertLessEqual(cache.timestamp(self.repository.list),
+                         time.time() - 3600 + FileCache.FAILED_RETRY)
+
+    # Once the retry delay passed, the next load crawls again and the failures are cleared
+    self.registry.failing.clear()
+    cache = FileCache(cachedir=self.cachedir, ttl=3600 - FileCache.FAILED_RETRY, max_stale=0)
+    records = cache.load(self.repository.list)
+    self.assertEqual([record.tags for record in records if record.name == 'image1'],
+                     [['1.2', '1.1', '1.0']])
+    self.assertEqual([name for name in os.listdir(self.cachedir) if name.endswith('.failed')], [])
+
+  def test_merge_outlives_max_stale(self):
+    old = '%s/merged.old.catalog' % self.cachedir
+    Catalog.write(old, key='old', timestamp=1, records=[])
+    os.utime(old, (1, 1))
+
+    cache = FileCache(cachedir=self.cachedir, ttl=3600, max_stale=0)
+    self.assertEqual(len(cache.merged([self.repository.list])), 4)
+    merged = [name for name in os.listdir(self.cachedir) if name.startswith('merged.')]
+    self.assertEqual(len(merged), 1)
+    self.assertNotIn('merged.old.catalog', merged)
+    self.assertEqual(len(cache.merged([self.repository.list])), 4)
+
+  def test_failed_images_do_not_hide_lower_repositories(self):
+    lower = FakeRegistry(images=4, tags=2).start()
+    try:
+      self.registry.failing.add('image1')
+      with self.assertLogs(level='WARNING'):
+        records = FileCache(cachedir=self.cachedir).merged(
+            [self.repository.list, repository('store', lower.host(), PlainHttpSession()).list])
+    finally:
+      lower.stop()
+    self.assertEqual({record.name: record.tags for record in records},
+                     {'image0': ['1.2', '1.1', '1.0'], 'image1': ['1.1', '1.0'],
+                      'image2': ['1.2', '1.1', '1.0'], 'image3': ['1.2', '1.1', '1.0']})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from cosh.client import is_trusted, planning_env
+
+
+class ClientTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp(prefix='cosh-test-')
+    os.chmod(self.dir, 0o755)
+    self.path = '%s/coshd.sock' % self.dir
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_only_private_sockets_are_trusted(self):
+    self.assertFalse(is_trusted(self.path))
+    with open(self.path, 'w'):
+      pass
+    self.assertFalse(is_trusted(self.path))
+    os.remove(self.path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.bind(self.path)
+      self.assertTrue(is_trusted(self.path))
+      os.chmod(self.dir, 0o775)
+      self.assertFalse(is_trusted(self.path))
+      os.chmod(self.dir, 0o757)
+      self.assertFalse(is_trusted(self.path))
+
+  def test_planning_env_leaves_unrelated_variables_out(self):
+    with mock.patch.dict(os.environ, {'HOME': '/home/user', 'SECRET': 's', 'FOO': 'f',
+                                      'BAR': 'b', 'BAZ': 'z'}):
+      env = planning_env(['-e', 'FOO', '--env=BAR', '-e', 'QUX=q', '-v', '${BAZ}:/baz', 'git'])
+    self.assertEqual({name: env.get(name) for name in ('HOME', 'SECRET', 'FOO', 'BAR', 'BAZ')},
+                     {'HOME': '/home/user', 'SECRET': None, 'FOO': 'f', 'BAR': 'b', 'BAZ': 'z'})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cosh.docker.engine import DockerEngineClient
+
+from tests.support import Captured, KWARGS
+from tests.support.fake_engine import FakeEngine
+
+
+class DockerEngineClientTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp(prefix='cosh-test-')
+    self.socket_path = '%s/engine.sock' % self.dir
+    self.engine = FakeEngine(self.socket_path).start()
+    self.client = DockerEngineClient('echo', socket_path=self.socket_path)
+
+  def tearDown(self):
+    self.engine.stop()
+    shutil.rmtree(self.dir)
+
+  def test_run_pulls_missing_images(self):
+    with Captured() as captured:
+      status = self.client.run('alpine:3.8', ['hello', 'world'], **KWARGS)
+    self.assertEqual((status, captured.stdout), (0, b'hello world\n'))
+    self.assertIn('POST /v1.25/images/create?fromImage=alpine&tag=3.8', self.engine.requests)
+    self.assertEqual(self.engine.containers, {})
+
+  def test_config(self):
+    config = self.client.config('alpine:3.8', [], **KWARGS)
+    self.assertEqual(config['HostConfig']['Binds'], ['/tmp:/tmp', '/tmp:/opt/tmp:ro'])
+    self.assertEqual(config['Env'][0], 'HOME=/root')
+    # Like docker run -e NAME, the value comes from the environment
+    self.assertEqual(config['Env'][1], 'PATH=%s' % os.environ['PATH'])
+
+  def test_stdin_is_forwarded(self):
+    with Captured(stdin=b'line1\nline2\n') as captured:
+      status = self.client.run('alpine:3.8', ['cat'], **KWARGS)
+    self.assertEqual((status, captured.stdout), (0, b'line1\nline2\n'))
+
+  def test_exit_status_and_stderr(self):
+    with Captured() as captured:
+      status = self.client.run('alpine:3.8', ['exit', '3'], **KWARGS)
+    self.assertEqual((status, captured.stderr), (3, b'exiting\n'))
+
+  def test_tty(self):
+    with Captured() as captured:
+      status = self.client.run('alpine:3.8', ['tty'], tty=True, **KWARGS)
+    self.assertEqual((status, captured.stdout), (0, b'tty\n'))
+    self.assertEqual(self.engine.containers, {})
+
+  def test_falls_back_to_the_docker_binary(self):
+    with Captured() as captured:
+      DockerEngineClient('echo', socket_path='%s.missing' % self.socket_path) \
+        .run('alpine:3.8', ['hello'], **KWARGS)
+    self.assertTrue(captured.stdout.startswith(b'run --net=host -i --rm'), captured.stdout)
+
+
+if __name__ == '__main__':
+  unittest.main()
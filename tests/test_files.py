@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from cosh.files import FileLock, atomic_write
+
+
+def locked_increment(file_name, start):
+  start.wait()
+  with FileLock('%s.lock' % file_name):
+    with open(file_name, 'r') as f:
+      value = int(f.read())
+    with atomic_write(file_name) as f:
+      f.write(str(value + 1))
+
+
+class FilesTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp(prefix='cosh-test-')
+    self.file_name = '%s/file' % self.dir
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_atomic_write_replaces_the_file(self):
+    with atomic_write(self.file_name) as f:
+      f.write('first')
+    with open(self.file_name, 'r') as reader:
+      with atomic_write(self.file_name) as f:
+        f.write('second')
+        # Nothing is visible before the write completes
+        with open(self.file_name, 'r') as current:
+          self.assertEqual(current.read(), 'first')
+      # Open readers keep the content they opened
+      self.assertEqual(reader.read(), 'first')
+    with open(self.file_name, 'r') as f:
+      self.assertEqual(f.read(), 'second')
+    self.assertEqual(os.listdir(self.dir), ['file'])
+
+  def test_failed_atomic_write_keeps_the_previous_file(self):
+    with atomic_write(self.file_name) as f:
+      f.write('first')
+    with self.assertRaises(ValueError):
+      with atomic_write(self.file_name) as f:
+        f.write('partial')
+        raise ValueError()
+    with open(self.file_name, 'r') as f:
+      self.assertEqual(f.read(), 'first')
+    self.assertEqual(os.listdir(self.dir), ['file'])
+
+  def test_atomic_write_permissions(self):
+    with atomic_write(self.file_name, permissions=0o600) as f:
+      f.write('secret')
+    self.assertEqual(os.stat(self.file_name).st_mode & 0o777, 0o600)
+
+  def test_file_lock_serializes_processes(self):
+    with atomic_write(self.file_name) as f:
+      f.write('0')
+    start = multiprocessing.Barrier(8)
+    processes = [multiprocessing.Process(target=locked_increment, args=(self.file_name, start))
+                 for _ in range(8)]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join()
+    with open(self.file_name, 'r') as f:
+      self.assertEqual(f.read(), '8')
+
+  def test_file_lock_non_blocking(self):
+    lock = FileLock('%s.lock' % self.file_name)
+    self.assertTrue(lock.acquire())
+    try:
+      # flock locks belong to the open file, a second open conflicts even in the same process
+      self.assertFalse(FileLock('%s.lock' % self.file_name).acquire(blocking=False))
+    finally:
+      lock.release()
+    other = FileLock('%s.lock' % self.file_name)
+    self.assertTrue(other.acquire(blocking=False))
+    other.release()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+import shutil
+import tempfile
+import unittest
+
+from cosh.cache import FileCache
+from cosh.mirror import CatalogMirror, MirroredRepository
+
+from tests.support import repository
+from tests.support.fake_registry import FakeRegistry, PlainHttpSession, RecordingHttpSession
+
+
+def client(registry, mirror, kind='store'):
+  http = RecordingHttpSession()
+  return MirroredRepository(repository(kind, registry.host(), PlainHttpSession()),
+                            'http://%s:%d' % mirror.address(), http), http
+
+
+def crawled(registry):
+  return repository('store', registry.host(), PlainHttpSession()).list()
+
+
+def fields(records):
+  return [record.fields() for record in records]
+
+
+class CatalogMirrorTest(unittest.TestCase):
+  def setUp(self):
+    self.registry = FakeRegistry(images=8, tags=3).start()
+    self.cachedir = tempfile.mkdtemp(prefix='cosh-test-')
+    # Every refresh of the mirror crawls the registry again
+    self.mirror = CatalogMirror(FileCache(cachedir=self.cachedir, ttl=0, max_stale=0),
+                                [repository('store', self.registry.host(), PlainHttpSession())],
+                                refresh_interval=3600).start(port=0)
+
+  def tearDown(self):
+    self.mirror.stop()
+    self.registry.stop()
+    shutil.rmtree(self.cachedir)
+
+  def test_catalog_is_served_without_a_crawl(self):
+    mirrored, _ = client(self.registry, self.mirror)
+    requests = len(self.registry.requests)
+    records = mirrored.list()
+    self.assertEqual(self.registry.requests[requests:], [])
+    self.assertEqual(fields(records), fields(crawled(self.registry)))
+
+  def test_unchanged_catalog_is_not_modified(self):
+    mirrored, http = client(self.registry, self.mirror)
+    records = mirrored.list()
+    self.assertIs(mirrored.list(records), records)
+    self.assertEqual(http.responses[-1], (304, 0))
+
+  def test_only_changed_records_are_sent(self):
+    mirrored, http = client(self.registry, self.mirror)
+    records = mirrored.list()
+    self.registry.touch('image3')
+    self.mirror.refresh()
+    self.assertEqual(fields(mirrored.list(records)), fields(crawled(self.registry)))
+    self.assertLess(http.responses[-1][1], http.responses[0][1] / 2, http.responses)
+
+  def test_unknown_repository_is_crawled_by_the_client(self):
+    unknown, _ = client(self.registry, self.mirror, kind='v1')
+    requests = len(self.registry.requests)
+    self.assertEqual(len(unknown.list()), 8)
+    self.assertGreater(len(self.registry.requests), requests)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from cosh.docker import DockerEnvironment, DockerTerminalClient, LaunchPlan
+from cosh.provisioners import CommandsProvisioner
+
+from tests.support import FAKE_DOCKER, records
+
+
+class CommandsProvisionerTest(unittest.TestCase):
+  def setUp(self):
+    self.base_dir = tempfile.mkdtemp(prefix='cosh-test-commands-')
+    self.docker_state = tempfile.mkdtemp(prefix='cosh-test-docker-')
+    self.environ = mock.patch.dict(os.environ, {'FAKE_DOCKER_STATE': self.docker_state,
+                                                'FAKE_DOCKER_START_DELAY': '0'})
+    self.environ.start()
+    self.env = DockerEnvironment(tmpdir_base=self.base_dir, home='/root', extra_volumes={},
+                                 extra_envs=[])
+
+  def tearDown(self):
+    self.environ.stop()
+    shutil.rmtree(self.base_dir)
+    shutil.rmtree(self.docker_state)
+
+  def plan(self, size, mode):
+    plan = LaunchPlan.create(docker_client=DockerTerminalClient(FAKE_DOCKER), env=self.env)
+    commands = CommandsProvisioner(plan=plan, records=records(size), base_dir=self.base_dir,
+                                   mode=mode).provision()
+    return plan.with_commands(**commands)
+
+  def test_directory_mode_mounts_the_commands_once(self):
+    commands = [self.plan(size, CommandsProvisioner.MODE_DIRECTORY)
+                .with_command(image='alpine:3.8', arguments=['true']).command().split()
+                for size in (5, 50)]
+    self.assertEqual(commands[0].count('-v'), commands[1].count('-v'))
+    self.assertEqual(commands[0][commands[0].index('--read-only') + 2].split(':')[1],
+                     DockerEnvironment.COMMANDS_DIR)
+    self.assertIn('PATH=/cosh/bin:/usr/local/bin:/usr/bin:/bin', commands[0])
+
+  def test_directory_mode_links_every_command_to_the_dispatcher(self):
+    commands_dir = self.plan(5, CommandsProvisioner.MODE_DIRECTORY).commands_dir
+    self.assertEqual(sorted(os.listdir(commands_dir)),
+                     [CommandsProvisioner.DISPATCHER, CommandsProvisioner.RUNNER] +
+                     ['image%d' % i for i in range(5)])
+    self.assertEqual(os.readlink('%s/image3' % commands_dir), CommandsProvisioner.DISPATCHER)
+    # Run outside of a container the dispatcher starts the nested one itself
+    output = subprocess.check_output(['%s/image3' % commands_dir, 'hello'],
+                                     stdin=subprocess.DEVNULL)
+    self.assertEqual(output, b'hello\n')
+    with open('%s/calls' % self.docker_state) as f:
+      run = [line.split() for line in f if line.startswith('run ')][0]
+    self.assertIn('PATH=/cosh/bin:/usr/local/bin:/usr/bin:/bin', run)
+    self.assertIn('actions/image3:1.0', run)
+
+  def test_mounts_mode_mounts_every_command(self):
+    plan = self.plan(5, CommandsProvisioner.MODE_MOUNTS).with_command(image='alpine:3.8',
+                                                                      arguments=['true'])
+    self.assertEqual([mount.target for mount in plan.commands_mounts],
+                     [DockerEnvironment.COMMANDS_DIR] + ['/sbin/image%d' % i for i in range(5)])
+    self.assertNotIn('PATH=', plan.command())
+
+  def test_mounts_mode_shims_do_not_grow_with_the_catalog(self):
+    shims = []
+    for size in (5, 50):
+      with open('%s/image0' % self.plan(size, CommandsProvisioner.MODE_MOUNTS).commands_dir) as f:
+        shims += [f.read()]
+    self.assertEqual(shims[0], shims[1])
+    self.assertTrue(shims[0].endswith('exec /cosh/bin/.cosh-run actions/image0:1.0 "$@"\n'),
+                    shims[0])
+
+  def test_commands_dir_does_not_depend_on_the_working_dir(self):
+    cwd = os.getcwd()
+    plans = []
+    try:
+      for working_dir in ('/', self.docker_state):
+        os.chdir(working_dir)
+        plans += [self.plan(5, CommandsProvisioner.MODE_MOUNTS)
+                  .with_command(image='alpine:3.8', arguments=['true'])]
+    finally:
+      os.chdir(cwd)
+    self.assertEqual(plans[0].commands_dir, plans[1].commands_dir)
+    self.assertIn('-e COSH_PWD=/ -e COSH_WORKDIR=/mount/root', plans[0].command())
+    self.assertIn('-e COSH_PWD=%s' % self.docker_state, plans[1].command())
+    # Nested containers run where the outer one does
+    subprocess.check_output(['%s/.cosh-run' % plans[0].commands_dir, 'alpine:3.8', 'true'],
+                            env=dict(os.environ, COSH_PWD='/src', COSH_WORKDIR='/src'),
+                            stdin=subprocess.DEVNULL)
+    with open('%s/calls' % self.docker_state) as f:
+      run = ' '.join([line for line in f if line.startswith('run ')][0].split())
+    self.assertIn('-e COSH_PWD=/src -e COSH_WORKDIR=/src -v /src:/src', run)
+    self.assertIn('-w /src', run)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from tests.support import repository
+from tests.support.fake_registry import FakeRegistry, RecordingHttpSession
+
+
+class IncrementalRefreshTest(unittest.TestCase):
+  def setUp(self):
+    self.registry = FakeRegistry(images=4, tags=3).start()
+
+  def tearDown(self):
+    self.registry.stop()
+
+  def tag_requests(self, since):
+    return [path for path in self.registry.requests[since:] if '/tags' in path]
+
+  def test_only_updated_images_are_fetched(self):
+    store = repository('store', self.registry.host(), RecordingHttpSession())
+    records = store.list()
+    requests = len(self.registry.requests)
+    self.registry.touch('image1')
+    updated = store.list(records)
+    self.assertEqual(self.tag_requests(requests),
+                     ['/v2/repositories/actions/image1/tags/?page_size=100'])
+    self.assertEqual([record.last_updated for record in updated if record.name == 'image1'],
+                     ['2018-08-15T00:00:01Z'])
+    # Unchanged images keep their previous records
+    self.assertEqual([updated_record is record for updated_record, record in zip(updated, records)],
+                     [True, False, True, True])
+
+  def test_not_modified_images_keep_their_tags(self):
+    http = RecordingHttpSession()
+    v1 = repository('v1', self.registry.host(), http)
+    records = v1.list()
+    # Only the touched image is served with the new tags, the others are not modified
+    self.registry.tags = 5
+    self.registry.touch('image1')
+    responses = len(http.responses)
+    updated = v1.list(records)
+    self.assertEqual([len(record.tags) for record in updated], [3, 5, 3, 3])
+    self.assertEqual(sorted(status for status, _ in http.responses[responses:]),
+                     [200, 200, 304, 304, 304])
+
+
+if __name__ == '__main__':
+  unittest.main()
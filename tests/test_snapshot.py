@@ -0,0 +1,38 @@
+import os
+import shutil
+import unittest
+
+from tests.support import cosh_tmpdir, create_cosh
+from tests.support.fake_registry import FakeRegistry
+
+
+class CatalogSnapshotTest(unittest.TestCase):
+  def setUp(self):
+    self.registry = FakeRegistry(images=4, tags=30).start()
+    self.tmpdirs = [cosh_tmpdir() for _ in range(3)]
+    self.snapshot = '%s/catalog.snapshot' % self.tmpdirs[0]
+    create_cosh(self.registry, self.tmpdirs[0]).export_catalog(self.snapshot)
+    self.requests = len(self.registry.requests)
+    self.registry.touch('image0')
+
+  def tearDown(self):
+    self.registry.stop()
+    for tmpdir in self.tmpdirs:
+      shutil.rmtree(tmpdir)
+
+  def test_imported_catalog_is_served_from_the_cache(self):
+    create_cosh(self.registry, self.tmpdirs[1]).import_catalog(self.snapshot)
+    plan = create_cosh(self.registry, self.tmpdirs[1]).plan('image0:^1.2', [])
+    self.assertTrue(plan.image.endswith('image0:1.29'), plan.image)
+    self.assertEqual(self.registry.requests[self.requests:], [])
+
+  def test_snapshot_is_used_in_place(self):
+    snapshot_cosh = create_cosh(self.registry, self.tmpdirs[2], '--catalog-snapshot', self.snapshot)
+    plan = snapshot_cosh.plan('image1', [])
+    self.assertTrue(plan.image.endswith('image1:1.29'), plan.image)
+    self.assertEqual(self.registry.requests[self.requests:], [])
+    self.assertFalse(os.path.exists('%s/cosh/cache' % self.tmpdirs[2]))
+
+
+if __name__ == '__main__':
+  unittest.main()
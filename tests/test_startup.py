@@ -0,0 +1,38 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+
+from tests.support import ROOT, WARM_START, warm_tmpdir
+
+
+class StartupTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = warm_tmpdir(20)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_warm_start_does_not_import_registry_clients(self):
+    output = subprocess.check_output(
+        [sys.executable, '-c', WARM_START,
+         '--tmpdir', self.tmpdir, '--docker-binary', 'true', 'image0', '--version'],
+        env=dict(os.environ, PYTHONPATH=ROOT, COSH_NO_DAEMON='1'))
+    modules = json.loads(output.decode('utf-8'))['modules']
+    self.assertEqual([module for module in ('requests', 'google.auth', 'natsort')
+                      if module in modules], [])
+
+  def test_client_does_not_import_the_package(self):
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys\n'
+         'from cosh import client\n'
+         'print(" ".join(sorted(module for module in sys.modules if module.startswith("cosh"))))'],
+        env=dict(os.environ, PYTHONPATH=ROOT))
+    self.assertEqual(output.decode('utf-8').split(), ['cosh', 'cosh.client'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cosh.docker.tokens import TokenCache
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+
+def cached_token(tokendir, refreshes, start):
+  def refresh():
+    # Slow enough for the other processes to find the refresh running
+    time.sleep(0.2)
+    with open(refreshes, 'a') as f:
+      f.write('refresh\n')
+    return 'token', time.time() + 3600
+
+  start.wait()
+  TokenCache(tokendir).get(['service_account', 'cosh'], SCOPES, refresh)
+
+
+class TokenCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp(prefix='cosh-test-')
+    self.tokendir = '%s/tokens' % self.dir
+    self.cache = TokenCache(self.tokendir)
+    self.refreshes = []
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def refresh(self, lifetime):
+    def fn_refresh():
+      self.refreshes += [lifetime]
+      return 'token%d' % len(self.refreshes), time.time() + lifetime
+    return fn_refresh
+
+  def test_tokens_are_refreshed_within_the_expiry_margin(self):
+    identity = ['service_account', 'cosh']
+    self.assertEqual(self.cache.get(identity, SCOPES, self.refresh(3600))[0], 'token1')
+    self.assertEqual(self.cache.get(identity, SCOPES, self.refresh(3600))[0], 'token1')
+    # Expires within the margin, so it is refreshed on every use
+    self.assertEqual(self.cache.get(['other'], SCOPES,
+                                    self.refresh(TokenCache.REFRESH_MARGIN - 1))[0], 'token2')
+    self.assertEqual(self.cache.get(['other'], SCOPES, self.refresh(3600))[0], 'token3')
+    self.assertEqual(self.cache.get(['other'], SCOPES, self.refresh(3600))[0], 'token3')
+    self.assertEqual(len(self.refreshes), 3)
+
+  def test_processes_share_a_single_refresh(self):
+    refreshes = '%s/refreshes' % self.dir
+    start = multiprocessing.Barrier(6)
+    processes = [multiprocessing.Process(target=cached_token,
+                                         args=(self.tokendir, refreshes, start))
+                 for _ in range(6)]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join()
+    with open(refreshes, 'r') as f:
+      self.assertEqual(f.read(), 'refresh\n')
+
+  def test_tokens_are_private(self):
+    self.assertFalse(os.path.exists(self.tokendir))
+    umask = os.umask(0o022)
+    try:
+      self.cache.get(['service_account', 'cosh'], SCOPES, self.refresh(3600))
+    finally:
+      os.umask(umask)
+    self.assertEqual(os.stat(self.tokendir).st_mode & 0o777, 0o700)
+    tokens = [entry for entry in os.listdir(self.tokendir) if entry.endswith('.json')]
+    self.assertEqual(len(tokens), 1)
+    self.assertEqual(os.stat('%s/%s' % (self.tokendir, tokens[0])).st_mode & 0o777, 0o600)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from cosh.docker.repositories import DockerRepositoryRecord, natsorted
+from cosh.versions import VersionIndex
+
+from tests.support import tags
+
+
+def resolve(tag_names, spec):
+  return VersionIndex.build(natsorted(tag_names, reverse=True)).resolve(spec)
+
+
+class VersionIndexTest(unittest.TestCase):
+  def test_constraints(self):
+    # Decoded from the cache, the way Cosh sees it
+    record = DockerRepositoryRecord.from_fields(
+        DockerRepositoryRecord(repository=None, namespace='actions', name='node',
+                               tags=tags(20, 10, 10)).fields())
+    for spec, expected in [('^3.5', '3.9.9'),
+                           ('~3.5', '3.5.9'),
+                           ('>=10 <12', '11.9.9'),
+                           ('<=2.3', '2.3.9'),
+                           ('>3', '19.9.9'),
+                           ('8-*', '8-jre'),
+                           ('^0.2', '0.2.9'),
+                           ('^20', None)]:
+      self.assertEqual(record.version_index().resolve(spec), expected, spec)
+
+  def test_pre_releases_are_skipped(self):
+    self.assertEqual(resolve(['3.6.0', '3.6.1-rc1'], '^3.5'), '3.6.0')
+    self.assertEqual(resolve(['3.6.0', '3.7.0-beta.2', '3.7.0a1', '3.7.0-SNAPSHOT'], '^3.5'),
+                     '3.6.0')
+    self.assertIsNone(resolve(['3.6.1-rc1'], '^3.5'))
+    # Globs name the tags they want
+    self.assertEqual(resolve(['3.6.0', '3.6.1-rc1'], '3.6.1-*'), '3.6.1-rc1')
+
+  def test_plain_releases_win_over_variants(self):
+    self.assertEqual(resolve(['3.6.0', '3.6.1-alpine', '3.6.1-slim'], '^3.5'), '3.6.0')
+    self.assertEqual(resolve(['3.6.0-alpine', '3.6.1-alpine', '2.0'], '^3.5'), '3.6.1-alpine')
+
+  def test_older_fields_are_rebuilt(self):
+    record = DockerRepositoryRecord(repository=None, namespace='actions', name='node',
+                                    tags=['3.6.0', '3.6.1-rc1'], versions=[[1, 0], [0, 1]])
+    self.assertEqual(record.version_index().resolve('^3.5'), '3.6.0')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cosh.docker import DockerTerminalClient
+from cosh.docker.warm import WarmContainerClient
+
+from tests.support import FAKE_DOCKER, KWARGS
+
+
+class WarmContainerClientTest(unittest.TestCase):
+  def setUp(self):
+    self.docker_state = tempfile.mkdtemp(prefix='cosh-test-docker-')
+    self.warm_dir = tempfile.mkdtemp(prefix='cosh-test-warm-')
+    self.environ = mock.patch.dict(os.environ, {'FAKE_DOCKER_STATE': self.docker_state,
+                                                'FAKE_DOCKER_START_DELAY': '0'})
+    self.environ.start()
+    self.client = WarmContainerClient(DockerTerminalClient(FAKE_DOCKER), state_dir=self.warm_dir,
+                                      idle_timeout=60)
+
+  def tearDown(self):
+    self.environ.stop()
+    shutil.rmtree(self.docker_state)
+    shutil.rmtree(self.warm_dir)
+
+  def calls(self):
+    with open('%s/calls' % self.docker_state) as f:
+      return [line.split() for line in f]
+
+  def containers(self):
+    return [entry for entry in os.listdir(self.docker_state) if entry.startswith('cosh-warm-')]
+
+  def states(self):
+    return [entry for entry in os.listdir(self.warm_dir) if entry.endswith('.json')]
+
+  def test_containers_are_reused_per_options(self):
+    first = self.client.exec_command('alpine:3.8', ['hello'], **KWARGS)
+    second = self.client.exec_command('alpine:3.8', ['world'], **KWARGS)
+    other = self.client.exec_command('alpine:3.8', ['world'], **dict(KWARGS, working_dir='/'))
+    self.assertIn(' exec -i cosh-warm-', first)
+    self.assertIn(' echo hello || ', first)
+    self.assertEqual(first.split()[3], second.split()[3])
+    self.assertNotEqual(first.split()[3], other.split()[3])
+    self.assertEqual([call[0] for call in self.calls()].count('run'), 2)
+    self.assertEqual(subprocess.check_output(second, shell=True), b'world\n')
+
+  def test_containers_exit_by_themselves(self):
+    self.client.exec_command('alpine:3.8', ['hello'], **KWARGS)
+    run = [call for call in self.calls() if call[0] == 'run'][0]
+    self.assertIn('--label', run)
+    self.assertEqual(run[run.index('--label') + 1], 'cosh.warm=60')
+    self.assertIn('[ "$idle" -lt 60 ]', ' '.join(run))
+
+  def test_reap_only_forgets_exited_containers(self):
+    self.client.exec_command('alpine:3.8', ['hello'], **KWARGS)
+    self.client.idle_timeout = 0
+    time.sleep(0.01)
+    # A container that is still running may be in use by a long command
+    self.client.reap()
+    self.assertEqual(len(self.states()), 1)
+    self.assertEqual(len(self.containers()), 1)
+    self.assertNotIn('rm', [call[0] for call in self.calls()[1:]])
+
+    subprocess.check_call('%s rm -f %s' % (FAKE_DOCKER, self.containers()[0]), shell=True)
+    self.client.reap()
+    self.assertEqual(self.states(), [])
+
+
+  def test_missing_containers_fall_back_to_a_cold_run(self):
+    command = self.client.exec_command('alpine:3.8', ['hello'], **KWARGS)
+    # Gone between the running check and the exec
+    subprocess.check_call('%s rm -f %s' % (FAKE_DOCKER, self.containers()[0]), shell=True)
+    calls = len(self.calls())
+    self.assertEqual(subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL),
+                     b'hello\n')
+    self.assertEqual([call[0] for call in self.calls()[calls:]], ['exec', 'inspect', 'run'])
+    self.assertNotIn('-d', self.calls()[-1])
+
+  def test_failing_commands_are_not_run_again(self):
+    command = self.client.exec_command('alpine:3.8', ['exit=3'], **KWARGS)
+    calls = len(self.calls())
+    self.assertEqual(subprocess.call(command, shell=True, stdout=subprocess.DEVNULL), 3)
+    self.assertEqual([call[0] for call in self.calls()[calls:]], ['exec', 'inspect'])
+
+
+if __name__ == '__main__':
+  unittest.main()